@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+albumArtEngine.py - Headless album art search and bulk apply, grouped by album
+"""
+
+import os
+import argparse
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import mp4Padding
+import circuitBreaker
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+SEARCH_LIMIT = 10
+PROVIDER_TIMEOUT = 5  # Seconds allowed for a single provider request
+DEEZER_SEARCH_URL = "https://api.deezer.com/search"
+ITUNES_SEARCH_URL = "https://itunes.apple.com/search"
+
+def search_itunes(query, limit=SEARCH_LIMIT):
+    """Search album art on iTunes and return a list of result dicts"""
+    import requests
+    results = []
+    breaker = circuitBreaker.get_breaker('itunes')
+    if not breaker.allow_request():
+        logger.warning("Skipping iTunes: provider is failing (circuit open)")
+        return results
+    search_url = f"{ITUNES_SEARCH_URL}?term={query}&media=music&limit={limit}"
+    try:
+        with metrics.span('provider_lookup', provider='itunes'):
+            response = requests.get(search_url, timeout=PROVIDER_TIMEOUT)
+        response.raise_for_status()
+        response = response.json()
+        breaker.record_success()
+        for result in response.get("results", []):
+            if "artworkUrl100" in result:
+                # Get the highest quality artwork by replacing '100x100' with larger dimensions
+                results.append({
+                    'art_url': result["artworkUrl100"].replace('100x100', '1200x1200'),
+                    'artist': result.get("artistName", "Unknown Artist"),
+                    'album': result.get("collectionName", "Unknown Album"),
+                    'track': result.get("trackName", "Unknown Track"),
+                    'source': 'iTunes'
+                })
+    except Exception as e:
+        breaker.record_failure()
+        logger.error(f"iTunes search error: {e}")
+    return results
+
+def search_deezer(query, limit=SEARCH_LIMIT):
+    """Search album art on Deezer and return a list of result dicts"""
+    import requests
+    results = []
+    breaker = circuitBreaker.get_breaker('deezer')
+    if not breaker.allow_request():
+        logger.warning("Skipping Deezer: provider is failing (circuit open)")
+        return results
+    search_url = f"{DEEZER_SEARCH_URL}?q={query}&limit={limit}"
+    try:
+        with metrics.span('provider_lookup', provider='deezer'):
+            response = requests.get(search_url, timeout=PROVIDER_TIMEOUT)
+        response.raise_for_status()
+        response = response.json()
+        if "error" in response:
+            # Deezer reports quota and service errors with a 200 status
+            raise RuntimeError(response["error"].get("message", response["error"]))
+        breaker.record_success()
+        for item in response.get("data", []):
+            if "album" in item and "cover_big" in item["album"]:
+                results.append({
+                    'art_url': item["album"]["cover_big"],
+                    'artist': item.get("artist", {}).get("name", "Unknown Artist"),
+                    'album': item.get("album", {}).get("title", "Unknown Album"),
+                    'track': item.get("title", "Unknown Track"),
+                    'source': 'Deezer'
+                })
+    except Exception as e:
+        breaker.record_failure()
+        logger.error(f"Deezer search error: {e}")
+    return results
+
+def search_album_art(query):
+    """Search all providers (iTunes first, then Deezer)"""
+    return search_itunes(query) + search_deezer(query)
+
+def fetch_image(url):
+    """Download image bytes for a URL, returning None on failure"""
+    import requests
+    try:
+        with metrics.span('cover_fetch'):
+            response = requests.get(url, timeout=PROVIDER_TIMEOUT)
+        if response.status_code == 200:
+            metrics.increment('bytes_downloaded', len(response.content), kind='cover')
+            return response.content
+    except Exception as e:
+        logger.error(f"Error downloading image {url}: {e}")
+    return None
+
+def make_cover(image_data):
+    """Wrap raw image bytes in an MP4Cover with the matching format"""
+    from mutagen.mp4 import MP4Cover
+    if image_data[:8] == b'\x89PNG\r\n\x1a\n':
+        return MP4Cover(image_data, imageformat=MP4Cover.FORMAT_PNG)
+    return MP4Cover(image_data, imageformat=MP4Cover.FORMAT_JPEG)
+
+def apply_cover(file_path, image_data):
+    """Write image data as the cover art of an M4A file"""
+    from mutagen.mp4 import MP4
+    try:
+        audio = MP4(file_path)
+        audio['covr'] = [make_cover(image_data)]
+        mp4Padding.save_mp4(audio)
+        return True
+    except Exception as e:
+        logger.error(f"Error applying album art to {file_path}: {e}")
+        return False
+
+def read_album_key(file_path):
+    """
+    Return (album artist, album, has cover) for an M4A file, or None if unreadable.
+    Falls back to the track artist when no album artist is set.
+    """
+    from mutagen.mp4 import MP4
+    try:
+        audio = MP4(file_path)
+    except Exception as e:
+        logger.warning(f"Cannot open as MP4: {file_path} ({e})")
+        return None
+    artist = audio.get('aART', audio.get('\xa9ART', ['']))[0].strip()
+    album = audio.get('\xa9alb', [''])[0].strip()
+    return artist, album, 'covr' in audio
+
+def group_files_by_album(directory, recursive=False, missing_only=False, workers=DEFAULT_WORKERS):
+    """
+    Group M4A files in a directory by (album artist, album) tag.
+    Files without an album tag cannot be grouped and are skipped.
+    """
+    directory = Path(directory)
+    pattern = '**/*.m4a' if recursive else '*.m4a'
+    files = [path for path in directory.glob(pattern) if path.is_file()]
+
+    groups = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file_path, key in zip(files, executor.map(read_album_key, files)):
+            if key is None:
+                continue
+            artist, album, has_cover = key
+            if not album:
+                logger.debug(f"No album tag, skipping: {file_path.name}")
+                continue
+            groups.setdefault((artist, album), []).append((file_path, has_cover))
+
+    if missing_only:
+        # Only keep groups where at least one member lacks a cover
+        groups = {key: members for key, members in groups.items()
+                  if not all(has_cover for _, has_cover in members)}
+
+    return {key: [path for path, _ in members] for key, members in groups.items()}
+
+def choose_result(results, artist, album):
+    """Prefer a result whose album (and artist) match the group, else the first hit"""
+    album_lower = album.lower()
+    artist_lower = artist.lower()
+    for result in results:
+        if result['album'].lower() == album_lower and (not artist or result['artist'].lower() == artist_lower):
+            return result
+    for result in results:
+        if result['album'].lower() == album_lower:
+            return result
+    return results[0] if results else None
+
+def process_album_group(artist, album, files, workers=DEFAULT_WORKERS, dry_run=False):
+    """
+    Run one provider search for an album group and apply the chosen cover
+    to every member file in parallel. Returns the number of files updated.
+    """
+    query = f"{artist} {album}".strip()
+    results = search_album_art(query)
+    result = choose_result(results, artist, album)
+    if not result:
+        logger.warning(f"No album art found for {artist} - {album}")
+        return 0
+
+    logger.info(f"{artist} - {album}: using {result['source']} art from '{result['album']}' "
+                f"for {len(files)} file(s)")
+    if dry_run:
+        return 0
+
+    image_data = fetch_image(result['art_url'])
+    if not image_data:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(lambda path: apply_cover(path, image_data), files))
+
+def process_library(directory, recursive=False, missing_only=False, workers=DEFAULT_WORKERS, dry_run=False):
+    """Group a library by album and fix the cover art of every group"""
+    directory = Path(directory)
+    if not directory.exists() or not directory.is_dir():
+        logger.error(f"Directory not found: {directory}")
+        return
+
+    groups = group_files_by_album(directory, recursive, missing_only, workers)
+    logger.info(f"Found {len(groups)} album group(s) in {directory}")
+
+    stats = {'groups': len(groups), 'files': 0, 'updated': 0}
+    # Searches run a few at a time to stay clear of provider rate limits
+    with ThreadPoolExecutor(max_workers=max(1, workers // 4)) as executor:
+        futures = [executor.submit(process_album_group, artist, album, files, workers, dry_run)
+                   for (artist, album), files in groups.items()]
+        for files, future in zip(groups.values(), futures):
+            stats['files'] += len(files)
+            stats['updated'] += future.result()
+
+    logger.info(f"\nAlbum Art Update Summary:")
+    logger.info(f"Album groups: {stats['groups']}")
+    logger.info(f"Files in groups: {stats['files']}")
+    logger.info(f"Files updated: {stats['updated']}")
+    mp4Padding.report_rewrites()
+    metrics.flush()
+
+def main():
+    """
+    Main function to parse arguments and start the bulk update
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description='Apply album art to a folder of M4A files, one search per album')
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--directory', '-d',
+                        default=os.path.join(script_dir, 'downloads'),
+                        help='Directory containing music files (default: script_location/downloads)')
+    parser.add_argument('--recursive', '-r', action='store_true',
+                        help='Recursively process subdirectories')
+    parser.add_argument('--missing-only', '-m', action='store_true',
+                        help='Only process albums where some files have no cover art')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS,
+                        help=f'Number of parallel workers (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help='Show the chosen art for each album without writing files')
+    parser.add_argument('--debug', action='store_true',
+                        help='Enable debug logging')
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    process_library(args.directory, args.recursive, args.missing_only, args.workers, args.dry_run)
+
+if __name__ == "__main__":
+    main()
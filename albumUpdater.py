@@ -4,16 +4,19 @@ albumUpdater.py - Update album metadata for music files using MusicBrainz API
 """
 
 import os
-import time
 import argparse
 import logging
+import threading
 from pathlib import Path
-import musicbrainzngs
-from mutagen import File
-from mutagen.id3 import ID3, TALB
-from mutagen.easyid3 import EasyID3
-from mutagen.mp4 import MP4
-import mutagen
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import metrics
+import profiler
+import mp4Padding
+import lookupCache
+import libraryIndex
+import catalogMirror
+import circuitBreaker
+import matching
 
 # Configure logging
 logging.basicConfig(
@@ -22,46 +25,292 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Set up MusicBrainz API
-musicbrainzngs.set_useragent(
-    "AlbumMetadataUpdater", 
-    "1.0", 
-    "https://github.com/yourusername/album-updater"
-)
+COVER_ART_URL = "https://coverartarchive.org/release/{release_id}/front-500"
+COVER_TIMEOUT = 10  # Seconds allowed for a Cover Art Archive request
+MUSICBRAINZ_TIMEOUT = 5   # Seconds allowed for a recording search
+SEARCH_LIMIT = 5          # Recordings scored per search
 
-def get_album_info(artist, title):
+# Freeform / TXXX / Vorbis names used by MusicBrainz Picard for the MBIDs
+MBID_TAGS = {
+    'recording_id': ('MusicBrainz Track Id', 'musicbrainz_trackid'),
+    'release_id': ('MusicBrainz Album Id', 'musicbrainz_albumid'),
+    'release_group_id': ('MusicBrainz Release Group Id', 'musicbrainz_releasegroupid'),
+}
+
+_musicbrainz = None
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_musicbrainz():
     """
-    Query MusicBrainz API to get album information for a song
+    Import and configure musicbrainzngs on first use
     """
-    try:
-        # Search for recordings (songs) with the given title and artist
-        result = musicbrainzngs.search_recordings(
-            query=f'recording:"{title}" AND artist:"{artist}"', 
-            limit=5
+    global _musicbrainz
+    if _musicbrainz is None:
+        import musicbrainzngs
+        # Set up MusicBrainz API
+        musicbrainzngs.set_useragent(
+            "AlbumMetadataUpdater", 
+            "1.0", 
+            "https://github.com/yourusername/album-updater"
         )
-        
-        if result and 'recording-list' in result and result['recording-list']:
-            for recording in result['recording-list']:
-                # Check if the recording has release (album) information
-                if 'release-list' in recording:
-                    # Return the first album name found
-                    album_name = recording['release-list'][0]['title']
-                    return album_name
-        
-        logger.warning(f"No album found for {artist} - {title}")
+        _musicbrainz = musicbrainzngs
+    return _musicbrainz
+
+def get_executor():
+    """
+    musicbrainzngs has no request timeout, so searches run on this pool and
+    the caller stops waiting after MUSICBRAINZ_TIMEOUT
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='musicbrainz')
+        return _executor
+
+def _to_int(value):
+    try:
+        return int(str(value).split('/')[0])
+    except (TypeError, ValueError):
         return None
+
+def parse_release_info(recording, release):
+    """Build the release info dict from one recording search hit"""
+    medium = (release.get('medium-list') or [{}])[0]
+    track = (medium.get('track-list') or [{}])[0]
+    date = release.get('date') or ''
+    return {
+        'album': release.get('title'),
+        'artist': recording.get('artist-credit-phrase'),
+        'date': date or None,
+        'year': date[:4] or None,
+        'track': _to_int(track.get('number') or track.get('position')),
+        'track_count': _to_int(medium.get('track-count')),
+        'disc': _to_int(medium.get('position')),
+        'disc_count': _to_int(release.get('medium-count')),
+        'recording_id': recording.get('id'),
+        'release_id': release.get('id'),
+        'release_group_id': (release.get('release-group') or {}).get('id'),
+        'cover_url': COVER_ART_URL.format(release_id=release['id']) if release.get('id') else None,
+    }
+
+def choose_release(releases):
+    """
+    Pick the release a recording is best known from: the earliest official
+    album, ahead of singles, compilations, bootlegs and undated releases
+    """
+    def rank(release):
+        group = release.get('release-group') or {}
+        primary_type = group.get('primary-type') or group.get('type')
+        date = release.get('date') or ''
+        return (release.get('status') != 'Official', primary_type != 'Album',
+                bool(group.get('secondary-type-list')), not date, date)
+    return min(releases, key=rank)
+
+def get_release_info(artist, title, duration=None, deadline=None):
+    """
+    Query MusicBrainz once for a song and return its album, release date,
+    track/disc number, MBIDs and a Cover Art Archive URL, or None.
+    The local catalog mirror is asked before the cache and the web service.
+    Recordings are scored like the other providers' candidates; the search
+    gives up at the deadline and is skipped while MusicBrainz is failing.
+    """
+    info = catalogMirror.find_release(artist, title, duration)
+    if info:
+        has_cover = info.pop('has_cover')
+        info['cover_url'] = COVER_ART_URL.format(release_id=info['release_id']) if has_cover else None
+        return info
+    
+    hit, info = lookupCache.get('musicbrainz_release', artist, title)
+    if hit:
+        if not info:
+            logger.info(f"Skipping lookup, known miss for {artist} - {title}")
+        return info
     
+    if deadline and not deadline.can_start():
+        logger.info("Skipping MusicBrainz: lookup time budget nearly spent")
+        return None
+    breaker = circuitBreaker.get_breaker('musicbrainz')
+    if not breaker.allow_request():
+        logger.info("Skipping MusicBrainz: provider is failing (circuit open)")
+        return None
+    
+    musicbrainzngs = get_musicbrainz()
+    # Field searches let musicbrainzngs escape quotes and other Lucene syntax in the names
+    fields = {'recording': title, 'artist': artist} if artist else {'recording': title}
+    timeout = deadline.timeout(MUSICBRAINZ_TIMEOUT) if deadline else MUSICBRAINZ_TIMEOUT
+    try:
+        # Search for recordings (songs) with the given title and artist; the
+        # hits already carry release IDs, dates and track positions
+        with metrics.span('provider_lookup', provider='musicbrainz'):
+            future = get_executor().submit(musicbrainzngs.search_recordings, limit=SEARCH_LIMIT,
+                                         strict=True, **fields)
+            result = future.result(timeout=timeout)
+        breaker.record_success()
+    except TimeoutError:
+        # Only a full-length timeout counts against MusicBrainz, not one the deadline cut short
+        if timeout >= MUSICBRAINZ_TIMEOUT:
+            breaker.record_failure()
+        else:
+            breaker.release_probe()
+        logger.error(f"MusicBrainz search timed out after {timeout:.1f}s")
+        return None
+    except musicbrainzngs.ResponseError as e:
+        # A rejected query (4xx other than rate limiting) says nothing about the service
+        code = getattr(e.cause, 'code', None)
+        if code and 400 <= code < 500 and code != 429:
+            breaker.release_probe()
+        else:
+            breaker.record_failure()
+        logger.error(f"MusicBrainz API error: {e}")
+        return None
     except musicbrainzngs.WebServiceError as e:
+        breaker.record_failure()
         logger.error(f"MusicBrainz API error: {e}")
         return None
     except Exception as e:
+        breaker.record_failure()
         logger.error(f"Error retrieving album info: {e}")
         return None
+    
+    # Keep the best scoring recording that appears on a release
+    best_score, info = 0.0, None
+    for recording in (result or {}).get('recording-list', []):
+        if not recording.get('release-list'):
+            continue
+        length = recording.get('length')
+        candidate = {
+            'title': recording.get('title'),
+            'artist': recording.get('artist-credit-phrase'),
+            'duration': int(length) / 1000 if length else None,
+        }
+        score = matching.score_candidate(candidate, title, artist, duration)
+        if score > best_score:
+            best_score, info = score, parse_release_info(recording, choose_release(recording['release-list']))
+    
+    if best_score < matching.MATCH_THRESHOLD:
+        logger.warning(f"No album found for {artist} - {title}")
+        info = None
+    lookupCache.put('musicbrainz_release', info, artist, title)
+    return info
+
+def get_album_info(artist, title):
+    """
+    Query MusicBrainz API to get album information for a song
+    """
+    info = get_release_info(artist, title)
+    return info['album'] if info else None
+
+def fetch_cover_art(url):
+    """Download a Cover Art Archive image, or None if the release has no front cover"""
+    import requests
+    
+    try:
+        with metrics.span('cover_fetch', provider='coverartarchive'):
+            response = requests.get(url, timeout=COVER_TIMEOUT)
+        if response.status_code == 200:
+            metrics.increment('bytes_downloaded', len(response.content), kind='cover')
+            return response.content
+        logger.debug(f"No cover art at {url} (status {response.status_code})")
+    except Exception as e:
+        logger.warning(f"Error downloading cover art: {e}")
+    return None
+
+def has_cover(audio):
+    """True if a mutagen file object (or bare ID3 tags) already embeds a picture"""
+    from mutagen.mp4 import MP4
+    from mutagen.id3 import ID3
+    
+    tags = audio if isinstance(audio, ID3) else audio.tags
+    if isinstance(audio, MP4):
+        return bool(tags and tags.get('covr'))
+    if isinstance(tags, ID3):
+        return bool(tags.getall('APIC'))
+    return bool(getattr(audio, 'pictures', None)) or bool(tags and tags.get('metadata_block_picture'))
+
+def apply_release_info(audio, info, cover_data=None):
+    """
+    Set album, date, track/disc numbers, MBIDs and (if given) the cover on a
+    mutagen MP4 or MP3 object, bare ID3 tags, or a Vorbis comment file.
+    Nothing is saved.
+    """
+    from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+    from mutagen.id3 import ID3, TALB, TDRC, TRCK, TPOS, TXXX, UFID, APIC
+    
+    if isinstance(audio, MP4):
+        if info.get('album'):
+            audio['©alb'] = [info['album']]
+        if info.get('date'):
+            audio['©day'] = [info['date']]
+        if info.get('track'):
+            audio['trkn'] = [(info['track'], info.get('track_count') or 0)]
+        if info.get('disc'):
+            audio['disk'] = [(info['disc'], info.get('disc_count') or 0)]
+        for key, (name, _) in MBID_TAGS.items():
+            if info.get(key):
+                audio[f'----:com.apple.iTunes:{name}'] = [MP4FreeForm(info[key].encode('utf-8'))]
+        if cover_data:
+            audio['covr'] = [MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)]
+        return
+    
+    tags = audio if isinstance(audio, ID3) else audio.tags
+    if tags is None and not isinstance(audio, ID3):
+        audio.add_tags()
+        tags = audio.tags
+    if isinstance(tags, ID3):
+        if info.get('album'):
+            tags.setall('TALB', [TALB(encoding=3, text=[info['album']])])
+        if info.get('date'):
+            tags.setall('TDRC', [TDRC(encoding=3, text=[info['date']])])
+        if info.get('track'):
+            total = f"/{info['track_count']}" if info.get('track_count') else ''
+            tags.setall('TRCK', [TRCK(encoding=3, text=[f"{info['track']}{total}"])])
+        if info.get('disc'):
+            total = f"/{info['disc_count']}" if info.get('disc_count') else ''
+            tags.setall('TPOS', [TPOS(encoding=3, text=[f"{info['disc']}{total}"])])
+        if info.get('recording_id'):
+            tags.setall('UFID:http://musicbrainz.org',
+                        [UFID(owner='http://musicbrainz.org', data=info['recording_id'].encode('ascii'))])
+        for key in ('release_id', 'release_group_id'):
+            if info.get(key):
+                name = MBID_TAGS[key][0]
+                tags.setall(f'TXXX:{name}', [TXXX(encoding=3, desc=name, text=[info[key]])])
+        if cover_data:
+            tags.setall('APIC', [APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover_data)])
+        return
+    
+    # Vorbis comments (Ogg, Opus, FLAC)
+    for field, key in (('album', 'album'), ('date', 'date'), ('track', 'tracknumber'),
+                       ('track_count', 'tracktotal'), ('disc', 'discnumber'), ('disc_count', 'disctotal')):
+        if info.get(field):
+            audio[key] = [str(info[field])]
+    for key, (_, comment) in MBID_TAGS.items():
+        if info.get(key):
+            audio[comment] = [info[key]]
+    if cover_data:
+        import base64
+        from mutagen.flac import Picture
+        picture = Picture()
+        picture.type = 3  # Front cover
+        picture.mime = 'image/jpeg'
+        picture.desc = 'Cover'
+        picture.data = cover_data
+        if hasattr(audio, 'add_picture'):
+            audio.clear_pictures()
+            audio.add_picture(picture)
+        else:
+            audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
 
 def update_album_metadata(file_path, force_update=False):
     """
     Update the album metadata for a single music file
     """
+    import mutagen
+    import mutagen.mp3
+    import mutagen.mp4
+    from mutagen import File
+    from mutagen.id3 import ID3
+    
     try:
         # Load the audio file
         audio = File(file_path)
@@ -163,28 +412,33 @@ def update_album_metadata(file_path, force_update=False):
                 logger.error(f"Error extracting from filename: {e}")
                 return False
         
-        # Get album information from MusicBrainz
-        album_name = get_album_info(artist, title)
+        # Get album, date, track numbers, MBIDs and cover URL in one MusicBrainz query;
+        # the file's length helps reject recordings that only share words with the title
+        duration = getattr(audio.info, 'length', None)
+        release_info = get_release_info(artist, title, duration)
         
-        if not album_name:
+        if not release_info or not release_info.get('album'):
             logger.warning(f"Could not find album info for {artist} - {title}")
             return False
+        album_name = release_info['album']
         
-        # Update the album metadata based on file type
-        if isinstance(audio, mutagen.mp3.MP3):
-            # For MP3 files using ID3 tags
-            if not audio.tags:
-                audio.tags = ID3()
-            audio.tags.add(TALB(encoding=3, text=album_name))
-        elif isinstance(audio, mutagen.mp4.MP4):
-            # For M4A files
-            audio['©alb'] = [album_name]
-        else:
-            # For other file types
-            audio['album'] = album_name
+        # Fill in missing artwork from the Cover Art Archive
+        cover_data = None
+        if release_info.get('cover_url') and (force_update or not has_cover(audio)):
+            cover_data = fetch_cover_art(release_info['cover_url'])
+        
+        # Update the metadata based on file type, written in a single save
+        if isinstance(audio, mutagen.mp3.MP3) and not audio.tags:
+            audio.tags = ID3()
+        apply_release_info(audio, release_info, cover_data)
         
         # Save the updated metadata
-        audio.save()
+        if isinstance(audio, mutagen.mp4.MP4):
+            mp4Padding.save_mp4(audio)
+        else:
+            with metrics.span('tag_save'):
+                audio.save()
+            libraryIndex.update_file(file_path)
         logger.info(f"Updated album for {file_path.name}: {album_name}")
         return True
         
@@ -214,29 +468,40 @@ def process_directory(directory_path, force_update=False):
     }
     
     logger.info(f"Scanning directory: {directory}")
+    music_files = [file_path for file_path in directory.glob('*')
+                   if file_path.is_file() and file_path.suffix.lower() in music_extensions]
+    
+    # Without --force only files lacking an album need work; the library
+    # index answers that after reading just the new and changed files
+    if not force_update:
+        libraryIndex.refresh(directory, recursive=False)
+        has_album = {track['path'] for track in libraryIndex.query_tracks(directory, recursive=False)
+                     if track['album']}
+        pending = [file_path for file_path in music_files if os.path.abspath(file_path) not in has_album]
+        stats['skipped'] = len(music_files) - len(pending)
+        music_files = pending
     
     # Process each file in the directory
-    for file_path in directory.glob('*'):
-        if file_path.is_file() and file_path.suffix.lower() in music_extensions:
-            stats['total'] += 1
-            logger.info(f"Processing file {stats['total']}: {file_path.name}")
-            
-            # Update album metadata
-            result = update_album_metadata(file_path, force_update)
-            
-            if result:
-                stats['updated'] += 1
-            else:
-                stats['failed'] += 1
-            
-            # Add a small delay to avoid rate limiting
-            time.sleep(1)
+    for file_path in music_files:
+        stats['total'] += 1
+        logger.info(f"Processing file {stats['total']}: {file_path.name}")
+        
+        # Update album metadata
+        result = update_album_metadata(file_path, force_update)
+        
+        if result:
+            stats['updated'] += 1
+        else:
+            stats['failed'] += 1
     
     # Print statistics
     logger.info(f"\nMetadata Update Summary:")
     logger.info(f"Total files processed: {stats['total']}")
     logger.info(f"Files updated: {stats['updated']}")
+    logger.info(f"Files skipped (album already set): {stats['skipped']}")
     logger.info(f"Files failed: {stats['failed']}")
+    mp4Padding.report_rewrites()
+    metrics.flush()
 
 def main():
     """
@@ -253,8 +518,10 @@ def main():
                         help='Recursively process subdirectories')
     parser.add_argument('--debug', action='store_true',
                         help='Enable debug logging')
+    profiler.add_arguments(parser)
     
     args = parser.parse_args()
+    profiler.enable_from_args(args, 'albumUpdater')
     
     # Set logging level
     if args.debug:
@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+benchmark.py - Offline end-to-end benchmark with stand-in providers
+
+Runs process_song, update_album_metadata, inspect_m4a_file and the duplicate
+scan against local HTTP servers that mimic the Deezer, iTunes and MusicBrainz
+endpoints, using synthetic .m4a files and a fake yt-dlp that serves local
+files. process_song runs with the default settings: the fake yt-dlp also
+works as the streaming subprocess, and every song gets distinct audio so the
+duplicate check runs without matching. Requires ffmpeg.
+"""
+
+import os
+import io
+import sys
+import json
+import re
+import time
+import types
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+from pathlib import Path
+from statistics import median
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape
+
+import main
+import albumUpdater
+import dedupeLibrary
+import lookupCache
+import downloadScheduler
+import m4aInspect
+import libraryIndex
+import videoInfoCache
+import catalogMirror
+import circuitBreaker
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(SCRIPT_DIR, "bench_baseline.json")
+DEFAULT_SIZES = [1, 10, 100]
+LARGE_SIZE = 10000             # Added by --large; process_song takes over an hour at this size
+REGRESSION_THRESHOLD = 0.10  # Flag stages more than 10% slower than baseline
+SONG_LENGTHS = [30, 180, 420]  # Seconds of audio in the synthetic pool
+COVER_SIZES = [300, 1200]      # Square cover edge in pixels
+CLIP_SECONDS = 10              # Length of the distinct clips songs are assembled from
+CLIP_COUNT = 24                # Distinct clips; the first three clips of a song encode its index
+
+class StandInProviders:
+    """
+    Local HTTP server answering Deezer search, iTunes search, MusicBrainz
+    recording search and cover image requests, with configurable latency
+    and error rate.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.host = f"127.0.0.1:{self.server.server_address[1]}"
+        self.base_url = f"http://{self.host}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def should_fail(self):
+        with self._lock:
+            self.requests += 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return fail
+
+    def cover_bytes(self, size):
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new('RGB', (size, size), (size % 256, 80, 160)).save(buffer, format='JPEG')
+        return buffer.getvalue()
+
+    def _make_handler(self):
+        providers = self
+        covers = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, body, content_type):
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # Client gave up, e.g. its timeout fired during the added latency
+
+            def do_GET(self):
+                if providers.latency:
+                    time.sleep(providers.latency)
+                if providers.should_fail():
+                    self.send_error(503)
+                    return
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == '/deezer/search':
+                    term = query.get('q', [''])[0]
+                    body = json.dumps({'data': [{
+                        'title': term,
+                        'artist': {'name': 'Stand-in Artist'},
+                        'album': {'title': 'Stand-in Album',
+                                  'cover_big': f"{providers.base_url}/covers/500.jpg"},
+                    }]})
+                    self.send_body(body.encode('utf-8'), 'application/json')
+                elif url.path == '/itunes/search':
+                    term = query.get('term', [''])[0]
+                    body = json.dumps({'resultCount': 1, 'results': [{
+                        'trackName': term,
+                        'artistName': 'Stand-in Artist',
+                        'collectionName': 'Stand-in Album',
+                        'artworkUrl100': f"{providers.base_url}/covers/100x100.jpg",
+                    }]})
+                    self.send_body(body.encode('utf-8'), 'application/json')
+                elif url.path.startswith('/ws/2/recording'):
+                    self.send_body(musicbrainz_recording_xml(query.get('query', [''])[0]), 'application/xml')
+                elif url.path.startswith('/covers/') or url.path.startswith('/release/'):
+                    name = url.path.rsplit('/', 1)[-1]
+                    size = int(name.split('x')[-1].split('.')[0]) if name[0].isdigit() else 500
+                    if size not in covers:
+                        covers[size] = providers.cover_bytes(min(size, 1200))
+                    self.send_body(covers[size], 'image/jpeg')
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+def musicbrainz_recording_xml(query):
+    """Minimal MusicBrainz web service XML for a recording search, echoing the searched title and artist"""
+    title_match = re.search(r'recording:"((?:[^"\\]|\\.)*)"', query)
+    artist_match = re.search(r'artist:"((?:[^"\\]|\\.)*)"', query)
+    title = re.sub(r'\\(.)', r'\1', title_match.group(1) if title_match else query)
+    artist = re.sub(r'\\(.)', r'\1', artist_match.group(1)) if artist_match else 'Stand-in Artist'
+    title, artist = escape(title[:64]), escape(artist)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#" xmlns:ext="http://musicbrainz.org/ns/ext#-2.0">
+<recording-list count="1" offset="0">
+<recording id="00000000-0000-0000-0000-000000000001" ext:score="100">
+<title>{title}</title><length>180000</length>
+<artist-credit><name-credit><artist id="00000000-0000-0000-0000-000000000002"><name>{artist}</name></artist></name-credit></artist-credit>
+<release-list count="1"><release id="00000000-0000-0000-0000-000000000003"><title>Stand-in Album</title><date>2001-01-01</date>
+<medium-list><medium><position>1</position><track-list count="12" offset="2"><track id="00000000-0000-0000-0000-000000000004"><number>3</number><title>{title}</title></track></track-list></medium></medium-list>
+</release></release-list>
+</recording>
+</recording-list>
+</metadata>""".encode('utf-8')
+
+def generate_m4a(path, seconds, cover_size=None, artist=None, title=None):
+    """Create a synthetic AAC .m4a file with optional tags and cover art"""
+    from PIL import Image
+    from mutagen.mp4 import MP4, MP4Cover
+
+    subprocess.run([
+        main.get_ffmpeg_path(), '-v', 'error', '-f', 'lavfi',
+        '-i', f'sine=frequency={220 + seconds % 440}:duration={seconds}',
+        '-c:a', 'aac', '-b:a', '128k', '-f', 'mp4', '-y', str(path)
+    ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    audio = MP4(path)
+    if artist:
+        audio['\xa9ART'] = [artist]
+    if title:
+        audio['\xa9nam'] = [title]
+    if cover_size:
+        buffer = io.BytesIO()
+        Image.effect_noise((cover_size, cover_size), 64).convert('RGB').save(buffer, format='JPEG')
+        audio['covr'] = [MP4Cover(buffer.getvalue(), imageformat=MP4Cover.FORMAT_JPEG)]
+    audio.save()
+
+def build_source_pool(directory):
+    """Generate one source file per (length, cover size) combination"""
+    os.makedirs(directory, exist_ok=True)
+    pool = []
+    for seconds in SONG_LENGTHS:
+        for cover_size in COVER_SIZES:
+            path = Path(directory) / f"source_{seconds}s_{cover_size}px.m4a"
+            generate_m4a(path, seconds, cover_size, 'Pool Artist', f'Pool Song {seconds}')
+            pool.append(path)
+    return pool
+
+def build_library(directory, count, pool):
+    """Fill a directory with count tagged files copied from the source pool"""
+    from mutagen.mp4 import MP4
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index in range(count):
+        path = Path(directory) / f"Artist {index} - Song {index}.m4a"
+        shutil.copyfile(pool[index % len(pool)], path)
+        audio = MP4(path)
+        audio['\xa9ART'] = [f"Artist {index}"]
+        audio['\xa9nam'] = [f"Song {index}"]
+        audio.save()
+        paths.append(path)
+    return paths
+
+def generate_clips(directory):
+    """Short clips with distinct tones and loudness patterns, so songs built from them fingerprint differently"""
+    os.makedirs(directory, exist_ok=True)
+    clips = []
+    for index in range(CLIP_COUNT):
+        path = Path(directory) / f"clip_{index:02d}.m4a"
+        clips.append(path)
+        if path.exists():
+            continue
+        subprocess.run([
+            main.get_ffmpeg_path(), '-v', 'error', '-f', 'lavfi',
+            '-i', f'sine=frequency={200 + 35 * index}:duration={CLIP_SECONDS},tremolo=f={0.7 + 0.37 * index}:d=0.9',
+            '-c:a', 'aac', '-b:a', '128k', '-f', 'mp4', '-y', str(path)
+        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return clips
+
+def song_length(index):
+    return SONG_LENGTHS[(index // len(COVER_SIZES)) % len(SONG_LENGTHS)]
+
+def build_song_sources(directory, count, clips):
+    """
+    One source file per song index, concatenated from clips without
+    re-encoding. Indexes below CLIP_COUNT ** 3 never share audio, so the
+    duplicate check finds nothing, as in a real library.
+    """
+    os.makedirs(directory, exist_ok=True)
+    sources = []
+    for index in range(count):
+        path = Path(directory) / f"song_{index}.m4a"
+        digits = [index // CLIP_COUNT ** position % CLIP_COUNT for position in range(3)]
+        order = random.Random(index).choices(range(CLIP_COUNT), k=song_length(index) // CLIP_SECONDS)
+        order[:3] = digits
+        list_path = Path(directory) / f"song_{index}.txt"
+        list_path.write_text("".join(f"file '{clips[clip]}'\n" for clip in order), encoding='utf-8')
+        # Metadata up front, so ffmpeg can read the source from a pipe
+        subprocess.run([
+            main.get_ffmpeg_path(), '-v', 'error', '-f', 'concat', '-safe', '0', '-i', str(list_path),
+            '-c', 'copy', '-movflags', '+faststart', '-y', str(path)
+        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        list_path.unlink()
+        sources.append(path)
+    return sources
+
+# Run as "python -m yt_dlp" by stream_song: writes the source named in the
+# info JSON to stdout and reports progress like yt-dlp's --progress-template
+FAKE_YT_DLP_MAIN = """
+import sys, json, time, argparse
+parser = argparse.ArgumentParser(allow_abbrev=False)
+parser.add_argument('--load-info-json')
+parser.add_argument('--progress-template', default='')
+args, _ = parser.parse_known_args()
+with open(args.load_info_json, encoding='utf-8') as f:
+    info = json.load(f)
+template = args.progress_template.split(':', 1)[-1]
+start, done = time.monotonic(), 0
+
+def report(status):
+    if template:
+        speed = done / max(time.monotonic() - start, 1e-6)
+        sys.stderr.write(template % {'progress.status': status, 'progress.downloaded_bytes': done,
+                                     'progress.speed': speed} + '\\n')
+
+with open(info['bench_source'], 'rb') as source:
+    for chunk in iter(lambda: source.read(1 << 20), b''):
+        sys.stdout.buffer.write(chunk)
+        done += len(chunk)
+        report('downloading')
+sys.stdout.buffer.flush()
+report('finished')
+"""
+
+def install_fake_yt_dlp(pool, workdir):
+    """
+    Register a stand-in yt_dlp module whose downloads copy local files, and
+    put a runnable copy first on PYTHONPATH for the streaming subprocess.
+    Song index i is served from sources[i % len(sources)].
+    """
+    class FakeYoutubeDL:
+        sources = list(pool)
+
+        def __init__(self, params=None):
+            self.params = params or {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def extract_info(self, url, download=False):
+            index = int(url.rsplit('/', 1)[-1])
+            info = {
+                'id': f"bench{index:06d}",
+                'title': f"Artist {index} - Song {index} (Official Video)",
+                'artist': '',
+                'track': '',
+                'duration': song_length(index),
+                'ext': 'webm',
+                'bench_source': str(self.sources[index % len(self.sources)]),
+            }
+            if download:
+                target = self.prepare_filename(info)
+                shutil.copyfile(info['bench_source'], target)
+                info['requested_downloads'] = [{'filepath': target}]
+            return info
+
+        def prepare_filename(self, info):
+            return self.params['outtmpl'].replace('%(title)s', info['title']).replace('%(ext)s', info['ext'])
+
+        def sanitize_info(self, info):
+            return info
+
+    module = types.ModuleType('yt_dlp')
+    module.YoutubeDL = FakeYoutubeDL
+    sys.modules['yt_dlp'] = module
+
+    package = Path(workdir) / "fake_yt_dlp" / "yt_dlp"
+    package.mkdir(parents=True, exist_ok=True)
+    (package / "__init__.py").write_text("", encoding='utf-8')
+    (package / "__main__.py").write_text(FAKE_YT_DLP_MAIN, encoding='utf-8')
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [str(package.parent), os.environ.get('PYTHONPATH')]))
+
+class StageTimer:
+    """Collects wall-clock durations per stage name"""
+    def __init__(self):
+        self.samples = {}
+        self.setup_seconds = 0.0
+
+    @contextlib.contextmanager
+    def setup(self):
+        """Preparation that the benchmark's wall time leaves out"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.setup_seconds += time.perf_counter() - start
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.samples.setdefault(name, []).append(time.perf_counter() - start)
+        return timed
+
+    @contextlib.contextmanager
+    def patched(self, module, names):
+        """Time module-level functions that the code under test looks up as globals"""
+        originals = {name: getattr(module, name) for name in names}
+        for name, func in originals.items():
+            setattr(module, name, self.wrap(name, func))
+        try:
+            yield
+        finally:
+            for name, func in originals.items():
+                setattr(module, name, func)
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'total': sum(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+    }
+
+def bench_process_song(count, workdir, pool, timer, stream=True):
+    """The default pipeline: streaming download, duplicate check, lookups and tagging"""
+    name = "process_song" if stream else "process_song_file"
+    main.DOWNLOAD_DIR = os.path.join(workdir, f"{name}_{count}")
+    os.makedirs(main.DOWNLOAD_DIR, exist_ok=True)
+    main.STREAM_DOWNLOADS = stream
+    yt_dlp = sys.modules['yt_dlp']
+    with timer.setup():
+        yt_dlp.YoutubeDL.sources = build_song_sources(os.path.join(workdir, f"songs_{count}"), count,
+                                                      generate_clips(os.path.join(workdir, "clips")))
+    stages = ['get_video_info', 'download_song', 'stream_song', 'find_existing_duplicate',
+              'get_album_art_and_artist', 'get_release_info', 'embed_metadata']
+    with timer.patched(main, stages), contextlib.redirect_stdout(io.StringIO()):
+        process_song = timer.wrap('process_song', main.process_song)
+        for index in range(count):
+            process_song(f"bench://song/{index}")
+    yt_dlp.YoutubeDL.sources = pool
+
+def bench_process_song_file(count, workdir, pool, timer):
+    """process_song with the file-based download that streaming falls back to"""
+    try:
+        bench_process_song(count, workdir, pool, timer, stream=False)
+    finally:
+        main.STREAM_DOWNLOADS = True
+
+def bench_update_album_metadata(count, workdir, pool, timer):
+    with timer.setup():
+        paths = build_library(os.path.join(workdir, f"albums_{count}"), count, pool)
+    update = timer.wrap('update_album_metadata', albumUpdater.update_album_metadata)
+    with timer.patched(albumUpdater, ['get_release_info', 'fetch_cover_art']):
+        for path in paths:
+            update(path, force_update=True)
+
+def bench_inspect_m4a_file(count, workdir, pool, timer):
+    with timer.setup():
+        paths = build_library(os.path.join(workdir, f"inspect_{count}"), count, pool)
+    inspect = timer.wrap('inspect_m4a_file', m4aInspect.inspect_m4a_file)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for path in paths:
+            inspect(path)
+
+def bench_dedupe_library(count, workdir, pool, timer):
+    """Fingerprint a library and group its duplicates (pool files share audio, so there are many)"""
+    directory = os.path.join(workdir, f"dedupe_{count}")
+    with timer.setup():
+        build_library(directory, count, pool)
+    entries = timer.wrap('build_index', dedupeLibrary.build_index)(directory)
+    timer.wrap('find_duplicate_groups', dedupeLibrary.find_duplicate_groups)(entries)
+
+BENCHMARKS = {
+    'process_song': bench_process_song,
+    'process_song_file': bench_process_song_file,
+    'update_album_metadata': bench_update_album_metadata,
+    'inspect_m4a_file': bench_inspect_m4a_file,
+    'dedupe_library': bench_dedupe_library,
+}
+
+def run_benchmarks(names, sizes, latency, error_rate):
+    """Run each benchmark at each size and return {'name@size': {stage: summary}}"""
+    import logging
+    logging.getLogger('albumUpdater').setLevel(logging.ERROR)
+    logging.getLogger('m4aInspect').setLevel(logging.ERROR)
+    logging.getLogger('downloadScheduler').setLevel(logging.ERROR)
+    logging.getLogger('dedupeLibrary').setLevel(logging.ERROR)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir, \
+            StandInProviders(latency, error_rate) as providers:
+        main.DEEZER_SEARCH_URL = f"{providers.base_url}/deezer/search"
+        main.ITUNES_SEARCH_URL = f"{providers.base_url}/itunes/search"
+        musicbrainzngs = albumUpdater.get_musicbrainz()
+        musicbrainzngs.set_hostname(providers.host, use_https=False)
+        musicbrainzngs.set_rate_limit(False)
+        albumUpdater.COVER_ART_URL = f"{providers.base_url}/release/{{release_id}}/front-500"
+
+        pool = build_source_pool(os.path.join(workdir, "pool"))
+        install_fake_yt_dlp(pool, workdir)
+
+        for name in names:
+            for size in sizes:
+                # Fresh caches and breakers for every run, kept out of the real
+                # library index, so earlier runs' lookups and failures never carry over
+                cache_dir = os.path.join(workdir, "cache", f"{name}_{size}")
+                libraryIndex.INDEX_DB = os.path.join(cache_dir, "library.db")
+                videoInfoCache.INFO_DB = os.path.join(cache_dir, "video_info.db")
+                catalogMirror.CATALOG_DB = os.path.join(cache_dir, "catalog.db")
+                dedupeLibrary.INDEX_DB = os.path.join(cache_dir, "dedupe.db")
+                lookupCache.CACHE_DB = os.path.join(cache_dir, "lookups.db")
+                downloadScheduler.JOBS_DB = os.path.join(cache_dir, "downloads.db")
+                with circuitBreaker._breakers_lock:
+                    circuitBreaker._breakers.clear()
+
+                timer = StageTimer()
+                start = time.perf_counter()
+                BENCHMARKS[name](size, workdir, pool, timer)
+                elapsed = time.perf_counter() - start - timer.setup_seconds
+                stages = {stage: summarize(samples) for stage, samples in timer.samples.items()}
+                stages['wall'] = {'count': size, 'total': elapsed, 'mean': elapsed / size,
+                                  'p50': elapsed / size, 'p95': elapsed / size}
+                results[f"{name}@{size}"] = stages
+                print(f"{name} x{size}: {elapsed:.2f}s ({size / elapsed:.1f} items/s)")
+
+        print(f"Stand-in providers served {providers.requests} requests ({providers.errors} errors)")
+    return results
+
+def print_report(results, baseline):
+    print(f"\n{'benchmark':<30} {'stage':<26} {'mean ms':>10} {'p95 ms':>10} {'vs base':>9}")
+    print("-" * 89)
+    regressions = []
+    for key, stages in results.items():
+        for stage, summary in stages.items():
+            line = f"{key:<30} {stage:<26} {summary['mean'] * 1000:>10.2f} {summary['p95'] * 1000:>10.2f}"
+            base = baseline.get(key, {}).get(stage)
+            if base and base['mean'] > 0:
+                change = (summary['mean'] - base['mean']) / base['mean']
+                line += f" {change:>+8.1%}"
+                if change > REGRESSION_THRESHOLD:
+                    regressions.append(f"{key} {stage}: {change:+.1%}")
+            print(line)
+    return regressions
+
+def main_cli():
+    """
+    Main function to parse arguments and run the benchmarks
+    """
+    parser = argparse.ArgumentParser(description='Offline benchmark of the download and tagging pipeline')
+    parser.add_argument('--benchmarks', '-b', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('--sizes', '-s', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help=f'Item counts to run each benchmark at (default: {DEFAULT_SIZES})')
+    parser.add_argument('--large', action='store_true',
+                        help=f'Also run at {LARGE_SIZE} items (process_song takes over an hour)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of latency added to every stand-in provider response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of stand-in provider requests that fail with HTTP 503')
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help='Baseline file to compare against (default: bench_baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store these results as the new baseline')
+    args = parser.parse_args()
+
+    sizes = args.sizes + ([LARGE_SIZE] if args.large and LARGE_SIZE not in args.sizes else [])
+    results = run_benchmarks(args.benchmarks, sizes, args.latency, args.error_rate)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = print_report(results, baseline)
+    if not baseline and not args.save_baseline:
+        print(f"\nNo baseline at {args.baseline}; record one with --save-baseline")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif regressions:
+        print(f"\nRegressions over {REGRESSION_THRESHOLD:.0%}:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+catalogMirror.py - Local mirror of a music catalog for offline metadata lookups
+
+Imports MusicBrainz JSON dumps (release or recording entities, one JSON
+object per line; plain, compressed or the .tar.xz archives as published)
+into cache/catalog.db. One row per track of a release, with an FTS5 index
+over recording titles and artist names. The album art search and the
+release lookup in albumUpdater.py query it before any remote API, so a
+mirrored library is tagged without network round trips or rate limits.
+
+    python catalogMirror.py --import release.tar.xz
+    python catalogMirror.py --search "artist song title"
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+import logging
+import threading
+import metrics
+import matching
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CATALOG_DB = os.path.join(SCRIPT_DIR, "cache", "catalog.db")
+SEARCH_LIMIT = 10       # Rows returned by one full-text search
+IMPORT_BATCH = 10000    # Rows inserted per executemany during an import
+
+COLUMNS = ['recording_id', 'title', 'artist', 'duration', 'release_id', 'release_title', 'release_group_id',
+           'date', 'track', 'track_count', 'disc', 'disc_count', 'has_cover']
+
+_local = threading.local()
+
+def _connect(create=False):
+    """
+    One connection per thread. Returns None while no catalog has been
+    imported, so lookups cost a stat call and never create an empty database.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != CATALOG_DB:
+        if not create and not os.path.exists(CATALOG_DB):
+            return None
+        os.makedirs(os.path.dirname(CATALOG_DB), exist_ok=True)
+        conn = sqlite3.connect(CATALOG_DB, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                id INTEGER PRIMARY KEY,
+                recording_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                artist TEXT,
+                duration REAL,           -- seconds
+                release_id TEXT NOT NULL,
+                release_title TEXT,
+                release_group_id TEXT,
+                date TEXT,
+                track INTEGER,
+                track_count INTEGER,
+                disc INTEGER,
+                disc_count INTEGER,
+                has_cover INTEGER NOT NULL DEFAULT 0  -- Cover Art Archive has a front image
+            )
+        """)
+        # A re-import replaces rows instead of adding them, even without a track position
+        conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS tracks_position
+            ON tracks (recording_id, release_id, IFNULL(disc, 0), IFNULL(track, 0))
+        """)
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+                title, artist, content='tracks', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        conn.commit()
+        _local.conn, _local.path = conn, CATALOG_DB
+    return conn
+
+def available():
+    """True once a catalog has been imported"""
+    return _connect() is not None
+
+def _artist_credit(credits):
+    """Join an artist-credit list into the name MusicBrainz displays"""
+    parts = []
+    for credit in credits or []:
+        parts.append(credit.get('name') or (credit.get('artist') or {}).get('name', ''))
+        parts.append(credit.get('joinphrase') or '')
+    return "".join(parts) or None
+
+def _to_int(value):
+    try:
+        return int(str(value).split('/')[0])
+    except (TypeError, ValueError):
+        return None
+
+def _seconds(length):
+    return length / 1000 if length else None
+
+def _release_fields(release):
+    return {
+        'release_id': release.get('id'),
+        'release_title': release.get('title'),
+        'release_group_id': (release.get('release-group') or {}).get('id'),
+        'date': release.get('date') or None,
+        'disc_count': len(release.get('media') or []) or _to_int(release.get('medium-count')),
+        'has_cover': int(bool((release.get('cover-art-archive') or {}).get('front'))),
+    }
+
+def rows_from_release(release):
+    """One row per track of a release entity"""
+    fields = _release_fields(release)
+    release_artist = _artist_credit(release.get('artist-credit'))
+    for medium in release.get('media') or []:
+        for track in medium.get('tracks') or []:
+            recording = track.get('recording') or {}
+            if not recording.get('id'):
+                continue
+            yield {
+                **fields,
+                'recording_id': recording['id'],
+                'title': recording.get('title') or track.get('title') or '',
+                'artist': (_artist_credit(recording.get('artist-credit'))
+                           or _artist_credit(track.get('artist-credit')) or release_artist),
+                'duration': _seconds(recording.get('length') or track.get('length')),
+                'track': _to_int(track.get('number') or track.get('position')),
+                'track_count': _to_int(medium.get('track-count')),
+                'disc': _to_int(medium.get('position')),
+            }
+
+def rows_from_recording(recording):
+    """One row per release a recording entity appears on"""
+    artist = _artist_credit(recording.get('artist-credit'))
+    for release in recording.get('releases') or []:
+        medium = (release.get('media') or [{}])[0]
+        track = ((medium.get('tracks') or medium.get('track')) or [{}])[0]
+        yield {
+            **_release_fields(release),
+            'disc_count': _to_int(release.get('medium-count')) or len(release.get('media') or []) or None,
+            'recording_id': recording['id'],
+            'title': recording.get('title') or '',
+            'artist': artist,
+            'duration': _seconds(recording.get('length')),
+            'track': _to_int(track.get('number') or track.get('position')),
+            'track_count': _to_int(medium.get('track-count')),
+            'disc': _to_int(medium.get('position')),
+        }
+
+def rows_from_entity(entity):
+    if 'media' in entity:
+        return rows_from_release(entity)
+    if 'releases' in entity and entity.get('id'):
+        return rows_from_recording(entity)
+    return ()
+
+def _open_lines(path):
+    """
+    Yield the lines of a dump: plain or .gz/.bz2/.xz JSON lines, or every
+    regular file inside a (compressed) tar archive such as the published dumps
+    """
+    import tarfile
+
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and ('/mbdump/' in f"/{member.name}" or member.name.endswith(('.json', '.jsonl'))):
+                    yield from archive.extractfile(member)
+        return
+    if path.endswith('.gz'):
+        import gzip
+        opener = gzip.open
+    elif path.endswith('.bz2'):
+        import bz2
+        opener = bz2.open
+    elif path.endswith('.xz'):
+        import lzma
+        opener = lzma.open
+    else:
+        opener = open
+    with opener(path, 'rb') as f:
+        yield from f
+
+def import_dump(path, replace=False):
+    """
+    Load a dump into the catalog in one transaction and rebuild the search
+    index. Rows already present (same recording, release and position) are
+    replaced. Returns the number of rows written.
+    """
+    conn = _connect(create=True)
+    conn.execute("PRAGMA synchronous=OFF")
+    insert = (f"INSERT OR REPLACE INTO tracks ({', '.join(COLUMNS)}) "
+              f"VALUES ({', '.join('?' * len(COLUMNS))})")
+    written, skipped, batch = 0, 0, []
+    with metrics.span('catalog_import'):
+        conn.execute("BEGIN")
+        if replace:
+            conn.execute("DELETE FROM tracks")
+        for line in _open_lines(path):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entity = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            for row in rows_from_entity(entity):
+                batch.append(tuple(row.get(name) for name in COLUMNS))
+            if len(batch) >= IMPORT_BATCH:
+                conn.executemany(insert, batch)
+                written += len(batch)
+                batch = []
+                logger.info(f"Imported {written} tracks...")
+        conn.executemany(insert, batch)
+        written += len(batch)
+        conn.execute("INSERT INTO tracks_fts(tracks_fts) VALUES ('rebuild')")
+        conn.commit()
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if skipped:
+        logger.warning(f"Skipped {skipped} lines that were not JSON")
+    logger.info(f"Imported {written} tracks from {path}")
+    return written
+
+def _match_terms(text):
+    """Quoted FTS5 terms for the words of a query, so punctuation cannot break the syntax"""
+    words = "".join(ch if ch.isalnum() else " " for ch in text or "").split()
+    return ['"' + word.replace('"', '""') + '"' for word in words]
+
+def _query(conn, expression, limit):
+    with metrics.span('catalog_lookup'):
+        rows = conn.execute(
+            f"SELECT {', '.join('t.' + name for name in COLUMNS)} FROM tracks_fts "
+            f"JOIN tracks t ON t.id = tracks_fts.rowid "
+            f"WHERE tracks_fts MATCH ? ORDER BY rank LIMIT ?",
+            (expression, limit)
+        ).fetchall()
+    metrics.increment('cache_hits' if rows else 'cache_misses', cache='catalog')
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+def search(query, artist=None, limit=SEARCH_LIMIT):
+    """
+    Full-text search: every word of query must appear in the title or
+    artist, and every word of artist (if given) in the artist. Returns row
+    dicts, best match first, or [] when nothing matches or no catalog exists.
+    """
+    conn = _connect()
+    terms = _match_terms(query)
+    if conn is None or not terms:
+        return []
+    expression = " AND ".join(terms)
+    artist_terms = _match_terms(artist)
+    if artist_terms:
+        expression = f"({expression}) AND artist : ({' AND '.join(artist_terms)})"
+    return _query(conn, expression, limit)
+
+def find_release(artist, title, duration=None):
+    """
+    The catalog's best release for a song as a dict shaped like
+    albumUpdater.parse_release_info (has_cover instead of cover_url), or
+    None. Full-text hits are scored on title, artist and duration like the
+    other providers' candidates, and none below MATCH_THRESHOLD is used.
+    """
+    conn = _connect()
+    if conn is None:
+        return None
+    title_terms = _match_terms(title)
+    if not title_terms:
+        return None
+    expression = f"title : ({' AND '.join(title_terms)})"
+    artist_terms = _match_terms(artist)
+    if artist_terms:
+        expression += f" AND artist : ({' AND '.join(artist_terms)})"
+    best_score, row = 0.0, None
+    for candidate in _query(conn, expression, SEARCH_LIMIT):
+        score = matching.score_candidate(candidate, title, artist, duration)
+        if score > best_score:
+            best_score, row = score, candidate
+    if best_score < matching.MATCH_THRESHOLD:
+        return None
+    date = row['date'] or ''
+    return {
+        'album': row['release_title'],
+        'artist': row['artist'],
+        'date': date or None,
+        'year': date[:4] or None,
+        'track': row['track'],
+        'track_count': row['track_count'],
+        'disc': row['disc'],
+        'disc_count': row['disc_count'],
+        'recording_id': row['recording_id'],
+        'release_id': row['release_id'],
+        'release_group_id': row['release_group_id'],
+        'has_cover': bool(row['has_cover']),
+    }
+
+def summary():
+    conn = _connect()
+    if conn is None:
+        return {'tracks': 0, 'releases': 0}
+    tracks, releases = conn.execute("SELECT COUNT(*), COUNT(DISTINCT release_id) FROM tracks").fetchone()
+    return {'tracks': tracks, 'releases': releases}
+
+def main():
+    """
+    Main function to parse arguments and import or query the catalog
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description='Import and search the local catalog mirror')
+    parser.add_argument('--import', dest='import_paths', nargs='+', metavar='DUMP',
+                        help='MusicBrainz JSON dump files or archives to import')
+    parser.add_argument('--replace', action='store_true',
+                        help='Empty the catalog before importing')
+    parser.add_argument('--search', help='Search titles and artists')
+    parser.add_argument('--artist', help='Restrict --search to this artist')
+    args = parser.parse_args()
+
+    for index, path in enumerate(args.import_paths or []):
+        if not os.path.exists(path):
+            logger.error(f"Dump not found: {path}")
+            continue
+        import_dump(path, replace=args.replace and index == 0)
+    if args.search:
+        for row in search(args.search, args.artist):
+            print(f"{row['artist']} - {row['title']} [{row['release_title']}, {row['date'] or '?'}] "
+                  f"track {row['track']}/{row['track_count']}  {row['recording_id']}")
+    counts = summary()
+    print(f"Catalog: {counts['tracks']} tracks on {counts['releases']} releases")
+
+if __name__ == "__main__":
+    main()
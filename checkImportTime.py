@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+checkImportTime.py - Fail if entry point cold start exceeds its import-time budget
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+# Cumulative import time budget per entry point, in milliseconds
+IMPORT_BUDGET_MS = {
+    'main': 150,
+    'albumUpdater': 150,
+    'm4aInspect': 150,
+    'editAlbumArt': 150,
+    'albumArtEngine': 150,
+    'jobQueue': 150,
+    'libraryCheck': 150,
+}
+
+# Modules that must only be imported by the code paths that use them
+DEFERRED_MODULES = {'yt_dlp', 'requests', 'mutagen', 'PIL', 'tkinter', 'musicbrainzngs'}
+
+def measure_import(module_name, python=sys.executable):
+    """
+    Import a module in a fresh interpreter with -X importtime and return
+    (total cumulative microseconds, {top-level package: cumulative microseconds}).
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [python, '-X', 'importtime', '-c', f'import {module_name}'],
+        cwd=script_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module_name} failed:\n{result.stderr}")
+
+    total_us = 0
+    packages = {}
+    for line in result.stderr.splitlines():
+        # Format: "import time: self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|', 2)
+        depth = len(name) - len(name.lstrip())
+        name = name.strip()
+        cumulative_us = int(cumulative)
+        # Only count first-level entries so nested imports are not double counted
+        if depth == 1:
+            total_us += cumulative_us
+        top_level = name.split('.')[0]
+        packages[top_level] = max(packages.get(top_level, 0), cumulative_us)
+    return total_us, packages
+
+def check_module(module_name, budget_ms):
+    """Return a list of problems found for a module (empty when within budget)"""
+    problems = []
+    total_us, packages = measure_import(module_name)
+    total_ms = total_us / 1000
+    print(f"{module_name}: {total_ms:.1f} ms (budget {budget_ms} ms)")
+
+    if total_ms > budget_ms:
+        dependencies = {name: us for name, us in packages.items() if name != module_name}
+        heaviest = sorted(dependencies.items(), key=lambda item: item[1], reverse=True)[:5]
+        details = ", ".join(f"{name} {us / 1000:.1f} ms" for name, us in heaviest)
+        problems.append(f"{module_name} took {total_ms:.1f} ms to import (budget {budget_ms} ms); heaviest: {details}")
+
+    eager = sorted(DEFERRED_MODULES & set(packages))
+    if eager:
+        problems.append(f"{module_name} imports {', '.join(eager)} at module load")
+    return problems
+
+def main():
+    """
+    Main function to parse arguments and run the budget check
+    """
+    parser = argparse.ArgumentParser(description='Check entry point import time against a budget')
+    parser.add_argument('modules', nargs='*', default=list(IMPORT_BUDGET_MS),
+                        help='Modules to check (default: all entry points)')
+    parser.add_argument('--budget', type=float,
+                        help='Override the budget in milliseconds for every module')
+    args = parser.parse_args()
+
+    problems = []
+    for module_name in args.modules:
+        budget_ms = args.budget if args.budget is not None else IMPORT_BUDGET_MS.get(module_name, 150)
+        problems.extend(check_module(module_name, budget_ms))
+
+    if problems:
+        print("\nImport time check failed:")
+        for problem in problems:
+            print(f"  - {problem}")
+        sys.exit(1)
+    print("\nImport time check passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+circuitBreaker.py - Per-provider circuit breakers and lookup deadlines
+"""
+
+import time
+import threading
+import metrics
+
+FAILURE_THRESHOLD = 3   # Consecutive failures or timeouts before a provider is skipped
+RESET_TIMEOUT = 30      # Seconds a breaker stays open before a half-open probe
+MIN_REQUEST_TIME = 1.0  # Seconds of lookup budget a request needs; with less left the provider is skipped
+
+class CircuitBreaker:
+    """
+    Tracks failures for one provider.
+
+    closed: requests pass; FAILURE_THRESHOLD consecutive failures open it.
+    open: requests are skipped until RESET_TIMEOUT has passed.
+    half-open: a single probe request is let through; success closes the
+    breaker, failure opens it again.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """Return True if a request to this provider should be attempted"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+        metrics.increment('provider_skips', provider=self.name)
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """
+        Neither success nor failure (e.g. a timeout the deadline cut short):
+        let the next request probe again instead of leaving the breaker
+        half-open with a probe that never reports back
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    metrics.increment('circuit_opened', provider=self.name)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name):
+    """Return the shared breaker for a provider, creating it on first use"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+class Deadline:
+    """Time budget shared by all lookups made for one song"""
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap):
+        """Per-request timeout: the remaining budget, capped at cap seconds"""
+        return min(cap, self.remaining())
+
+    def can_start(self):
+        """
+        True while a request still has a fair chance to finish. A request
+        started with less time would time out and count against a healthy
+        provider's breaker.
+        """
+        return self.remaining() >= MIN_REQUEST_TIME
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+dedupeLibrary.py - Find duplicate songs by duration and a compact audio fingerprint
+
+Each file is decoded once with ffmpeg to low-rate mono PCM. The fingerprint is
+one bit per 250 ms frame (is the frame louder than the previous one), which
+survives re-encoding and bitrate changes. Fingerprints are cached in SQLite by
+path, size and mtime, so later runs only decode new or changed files.
+"""
+
+import os
+import sqlite3
+import argparse
+import logging
+import subprocess
+import threading
+from array import array
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import libraryIndex
+from ffmpegPath import get_ffmpeg_path
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_DB = os.path.join(SCRIPT_DIR, "cache", "dedupe.db")
+SAMPLE_RATE = 4000          # Hz of the decoded mono PCM used for fingerprints
+FRAME_SAMPLES = 1000        # 250 ms per fingerprint bit
+DURATION_TOLERANCE = 2.0    # Seconds two duplicates may differ by
+SIMILARITY_THRESHOLD = 0.9  # Fraction of matching fingerprint bits for a duplicate
+MAX_SHIFT = 4               # Frames of offset tried when aligning fingerprints
+MIN_BITS = 20               # Fingerprints shorter than this (5 s) are never matched
+MIN_VARIATION = 0.1         # Fraction of frames where the loudness trend must flip for a usable fingerprint
+DEFAULT_WORKERS = os.cpu_count() or 4
+MUSIC_EXTENSIONS = {'.m4a', '.mp3', '.opus', '.ogg', '.flac', '.webm', '.wav'}
+
+_local = threading.local()
+
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != INDEX_DB:
+        os.makedirs(os.path.dirname(INDEX_DB), exist_ok=True)
+        conn = sqlite3.connect(INDEX_DB, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                duration REAL NOT NULL,
+                bits INTEGER NOT NULL,
+                signature TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS fingerprints_duration ON fingerprints (duration)")
+        conn.commit()
+        _local.conn, _local.path = conn, INDEX_DB
+    return conn
+
+def decode_pcm(path):
+    """Decode a file to mono signed 16-bit PCM at SAMPLE_RATE"""
+    result = subprocess.run([
+        get_ffmpeg_path(), '-v', 'error', '-i', str(path),
+        '-vn', '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', '-'
+    ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    samples = array('h')
+    samples.frombytes(result.stdout[:len(result.stdout) - len(result.stdout) % 2])
+    return samples
+
+def compute_fingerprint(path):
+    """Return (duration seconds, number of bits, fingerprint as an int)"""
+    samples = decode_pcm(path)
+    energies = []
+    for start in range(0, len(samples) - FRAME_SAMPLES + 1, FRAME_SAMPLES):
+        frame = samples[start:start + FRAME_SAMPLES]
+        energies.append(sum(sample * sample for sample in frame))
+    value = 0
+    for previous, current in zip(energies, energies[1:]):
+        value = (value << 1) | (1 if current > previous else 0)
+    return len(samples) / SAMPLE_RATE, max(0, len(energies) - 1), value
+
+def is_distinctive(bits, value):
+    """
+    False for fingerprints of silence, constant tones and other audio whose
+    loudness hardly changes: their bits are almost all equal, so any two of
+    them look identical
+    """
+    if bits < MIN_BITS:
+        return False
+    flips = bin((value ^ (value >> 1)) & ((1 << (bits - 1)) - 1)).count('1')
+    return flips >= MIN_VARIATION * (bits - 1)
+
+def _cached_fingerprint(conn, path, stat):
+    row = conn.execute(
+        "SELECT duration, bits, signature FROM fingerprints WHERE path = ? AND size = ? AND mtime_ns = ?",
+        (path, stat.st_size, stat.st_mtime_ns)
+    ).fetchone()
+    return (row[0], row[1], int(row[2], 16)) if row else None
+
+def _store_fingerprint(conn, path, stat, fingerprint):
+    duration, bits, value = fingerprint
+    conn.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?)",
+                 (path, stat.st_size, stat.st_mtime_ns, duration, bits, format(value, 'x')))
+
+def get_fingerprint(path):
+    """Return the cached fingerprint for a file, computing it if the file changed"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    conn = _connect()
+    fingerprint = _cached_fingerprint(conn, path, stat)
+    if fingerprint is None:
+        fingerprint = compute_fingerprint(path)
+        _store_fingerprint(conn, path, stat, fingerprint)
+        conn.commit()
+    return fingerprint
+
+def _bit_slice(value, length, start, count):
+    """Bits start..start+count of a length-bit fingerprint (first frame is the high bit)"""
+    return (value >> (length - start - count)) & ((1 << count) - 1)
+
+def similarity(a, b):
+    """Best fraction of equal bits between two fingerprints over small alignment shifts"""
+    bits_a, value_a = a
+    bits_b, value_b = b
+    best = 0.0
+    for shift in range(-MAX_SHIFT, MAX_SHIFT + 1):
+        start_a, start_b = max(0, shift), max(0, -shift)
+        overlap = min(bits_a - start_a, bits_b - start_b)
+        if overlap <= 0:
+            continue
+        difference = _bit_slice(value_a, bits_a, start_a, overlap) ^ _bit_slice(value_b, bits_b, start_b, overlap)
+        best = max(best, 1 - bin(difference).count('1') / overlap)
+    return best
+
+def list_music_files(directory):
+    return [path for path in Path(directory).rglob('*')
+            if path.is_file() and path.suffix.lower() in MUSIC_EXTENSIONS]
+
+def build_index(directory, workers=DEFAULT_WORKERS):
+    """Fingerprint every music file under a directory and drop stale entries"""
+    files = list_music_files(directory)
+
+    def fingerprint(path):
+        try:
+            return os.path.abspath(path), get_fingerprint(path)
+        except Exception as e:
+            logger.warning(f"Could not fingerprint {path}: {e}")
+            return os.path.abspath(path), None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        entries = {path: fp for path, fp in executor.map(fingerprint, files) if fp}
+
+    # Forget files that no longer exist under this directory
+    conn = _connect()
+    prefix = os.path.abspath(directory) + os.sep
+    stale = [row[0] for row in conn.execute("SELECT path FROM fingerprints WHERE substr(path, 1, ?) = ?",
+                                            (len(prefix), prefix))
+             if row[0] not in entries]
+    conn.executemany("DELETE FROM fingerprints WHERE path = ?", [(path,) for path in stale])
+    conn.commit()
+    return entries
+
+def same_song(path_a, path_b, source_ids=None):
+    """
+    True for two outputs of one download: the formats share a base name and
+    are tagged with the same source video ID. They are never duplicates.
+    """
+    if os.path.splitext(path_a)[0] == os.path.splitext(path_b)[0]:
+        return True
+    source_ids = source_ids or {}
+    source_a = source_ids.get(path_a)
+    return bool(source_a) and source_a == source_ids.get(path_b)
+
+def find_duplicate_groups(entries, source_ids=None):
+    """
+    Group paths whose durations and fingerprints match. source_ids maps
+    paths to their source video ID, so the formats of one song stay apart.
+    """
+    ordered = sorted(((path, fp) for path, fp in entries.items() if is_distinctive(fp[1], fp[2])),
+                     key=lambda item: item[1][0])
+    parent = {path: path for path in entries}
+
+    def find(path):
+        while parent[path] != path:
+            parent[path] = parent[parent[path]]
+            path = parent[path]
+        return path
+
+    for i, (path_a, (duration_a, bits_a, value_a)) in enumerate(ordered):
+        # Durations are sorted, so only a short window needs comparing
+        for path_b, (duration_b, bits_b, value_b) in ordered[i + 1:]:
+            if duration_b - duration_a > DURATION_TOLERANCE:
+                break
+            if same_song(path_a, path_b, source_ids):
+                continue
+            if similarity((bits_a, value_a), (bits_b, value_b)) >= SIMILARITY_THRESHOLD:
+                parent[find(path_b)] = find(path_a)
+
+    groups = {}
+    for path in entries:
+        groups.setdefault(find(path), []).append(path)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+def find_duplicate(path, exclude_self=True, source_id=None):
+    """
+    Check a single file against the index. Returns the path of an indexed
+    near-identical track, or None. The file itself is added to the index.
+    Other formats of the same file and files downloaded from source_id
+    (an earlier run of the same video) are not duplicates.
+
+    The lookup and the insert run in one write transaction, so of two
+    copies of a song checked at the same time (by other download workers
+    or processes) only the later one is reported as a duplicate.
+    """
+    own_path = os.path.abspath(path)
+    stat = os.stat(own_path)
+    conn = _connect()
+    fingerprint = _cached_fingerprint(conn, own_path, stat) or compute_fingerprint(own_path)
+    duration, bits, value = fingerprint
+    same_source = set()
+    if source_id:
+        same_source = {track['path'] for track in libraryIndex.query_tracks(source_id=source_id)}
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = []
+        if is_distinctive(bits, value):
+            rows = conn.execute(
+                "SELECT path, bits, signature FROM fingerprints WHERE duration BETWEEN ? AND ?",
+                (duration - DURATION_TOLERANCE, duration + DURATION_TOLERANCE)
+            ).fetchall()
+        _store_fingerprint(conn, own_path, stat, fingerprint)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    for other_path, other_bits, signature in rows:
+        if exclude_self and other_path == own_path:
+            continue
+        if same_song(own_path, other_path) or other_path in same_source:
+            continue
+        other_value = int(signature, 16)
+        if not is_distinctive(other_bits, other_value) or not os.path.exists(other_path):
+            continue
+        if similarity((bits, value), (other_bits, other_value)) >= SIMILARITY_THRESHOLD:
+            return other_path
+    return None
+
+def update_stat(path):
+    """
+    Record a file's new size and mtime after a tag-only edit, so its
+    fingerprint is not recomputed on the next scan
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    conn = _connect()
+    conn.execute("UPDATE fingerprints SET size = ?, mtime_ns = ? WHERE path = ?",
+                 (stat.st_size, stat.st_mtime_ns, path))
+    conn.commit()
+
+def choose_keeper(group):
+    """Keep the largest file of a group (usually the higher bitrate or the one with art)"""
+    return max(group, key=lambda path: os.path.getsize(path))
+
+def main():
+    """
+    Main function to parse arguments and start the duplicate scan
+    """
+    parser = argparse.ArgumentParser(description='Find duplicate songs by audio fingerprint')
+    parser.add_argument('--directory', '-d',
+                        default=os.path.join(SCRIPT_DIR, 'downloads'),
+                        help='Directory containing music files (default: script_location/downloads)')
+    parser.add_argument('--remove', action='store_true',
+                        help='Delete duplicates, keeping the largest file of each group')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS,
+                        help=f'Number of files decoded in parallel (default: {DEFAULT_WORKERS})')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        logger.error(f"Directory not found: {args.directory}")
+        return
+
+    entries = build_index(args.directory, args.workers)
+    libraryIndex.refresh(args.directory, workers=args.workers)
+    source_ids = {track['path']: track['source_id'] for track in libraryIndex.query_tracks(args.directory)}
+    groups = find_duplicate_groups(entries, source_ids)
+    logger.info(f"Indexed {len(entries)} files, found {len(groups)} duplicate group(s)")
+
+    removed = 0
+    for group in groups:
+        keeper = choose_keeper(group)
+        logger.info(f"Keep:      {keeper}")
+        for path in group:
+            # The keeper's other formats were grouped through another song
+            if same_song(path, keeper, source_ids):
+                continue
+            if args.remove:
+                os.remove(path)
+                libraryIndex.remove_file(path)
+                removed += 1
+                logger.info(f"Removed:   {path}")
+            else:
+                logger.info(f"Duplicate: {path}")
+    if args.remove:
+        logger.info(f"Removed {removed} duplicate file(s)")
+
+if __name__ == "__main__":
+    main()
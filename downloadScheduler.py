@@ -0,0 +1,353 @@
+"""
+downloadScheduler.py - Bandwidth-aware scheduling of yt-dlp downloads
+
+Caps simultaneous downloads per host, turns on concurrent fragment downloads,
+and splits a global bandwidth ceiling evenly across the downloads that are
+running in every process (jobQueue workers included): each process lists
+its downloads in cache/downloads.db and reads the others' from there.
+Streaming downloads run yt-dlp as a subprocess whose rate cannot change
+after it starts, so they get a conservative share up front and keep it;
+the other downloads split what is left. The ceiling can depend on the time of day: bandwidth.json next to
+this script is re-read whenever it changes, e.g.
+
+    {
+        "limit": null,
+        "per_host": 2,
+        "concurrent_fragments": 4,
+        "schedule": [
+            {"days": ["mon", "tue", "wed", "thu", "fri"], "start": "09:00", "end": "18:00", "limit": "2M"}
+        ]
+    }
+
+limit is in bytes per second ("500K", "2M" or a number); null means
+unlimited. The first schedule entry matching the current time wins.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(SCRIPT_DIR, "bandwidth.json")
+CONCURRENT_FRAGMENTS = 4  # Fragments of one song downloaded in parallel (DASH/HLS formats)
+PER_HOST_LIMIT = 2        # Simultaneous downloads from one site
+REPORT_INTERVAL = 5       # Seconds between live throughput reports
+RECHECK_INTERVAL = 10     # Seconds between checks of the schedule and the other processes' downloads
+STALE_AFTER = 3 * RECHECK_INTERVAL  # Seconds after which a silent download of another process is ignored
+MIN_SHARE = 50 * 1024     # Bytes per second a download gets even when fixed shares use up the ceiling
+JOBS_DB = os.path.join(SCRIPT_DIR, "cache", "downloads.db")
+PROGRESS_MARKER = "[progress]"
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_rate(value):
+    """Parse "500K", "2M" or a number of bytes per second. None means unlimited."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value) or None
+    text = str(value).strip().upper().replace('/S', '')
+    for suffix in ('IB', 'B'):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+            break
+    unit = text[-1] if text and text[-1] in _UNITS else ''
+    number = float(text[:-1] if unit else text)
+    return int(number * _UNITS[unit]) or None
+
+def format_rate(value):
+    if not value:
+        return "unlimited"
+    for unit in ('G', 'M', 'K'):
+        if value >= _UNITS[unit]:
+            return f"{value / _UNITS[unit]:.1f} {unit}iB/s"
+    return f"{value:.0f} B/s"
+
+_local = threading.local()
+
+def _connect():
+    """One connection per thread to the table of running downloads shared by all processes"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != JOBS_DB:
+        os.makedirs(os.path.dirname(JOBS_DB), exist_ok=True)
+        conn = sqlite3.connect(JOBS_DB, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                job_key TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                fixed INTEGER NOT NULL,  -- the rate cannot change after the start
+                rate INTEGER,            -- bytes per second, NULL for unlimited
+                heartbeat REAL NOT NULL
+            )
+        """)
+        conn.commit()
+        _local.conn, _local.path = conn, JOBS_DB
+    return conn
+
+def _number(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def _minutes(text):
+    hours, minutes = text.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def window_matches(window, now):
+    """True if a schedule entry covers the given datetime. Windows may cross midnight."""
+    days = [day[:3].lower() for day in window.get('days', DAY_NAMES)]
+    start, end = _minutes(window.get('start', '00:00')), _minutes(window.get('end', '24:00'))
+    minute = now.hour * 60 + now.minute
+    if start <= end:
+        return DAY_NAMES[now.weekday()] in days and start <= minute < end
+    # Crossing midnight: the part after midnight belongs to the previous day's window
+    if minute >= start:
+        return DAY_NAMES[now.weekday()] in days
+    return minute < end and DAY_NAMES[(now.weekday() - 1) % 7] in days
+
+class Job:
+    """One running download: its share of the bandwidth and its live progress"""
+    def __init__(self, scheduler, url, host, fixed=False):
+        self.scheduler = scheduler
+        self.url = url
+        self.host = host
+        self.key = f"{os.getpid()}-{id(self)}"
+        self.fixed = fixed
+        self.assigned = False
+        self.ydl = None
+        self.ratelimit = None
+        self.speed = 0.0
+        self.downloaded = 0
+
+    def ydl_options(self):
+        """Options to merge into the YoutubeDL params of this download"""
+        return {
+            'concurrent_fragment_downloads': self.scheduler.concurrent_fragments,
+            'ratelimit': self.ratelimit,
+            'progress_hooks': [self.progress_hook],
+        }
+
+    def cli_options(self):
+        """
+        Equivalent yt-dlp command line options, for the streaming subprocess.
+        Progress is printed one line per update for progress_line to parse.
+        """
+        args = ["--concurrent-fragments", str(self.scheduler.concurrent_fragments),
+                "--progress", "--newline", "--progress-template",
+                f"download:{PROGRESS_MARKER} %(progress.status)s %(progress.downloaded_bytes)s %(progress.speed)s"]
+        if self.ratelimit:
+            args += ["--limit-rate", str(self.ratelimit)]
+        return args
+
+    def progress_line(self, line):
+        """Feed a line of the subprocess output to the progress hook. Returns False if it is not progress."""
+        if isinstance(line, bytes):
+            line = line.decode(errors='replace')
+        parts = line.split()
+        if len(parts) != 4 or parts[0] != PROGRESS_MARKER:
+            return False
+        self.progress_hook({'status': parts[1], 'downloaded_bytes': _number(parts[2]), 'speed': _number(parts[3])})
+        return True
+
+    def attach(self, ydl):
+        """
+        Register the YoutubeDL instance so rebalancing can change its rate
+        limit while it downloads. Downloaders read params['ratelimit'] on every
+        chunk; fragment downloaders pick up the new value with their next fragment.
+        """
+        self.ydl = ydl
+        self.scheduler.rebalance()
+
+    def set_ratelimit(self, ratelimit):
+        self.assigned = True
+        self.ratelimit = ratelimit
+        if self.ydl is not None:
+            self.ydl.params['ratelimit'] = ratelimit
+
+    def progress_hook(self, status):
+        if status.get('status') == 'downloading':
+            self.speed = status.get('speed') or 0.0
+            self.downloaded = status.get('downloaded_bytes') or self.downloaded
+        elif status.get('status') == 'finished':
+            self.speed = 0.0
+        self.scheduler.on_progress()
+
+class DownloadScheduler:
+    """Shared by all download threads of a process"""
+    def __init__(self, config_file=CONFIG_FILE):
+        self.config_file = config_file
+        self._config_mtime = None
+        self.base_limit = None
+        self.schedule = []
+        self.per_host = PER_HOST_LIMIT
+        self.concurrent_fragments = CONCURRENT_FRAGMENTS
+        self.jobs = []
+        self.current_limit = None
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._last_report = 0.0
+        self._last_check = 0.0
+        self.reload_config()
+
+    def reload_config(self):
+        """Re-read the config file if it changed. Returns True if it was (re)loaded."""
+        try:
+            mtime = os.stat(self.config_file).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._config_mtime:
+            return False
+        self._config_mtime = mtime
+        config = {}
+        if mtime is not None:
+            try:
+                with open(self.config_file, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring invalid {self.config_file}: {e}")
+                return False
+        self.base_limit = parse_rate(config.get('limit'))
+        self.schedule = config.get('schedule', [])
+        self.per_host = config.get('per_host', PER_HOST_LIMIT)
+        self.concurrent_fragments = config.get('concurrent_fragments', CONCURRENT_FRAGMENTS)
+        return True
+
+    def limit_at(self, now=None):
+        """Global bandwidth ceiling in bytes per second at the given time"""
+        now = now or datetime.now()
+        for window in self.schedule:
+            if window_matches(window, now):
+                return parse_rate(window.get('limit'))
+        return self.base_limit
+
+    def _host_slot(self, host):
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    @contextmanager
+    def slot(self, url, fixed=False):
+        """
+        Wait for a free slot on the URL's host, then run the download as a
+        Job. fixed means the rate limit is read once at the start (a subprocess).
+        """
+        self.reload_config()
+        host = (urlparse(url).hostname or 'unknown').lower()
+        if host.startswith('www.'):
+            host = host[4:]
+        host_slot = self._host_slot(host)
+        if not host_slot.acquire(blocking=False):
+            logger.info(f"Waiting for a free download slot on {host}")
+            host_slot.acquire()
+        job = Job(self, url, host, fixed)
+        with self._lock:
+            self.jobs.append(job)
+        self.rebalance()
+        try:
+            yield job
+        finally:
+            with self._lock:
+                self.jobs.remove(job)
+            host_slot.release()
+            self._withdraw(job)
+            self.rebalance()
+
+    def _other_jobs(self):
+        """(fixed, rate) of the downloads other processes are running"""
+        try:
+            conn = _connect()
+            conn.execute("DELETE FROM downloads WHERE heartbeat < ?", (time.time() - STALE_AFTER,))
+            conn.commit()
+            return conn.execute("SELECT fixed, rate FROM downloads WHERE pid != ?", (os.getpid(),)).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read the downloads of other processes: {e}")
+            return []
+
+    def _publish(self, jobs):
+        """Record this process's downloads and their rates for the other processes"""
+        now = time.time()
+        try:
+            conn = _connect()
+            conn.executemany("INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?)",
+                             [(job.key, os.getpid(), int(job.fixed), job.ratelimit, now) for job in jobs])
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not publish running downloads: {e}")
+
+    def _withdraw(self, job):
+        try:
+            conn = _connect()
+            conn.execute("DELETE FROM downloads WHERE job_key = ?", (job.key,))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not withdraw a finished download: {e}")
+
+    def rebalance(self):
+        """
+        Split the current ceiling across the running downloads of all
+        processes. Fixed downloads keep the share they started with; a new
+        one gets at most an even share of per_host downloads, since more
+        may start while it runs. The rest is split evenly.
+        """
+        self._last_check = time.monotonic()
+        with self._lock:
+            limit = self.limit_at()
+            jobs = list(self.jobs)
+        others = self._other_jobs()
+        frozen = [rate for fixed, rate in others if fixed and rate]
+        frozen += [job.ratelimit for job in jobs if job.fixed and job.assigned and job.ratelimit]
+        total = len(jobs) + len(others)
+        for job in jobs:
+            if job.fixed and not job.assigned:
+                share = None
+                if limit:
+                    available = (limit - sum(frozen)) / max(total - len(frozen), 1)
+                    share = max(int(min(available, limit / max(self.per_host, total))), MIN_SHARE)
+                    frozen.append(share)
+                job.set_ratelimit(share)
+        sharers = total - len(frozen)
+        share = max(int((limit - sum(frozen)) / sharers), MIN_SHARE) if limit and sharers else None
+        for job in jobs:
+            if not job.fixed:
+                job.set_ratelimit(share)
+        self._publish(jobs)
+        if limit != self.current_limit:
+            logger.info(f"Bandwidth limit is now {format_rate(limit)}")
+            self.current_limit = limit
+
+    def on_progress(self):
+        """Called from progress hooks: follow schedule changes and report throughput"""
+        now = time.monotonic()
+        if now - self._last_check >= RECHECK_INTERVAL:
+            self.reload_config()
+            self.rebalance()
+        if now - self._last_report >= REPORT_INTERVAL:
+            self._last_report = now
+            with self._lock:
+                jobs = list(self.jobs)
+            total = sum(job.speed for job in jobs)
+            logger.info(f"Throughput: {format_rate(total)} across {len(jobs)} download(s), "
+                        f"limit {format_rate(self.current_limit)}")
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """Return the process-wide scheduler, creating it on first use"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = DownloadScheduler()
+        return _scheduler
@@ -1,23 +1,81 @@
 import os
 import sys
-import requests
-import subprocess
-from mutagen.mp4 import MP4, MP4Cover
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from tkinter import ttk
-from PIL import Image, ImageTk
+import argparse
+import threading
+from collections import OrderedDict
 from io import BytesIO
+import albumArtEngine
+import metrics
+import profiler
+import mp4Padding
+import libraryCheck
+
+# GUI modules are imported on first use so headless helpers stay cheap to import
+tk = filedialog = messagebox = ttk = Image = ImageTk = LibraryPane = None
+
+def load_gui_modules():
+    """Import tkinter, Pillow and the library pane into module globals"""
+    global tk, filedialog, messagebox, ttk, Image, ImageTk, LibraryPane
+    if tk is not None:
+        return
+    import tkinter
+    from tkinter import filedialog as tk_filedialog, messagebox as tk_messagebox, ttk as tk_ttk
+    from PIL import Image as pil_image, ImageTk as pil_imagetk
+    from libraryBrowser import LibraryPane as library_pane
+    tk, filedialog, messagebox, ttk = tkinter, tk_filedialog, tk_messagebox, tk_ttk
+    Image, ImageTk, LibraryPane = pil_image, pil_imagetk, library_pane
 
 # Constants
-FFMPEG_DIRECTORY = r"ffmpeg\ffmpeg-2025-02-20-git-bc1a3bfd2c-full_build\bin"
 DEFAULT_IMG_SIZE = (300, 300)
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024  # Upper bound for cached raw + decoded images
+
+class ImageCache:
+    """Byte-bounded LRU cache for album art, keyed by (kind, url)"""
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return a cached value and mark it as recently used, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        metrics.increment('cache_hits' if entry is not None else 'cache_misses', cache='image', kind=key[0])
+        return entry[0] if entry is not None else None
+    
+    def put(self, key, value, size):
+        """Store a value with its approximate size, evicting old entries if needed"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+def image_size_in_bytes(img):
+    """Approximate the memory used by a decoded image"""
+    return img.width * img.height * len(img.getbands())
+
 
 class AlbumArtEditor:
     def __init__(self, root):
+        load_gui_modules()
         self.root = root
         self.root.title("Album Art Editor")
-        self.root.geometry("1200x800")
+        self.root.geometry("1600x800")
         self.root.minsize(800, 600)
         
         # Variables
@@ -26,10 +84,20 @@ class AlbumArtEditor:
         self.current_art_url = None
         self.search_results = []
         self.current_result_index = 0
+        self.image_cache = ImageCache()
+        self.prefetching = set()
+        self.prefetch_lock = threading.Lock()
+        
+        # Library browser on the left, editor on the right
+        self.paned = ttk.PanedWindow(root, orient=tk.HORIZONTAL)
+        self.paned.pack(fill=tk.BOTH, expand=True)
+        
+        self.library_pane = LibraryPane(self.paned, on_select=self.select_file)
+        self.paned.add(self.library_pane, weight=1)
         
         # Create main frame
-        self.main_frame = ttk.Frame(root, padding="10")
-        self.main_frame.pack(fill=tk.BOTH, expand=True)
+        self.main_frame = ttk.Frame(self.paned, padding="10")
+        self.paned.add(self.main_frame, weight=2)
         
         # Create file selection area
         self.file_frame = ttk.LabelFrame(self.main_frame, text="Song File", padding="10")
@@ -117,12 +185,20 @@ class AlbumArtEditor:
         )
         
         if file_path:
-            self.file_path_var.set(file_path)
-            self.current_file = file_path
-            self.load_metadata()
+            self.select_file(file_path)
+    
+    def select_file(self, file_path):
+        """Make a file the current file and show its metadata"""
+        self.file_path_var.set(file_path)
+        self.current_file = file_path
+        # The file may have changed since its library row was loaded
+        self.library_pane.invalidate(file_path)
+        self.load_metadata()
     
     def load_metadata(self):
         """Load and display metadata from the selected file"""
+        from mutagen.mp4 import MP4
+        
         try:
             if not os.path.exists(self.current_file):
                 messagebox.showerror("Error", f"File not found: {self.current_file}")
@@ -188,48 +264,11 @@ class AlbumArtEditor:
     
     def search_itunes(self, query):
         """Search album art on iTunes"""
-        search_url = f"https://itunes.apple.com/search?term={query}&media=music&limit=10"
-        try:
-            response = requests.get(search_url).json()
-            for result in response.get("results", []):
-                if "artworkUrl100" in result:
-                    # Get the highest quality artwork by replacing '100x100' with larger dimensions
-                    artwork_url = result["artworkUrl100"].replace('100x100', '1200x1200')
-                    artist = result.get("artistName", "Unknown Artist")
-                    album = result.get("collectionName", "Unknown Album")
-                    track = result.get("trackName", "Unknown Track")
-                    
-                    self.search_results.append({
-                        'art_url': artwork_url,
-                        'artist': artist,
-                        'album': album,
-                        'track': track,
-                        'source': 'iTunes'
-                    })
-        except Exception as e:
-            print(f"iTunes search error: {e}")
+        self.search_results.extend(albumArtEngine.search_itunes(query))
     
     def search_deezer(self, query):
         """Search album art on Deezer"""
-        search_url = f"https://api.deezer.com/search?q={query}&limit=10"
-        try:
-            response = requests.get(search_url).json()
-            for item in response.get("data", []):
-                if "album" in item and "cover_big" in item["album"]:
-                    artwork_url = item["album"]["cover_big"]
-                    artist = item.get("artist", {}).get("name", "Unknown Artist")
-                    album = item.get("album", {}).get("title", "Unknown Album")
-                    track = item.get("title", "Unknown Track")
-                    
-                    self.search_results.append({
-                        'art_url': artwork_url,
-                        'artist': artist,
-                        'album': album,
-                        'track': track,
-                        'source': 'Deezer'
-                    })
-        except Exception as e:
-            print(f"Deezer search error: {e}")
+        self.search_results.extend(albumArtEngine.search_deezer(query))
     
     def update_result_display(self):
         """Update UI to display current search result"""
@@ -238,27 +277,97 @@ class AlbumArtEditor:
         
         result = self.search_results[self.current_result_index]
         
-        # Display the image
-        try:
-            response = requests.get(result['art_url'])
-            if response.status_code == 200:
-                image_data = response.content
-                self.display_image(image_data, self.new_art_display)
-                self.current_art_url = result['art_url']
-            else:
-                self.display_default_image(self.new_art_display, "Image Load Error")
-                self.current_art_url = None
-        except Exception as e:
-            print(f"Error loading image: {e}")
+        # Display the image, served from the cache when possible
+        photo = self.get_photo(result['art_url'])
+        if photo:
+            self.new_art_display.config(image=photo)
+            self.new_art_display.image = photo
+            self.current_art_url = result['art_url']
+        else:
             self.display_default_image(self.new_art_display, "Image Load Error")
             self.current_art_url = None
         
+        # Warm the cache for the neighbouring results
+        self.prefetch_adjacent()
+        
         # Update result counter
         self.result_label.config(
             text=f"Result {self.current_result_index+1} of {len(self.search_results)}: "
                 f"{result['track']} - {result['artist']} ({result['source']})"
         )
     
+    def fetch_image_data(self, url):
+        """Return raw image bytes for a URL, downloading only on a cache miss"""
+        if not url:
+            return None
+        image_data = self.image_cache.get(('raw', url))
+        if image_data is not None:
+            return image_data
+        import requests
+        try:
+            with metrics.span('cover_fetch'):
+                response = requests.get(url)
+            if response.status_code != 200:
+                return None
+            image_data = response.content
+            metrics.increment('bytes_downloaded', len(image_data), kind='cover')
+            self.image_cache.put(('raw', url), image_data, len(image_data))
+            return image_data
+        except Exception as e:
+            print(f"Error loading image: {e}")
+            return None
+    
+    def get_thumbnail(self, url):
+        """Return a decoded, resized PIL image for a URL"""
+        img = self.image_cache.get(('thumb', url))
+        if img is not None:
+            return img
+        image_data = self.fetch_image_data(url)
+        if image_data is None:
+            return None
+        try:
+            with profiler.stage('image_decode'):
+                img = Image.open(BytesIO(image_data))
+                img.thumbnail(DEFAULT_IMG_SIZE)
+                img.load()
+        except Exception as e:
+            print(f"Error decoding image: {e}")
+            return None
+        self.image_cache.put(('thumb', url), img, image_size_in_bytes(img))
+        return img
+    
+    def get_photo(self, url):
+        """Return a PhotoImage for a URL (must be called from the Tk thread)"""
+        photo = self.image_cache.get(('photo', url))
+        if photo is not None:
+            return photo
+        img = self.get_thumbnail(url)
+        if img is None:
+            return None
+        photo = ImageTk.PhotoImage(img)
+        self.image_cache.put(('photo', url), photo, image_size_in_bytes(img))
+        return photo
+    
+    def prefetch_adjacent(self):
+        """Download and decode the previous and next results in the background"""
+        for index in (self.current_result_index - 1, self.current_result_index + 1):
+            if 0 <= index < len(self.search_results):
+                url = self.search_results[index].get('art_url')
+                if not url or self.image_cache.get(('thumb', url)) is not None:
+                    continue
+                with self.prefetch_lock:
+                    if url in self.prefetching:
+                        continue
+                    self.prefetching.add(url)
+                threading.Thread(target=self._prefetch_worker, args=(url,), daemon=True).start()
+    
+    def _prefetch_worker(self, url):
+        try:
+            self.get_thumbnail(url)
+        finally:
+            with self.prefetch_lock:
+                self.prefetching.discard(url)
+    
     def next_result(self):
         """Show next search result"""
         if self.current_result_index < len(self.search_results) - 1:
@@ -324,6 +433,8 @@ class AlbumArtEditor:
     
     def apply_album_art(self):
         """Apply the selected album art to the current file"""
+        from mutagen.mp4 import MP4
+        
         if not self.current_file:
             messagebox.showinfo("Info", "Please select a song file first")
             return
@@ -341,9 +452,7 @@ class AlbumArtEditor:
             if 'data' in result:  # For uploaded images
                 image_data = result['data']
             elif result['art_url']:  # For search results
-                response = requests.get(result['art_url'])
-                if response.status_code == 200:
-                    image_data = response.content
+                image_data = self.fetch_image_data(result['art_url'])
             
             if not image_data:
                 messagebox.showerror("Error", "Could not retrieve image data")
@@ -366,13 +475,16 @@ class AlbumArtEditor:
             audio = MP4(self.current_file)
             
             # Create MP4Cover from image data
-            cover = MP4Cover(image_data, imageformat=MP4Cover.FORMAT_JPEG)
+            cover = albumArtEngine.make_cover(image_data)
             
             # Set the cover art
             audio['covr'] = [cover]
             
-            # Save the file
-            audio.save()
+            # Save the file, in place when the reserved padding allows it
+            if not mp4Padding.save_mp4(audio):
+                print(f"Album art did not fit in the reserved padding, file was rewritten: {self.current_file}")
+            metrics.flush()
+            self.library_pane.invalidate(self.current_file)
             
             # Update the current display
             self.current_art_data = cover
@@ -414,6 +526,8 @@ def fix_mp4_file(file_path):
         print(f"File not found: {file_path}")
         return False
     
+    from mutagen.mp4 import MP4
+    
     try:
         # Check if we can open it as an MP4 file
         MP4(file_path)
@@ -422,40 +536,22 @@ def fix_mp4_file(file_path):
     except Exception as e:
         print(f"File is not a valid MP4: {e}")
         
-        # Try to fix the file with ffmpeg
+        # Remux into a temp file that replaces the original once it checks out
         print("Attempting to fix the file format...")
-        ffmpeg_path = os.path.join(FFMPEG_DIRECTORY, "ffmpeg.exe")
-        temp_path = file_path + ".temp.m4a"
-        
-        ffmpeg_cmd = [
-            ffmpeg_path,
-            "-i", file_path,
-            "-c:a", "copy",  # Just copy the audio stream, no re-encoding
-            "-f", "mp4",     # Ensure mp4 container format
-            "-y",            # Overwrite if exists
-            temp_path
-        ]
-        
-        try:
-            subprocess.run(ffmpeg_cmd, check=True, 
-                          stdout=subprocess.PIPE, 
-                          stderr=subprocess.PIPE)
-            
-            # Remove original file and rename temp file
-            if os.path.exists(temp_path):
-                os.remove(file_path)
-                os.rename(temp_path, file_path)
-                print("File fixed successfully")
-                return True
-            else:
-                print("Failed to fix file format")
-                return False
-        except Exception as fix_e:
-            print(f"Error fixing file: {fix_e}")
-            return False
+        if libraryCheck.repair_file(file_path):
+            print("File fixed successfully")
+            return True
+        print("Failed to fix file format")
+        return False
 
 def main():
     """Main function to run the application"""
+    parser = argparse.ArgumentParser(description='Edit album art of M4A files')
+    profiler.add_arguments(parser)
+    args = parser.parse_args()
+    profiler.enable_from_args(args, 'editAlbumArt')
+    
+    load_gui_modules()
     root = tk.Tk()
     app = AlbumArtEditor(root)
     root.mainloop()
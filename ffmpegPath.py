@@ -0,0 +1,15 @@
+"""
+ffmpegPath.py - Location of the ffmpeg executable, shared by every tool that runs it
+"""
+
+import os
+import shutil
+
+FFMPEG_DIRECTORY = r"ffmpeg\ffmpeg-2025-02-20-git-bc1a3bfd2c-full_build\bin"
+
+def get_ffmpeg_path():
+    """Return the ffmpeg executable from FFMPEG_DIRECTORY, falling back to the one on PATH"""
+    ffmpeg_path = os.path.join(FFMPEG_DIRECTORY, "ffmpeg.exe")
+    if os.path.exists(ffmpeg_path):
+        return ffmpeg_path
+    return shutil.which("ffmpeg") or ffmpeg_path
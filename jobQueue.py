@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+jobQueue.py - Shared download queue with leases, and a worker mode
+
+Songs are enqueued once and claimed by any number of worker processes. A
+claimed job carries a lease that the worker renews with heartbeats while it
+runs; if a worker crashes, its lease expires and the job is handed to the next
+worker. The default backend is SQLite in WAL mode, which is safe for several
+processes on one host. Workers on several hosts need a backend that does its
+own locking (SQLite locking is unreliable on network file systems); register
+it in QUEUE_BACKENDS.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import logging
+import tempfile
+import threading
+import subprocess
+import metrics
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+QUEUE_DB = os.path.join(SCRIPT_DIR, "cache", "jobs.db")
+LEASE_SECONDS = 120       # A job is requeued if its worker misses heartbeats for this long
+HEARTBEAT_INTERVAL = 30   # Seconds between lease renewals of a running job
+MAX_ATTEMPTS = 3          # Failed or abandoned runs before a job is marked failed
+POLL_INTERVAL = 2         # Seconds an idle worker waits before looking for work again
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+class SQLiteJobQueue:
+    """
+    Job queue in a SQLite database. Every state change runs in an IMMEDIATE
+    transaction, so two workers can never claim the same job.
+    """
+    def __init__(self, path=QUEUE_DB, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+
+    def _connect(self):
+        """One connection per thread, since heartbeats run beside the job"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    formats TEXT,            -- JSON list, NULL for OUTPUT_FORMATS
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_expires REAL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def enqueue(self, url, formats=None):
+        """Add a job unless the same URL is already waiting or running. Returns the job id or None."""
+        conn = self._transaction()
+        try:
+            if conn.execute("SELECT 1 FROM jobs WHERE url = ? AND status IN (?, ?)",
+                            (url, QUEUED, RUNNING)).fetchone():
+                conn.execute("COMMIT")
+                return None
+            now = time.time()
+            job_id = conn.execute(
+                "INSERT INTO jobs (url, formats, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (url, json.dumps(formats) if formats else None, QUEUED, now, now)
+            ).lastrowid
+            conn.execute("COMMIT")
+            return job_id
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _requeue_expired(self, conn, now):
+        """Hand jobs whose lease ran out back to the queue, or fail them after MAX_ATTEMPTS"""
+        expired = conn.execute("SELECT id, attempts, worker FROM jobs WHERE status = ? AND lease_expires < ?",
+                               (RUNNING, now)).fetchall()
+        for job_id, attempts, worker in expired:
+            status = FAILED if attempts >= MAX_ATTEMPTS else QUEUED
+            conn.execute("UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, error = ?, updated_at = ? "
+                         "WHERE id = ?", (status, f"lease expired on {worker}", now, job_id))
+            metrics.increment('lease_expired')
+            logger.warning(f"Lease of job {job_id} held by {worker} expired, {status}")
+        return len(expired)
+
+    def claim(self, worker):
+        """Lease the oldest waiting job to a worker. Returns (job_id, url, formats) or None."""
+        conn = self._transaction()
+        try:
+            now = time.time()
+            self._requeue_expired(conn, now)
+            row = conn.execute("SELECT id, url, formats FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                               (QUEUED,)).fetchone()
+            if row:
+                conn.execute("UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, "
+                             "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                             (RUNNING, worker, now + self.lease_seconds, now, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]) if row[2] else None
+
+    def heartbeat(self, job_id, worker):
+        """Extend a lease. Returns False if the worker no longer holds the job."""
+        now = time.time()
+        cursor = self._connect().execute(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+            (now + self.lease_seconds, now, job_id, worker, RUNNING)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker):
+        """Mark a job done. Returns False if the lease had already been lost."""
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = ?, lease_expires = NULL, error = NULL, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND status = ?",
+            (DONE, time.time(), job_id, worker, RUNNING)
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        """Record a failed run: requeue the job, or fail it after MAX_ATTEMPTS"""
+        conn = self._transaction()
+        try:
+            row = conn.execute("SELECT attempts FROM jobs WHERE id = ? AND worker = ? AND status = ?",
+                               (job_id, worker, RUNNING)).fetchone()
+            if row:
+                status = FAILED if row[0] >= MAX_ATTEMPTS else QUEUED
+                conn.execute("UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, error = ?, "
+                             "updated_at = ? WHERE id = ?", (status, str(error)[:500], time.time(), job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def requeue_expired(self):
+        conn = self._transaction()
+        try:
+            count = self._requeue_expired(conn, time.time())
+            conn.execute("COMMIT")
+            return count
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def retry_failed(self):
+        """Put failed jobs back in the queue with a fresh attempt count"""
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = ?, attempts = 0, error = NULL, updated_at = ? WHERE status = ?",
+            (QUEUED, time.time(), FAILED)
+        )
+        return cursor.rowcount
+
+    def counts(self):
+        """Number of jobs per status"""
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        for status, count in self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+            counts[status] = count
+        return counts
+
+    def list_failed(self):
+        return self._connect().execute(
+            "SELECT id, url, attempts, error FROM jobs WHERE status = ? ORDER BY id", (FAILED,)
+        ).fetchall()
+
+QUEUE_BACKENDS = {'sqlite': SQLiteJobQueue}
+
+def open_queue(location=None, backend='sqlite'):
+    """Open the job queue with the given backend"""
+    return QUEUE_BACKENDS[backend](location or QUEUE_DB)
+
+def make_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class Heartbeat:
+    """Renews a job's lease in the background while the job runs"""
+    def __init__(self, job_queue, job_id, worker, interval=None):
+        self.job_queue = job_queue
+        self.job_id = job_id
+        self.worker = worker
+        # Several renewals per lease, so one slow write does not lose the job
+        self.interval = interval or min(HEARTBEAT_INTERVAL, job_queue.lease_seconds / 4)
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.job_queue.heartbeat(self.job_id, self.worker):
+                    self.lost = True
+                    logger.warning(f"Lost the lease on job {self.job_id}, another worker may run it")
+                    return
+            except sqlite3.Error as e:
+                # Keep trying: the lease only expires after LEASE_SECONDS
+                logger.warning(f"Heartbeat for job {self.job_id} failed: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def default_handler(url, formats):
+    import main
+    return main.process_song(url, formats)
+
+def simulated_handler(seconds):
+    """Job handler that only waits, for load tests of the queue itself"""
+    def handle(url, formats):
+        time.sleep(seconds)
+        return True
+    return handle
+
+def run_worker(job_queue, handler=None, exit_when_empty=False, poll_interval=POLL_INTERVAL):
+    """
+    Claim and run jobs until stopped (or until the queue is empty with
+    exit_when_empty). Returns the number of jobs completed.
+    """
+    handler = handler or default_handler
+    worker = make_worker_id()
+    completed = 0
+    logger.info(f"Worker {worker} started")
+    while True:
+        job = job_queue.claim(worker)
+        if job is None:
+            if exit_when_empty and job_queue.counts()[RUNNING] == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+        job_id, url, formats = job
+        logger.info(f"Job {job_id}: {url}")
+        try:
+            with Heartbeat(job_queue, job_id, worker):
+                with metrics.span('process_song', mode='worker'):
+                    success = handler(url, formats)
+            if success:
+                if job_queue.complete(job_id, worker):
+                    completed += 1
+                    metrics.increment('jobs_completed')
+            else:
+                job_queue.fail(job_id, worker, "process_song reported failure")
+                metrics.increment('jobs_failed')
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            job_queue.fail(job_id, worker, e)
+            metrics.increment('jobs_failed')
+        try:
+            metrics.flush()
+        except OSError as e:
+            logger.warning(f"Could not write metrics: {e}")
+    logger.info(f"Worker {worker} finished after {completed} job(s)")
+    return completed
+
+def enqueue_urls(job_queue, urls, formats=None, expand=False):
+    """Enqueue song URLs, expanding playlists and channels first if asked"""
+    added = 0
+    for url in urls:
+        if expand:
+            import main
+            song_urls = main.iter_playlist_entries(url)
+        else:
+            song_urls = [url]
+        for song_url in song_urls:
+            if job_queue.enqueue(song_url, formats) is not None:
+                added += 1
+    return added
+
+def load_test(worker_counts, jobs, job_seconds, crash=False):
+    """
+    Run the queue with several local worker processes and simulated jobs,
+    reporting throughput per worker count. With crash, one worker is killed
+    mid-job to check that its job is requeued when the lease expires.
+    """
+    results = {}
+    for count in worker_counts:
+        with tempfile.TemporaryDirectory() as workdir:
+            location = os.path.join(workdir, "jobs.db")
+            job_queue = SQLiteJobQueue(location)
+            for index in range(jobs):
+                job_queue.enqueue(f"loadtest://job/{index}")
+            lease = max(2, job_seconds * 4)
+            command = [sys.executable, os.path.abspath(__file__), "--queue", location, "worker",
+                       "--exit-when-empty", "--simulate", str(job_seconds),
+                       "--lease", str(lease), "--poll", "0.05"]
+            started = time.perf_counter()
+            workers = [subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                       for _ in range(count)]
+            if crash:
+                # Wait until a job is in flight so the kill leaves a lease behind
+                while job_queue.counts()[RUNNING] == 0 and workers[0].poll() is None:
+                    time.sleep(0.01)
+                workers[0].kill()
+            for process in workers:
+                process.wait()
+            # A killed worker's job waits for its lease; finish the queue here if needed
+            if job_queue.counts()[QUEUED] or job_queue.counts()[RUNNING]:
+                job_queue.lease_seconds = lease
+                run_worker(job_queue, simulated_handler(job_seconds), exit_when_empty=True, poll_interval=0.05)
+            elapsed = time.perf_counter() - started
+            counts = job_queue.counts()
+            results[count] = (elapsed, counts)
+            logger.info(f"{count} worker(s): {jobs} jobs in {elapsed:.2f}s "
+                        f"({jobs / elapsed:.1f} jobs/s), {counts[DONE]} done, {counts[FAILED]} failed")
+    base_count = worker_counts[0]
+    base_elapsed = results[base_count][0]
+    for count, (elapsed, _) in results.items():
+        speedup = base_elapsed / elapsed
+        logger.info(f"{count} worker(s): {speedup:.2f}x the speed of {base_count}, "
+                    f"scaling efficiency {speedup * base_count / count:.0%}")
+    return results
+
+def main():
+    """
+    Main function to parse arguments and manage the job queue
+    """
+    parser = argparse.ArgumentParser(description='Shared download queue and worker mode')
+    parser.add_argument('--queue', default=QUEUE_DB,
+                        help='Queue location (default: cache/jobs.db next to this script)')
+    parser.add_argument('--backend', default='sqlite', choices=sorted(QUEUE_BACKENDS),
+                        help='Queue backend (default: sqlite)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    enqueue_parser = commands.add_parser('enqueue', help='Add songs, playlists or channels to the queue')
+    enqueue_parser.add_argument('urls', nargs='+', help='YouTube URLs')
+    enqueue_parser.add_argument('--playlist', action='store_true',
+                                help='Expand playlist and channel URLs into one job per song')
+    enqueue_parser.add_argument('--formats', nargs='+',
+                                help='Output formats for these jobs (default: OUTPUT_FORMATS in main.py)')
+
+    worker_parser = commands.add_parser('worker', help='Claim and process jobs')
+    worker_parser.add_argument('--exit-when-empty', action='store_true',
+                               help='Stop once no job is waiting or running')
+    worker_parser.add_argument('--simulate', type=float,
+                               help='Sleep this many seconds per job instead of downloading (load tests)')
+    worker_parser.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                               help=f'Lease length in seconds (default: {LEASE_SECONDS})')
+    worker_parser.add_argument('--poll', type=float, default=POLL_INTERVAL,
+                               help=f'Idle poll interval in seconds (default: {POLL_INTERVAL})')
+
+    commands.add_parser('status', help='Show job counts and failed jobs')
+    commands.add_parser('retry-failed', help='Requeue failed jobs')
+
+    load_parser = commands.add_parser('loadtest', help='Measure scaling with local worker processes')
+    load_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                             help='Worker process counts to try (default: 1 2 4)')
+    load_parser.add_argument('--jobs', type=int, default=40, help='Simulated jobs per run (default: 40)')
+    load_parser.add_argument('--job-seconds', type=float, default=0.25,
+                             help='Duration of one simulated job (default: 0.25)')
+    load_parser.add_argument('--crash', action='store_true',
+                             help='Kill one worker mid-job to exercise lease expiry')
+    args = parser.parse_args()
+
+    if args.command == 'loadtest':
+        load_test(args.workers, args.jobs, args.job_seconds, args.crash)
+        return
+
+    job_queue = open_queue(args.queue, args.backend)
+    if args.command == 'enqueue':
+        added = enqueue_urls(job_queue, args.urls, args.formats, args.playlist)
+        logger.info(f"Enqueued {added} job(s)")
+    elif args.command == 'worker':
+        job_queue.lease_seconds = args.lease
+        handler = None
+        if args.simulate is not None:
+            handler = simulated_handler(args.simulate)
+            metrics.METRICS_ENABLED = False  # Keep load tests out of the real metrics
+        else:
+            import main
+            main.sweep_orphans()
+        run_worker(job_queue, handler, args.exit_when_empty, args.poll)
+    elif args.command == 'status':
+        counts = job_queue.counts()
+        print(", ".join(f"{count} {status}" for status, count in counts.items()))
+        for job_id, url, attempts, error in job_queue.list_failed():
+            print(f"  #{job_id} {url} ({attempts} attempts): {error}")
+    elif args.command == 'retry-failed':
+        logger.info(f"Requeued {job_queue.retry_failed()} failed job(s)")
+
+if __name__ == "__main__":
+    main()
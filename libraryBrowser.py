@@ -0,0 +1,289 @@
+"""
+libraryBrowser.py - Virtualized library pane for the album art editor
+"""
+
+import os
+import queue
+import hashlib
+import threading
+import tkinter as tk
+from tkinter import ttk
+from io import BytesIO
+from mutagen.mp4 import MP4
+from PIL import Image, ImageTk
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LIBRARY_DIR = os.path.join(SCRIPT_DIR, "downloads")
+THUMB_CACHE_DIR = os.path.join(SCRIPT_DIR, "cache", "thumbnails")
+THUMB_SIZE = (32, 32)
+ROW_HEIGHT = 36  # Tall enough for a thumbnail
+POLL_INTERVAL_MS = 50
+
+def scan_library(directory):
+    """Return a sorted list of every .m4a path under a directory"""
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith('.m4a'):
+                paths.append(os.path.join(root, name))
+    paths.sort(key=lambda path: os.path.basename(path).lower())
+    return paths
+
+class ThumbnailCache:
+    """On-disk cache of decoded cover thumbnails keyed by path and mtime"""
+    def __init__(self, cache_dir=THUMB_CACHE_DIR, size=THUMB_SIZE):
+        self.cache_dir = cache_dir
+        self.size = size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, path, mtime_ns):
+        key = hashlib.sha1(f"{os.path.abspath(path)}|{mtime_ns}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".png")
+
+    def load(self, path, mtime_ns, cover_data=None):
+        """
+        Return the thumbnail for a file, decoding cover_data on a cache miss.
+        Returns None if there is no cached thumbnail and no cover to decode.
+        """
+        cache_path = self._cache_path(path, mtime_ns)
+        if os.path.exists(cache_path):
+            try:
+                img = Image.open(cache_path)
+                img.load()
+                return img
+            except Exception:
+                pass  # Corrupt cache entry, regenerate below
+        if cover_data is None:
+            return None
+        img = Image.open(BytesIO(bytes(cover_data)))
+        img.thumbnail(self.size)
+        img = img.convert('RGB')
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = cache_path + ".tmp"
+        img.save(temp_path, format='PNG')
+        os.replace(temp_path, cache_path)
+        return img
+
+    def prune(self, paths):
+        """
+        Delete cached thumbnails of files that are gone or have changed
+        since (a new mtime means a new cache entry). Returns the number removed.
+        """
+        keep = set()
+        for path in paths:
+            try:
+                keep.add(os.path.basename(self._cache_path(path, os.stat(path).st_mtime_ns)))
+            except OSError:
+                continue
+        removed = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".png") and name not in keep:
+                    try:
+                        os.remove(os.path.join(root, name))
+                        removed += 1
+                    except OSError:
+                        pass
+        return removed
+
+class LibraryPane(ttk.Frame):
+    """
+    Track list showing only the rows that fit on screen. The Treeview holds a
+    fixed number of items that are refilled as the scrollbar moves, and tags
+    and thumbnails are loaded on a background thread for visible rows only.
+    """
+    def __init__(self, parent, on_select, directory=LIBRARY_DIR):
+        super().__init__(parent, padding="5")
+        self.on_select = on_select
+        self.directory = directory
+        self.paths = []
+        self.offset = 0
+        self.visible_rows = 20
+        self.selected_path = None
+        self.row_info = {}    # path -> (title, artist, album)
+        self.row_thumbs = {}  # path -> PIL image, only for loaded rows near the window
+        self.no_thumbs = set()  # paths known to have no cover
+        self.photos = {}      # path -> PhotoImage for the rows currently shown
+        self.thumb_cache = ThumbnailCache()
+        self.pending = queue.LifoQueue()  # Newest visible rows are loaded first
+        self.loaded = queue.Queue()
+
+        style = ttk.Style(self)
+        style.configure("Library.Treeview", rowheight=ROW_HEIGHT)
+
+        header = ttk.Frame(self)
+        header.pack(fill=tk.X)
+        self.count_label = ttk.Label(header, text="Library")
+        self.count_label.pack(side=tk.LEFT)
+        ttk.Button(header, text="Refresh", command=self.refresh).pack(side=tk.RIGHT)
+
+        body = ttk.Frame(self)
+        body.pack(fill=tk.BOTH, expand=True)
+        self.tree = ttk.Treeview(body, columns=("artist", "album"), style="Library.Treeview",
+                                 show="tree headings", selectmode="browse")
+        self.tree.heading("#0", text="Title")
+        self.tree.heading("artist", text="Artist")
+        self.tree.heading("album", text="Album")
+        self.tree.column("#0", width=220)
+        self.tree.column("artist", width=120)
+        self.tree.column("album", width=120)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.scrollbar = ttk.Scrollbar(body, orient=tk.VERTICAL, command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<MouseWheel>", self.on_mousewheel)
+        self.tree.bind("<Button-4>", lambda event: self.scroll_by(-3))
+        self.tree.bind("<Button-5>", lambda event: self.scroll_by(3))
+        self.tree.bind("<<TreeviewSelect>>", self.on_tree_select)
+
+        threading.Thread(target=self._load_worker, daemon=True).start()
+        self.after(POLL_INTERVAL_MS, self._poll_loaded)
+        self.refresh()
+
+    def refresh(self):
+        """Rescan the library directory and redraw from the top"""
+        self.paths = scan_library(self.directory) if os.path.isdir(self.directory) else []
+        self.row_info.clear()
+        self.row_thumbs.clear()
+        self.no_thumbs.clear()
+        self.offset = 0
+        self.count_label.config(text=f"Library ({len(self.paths)} tracks)")
+        self.redraw()
+        threading.Thread(target=self.thumb_cache.prune, args=(list(self.paths),), daemon=True).start()
+
+    def invalidate(self, path):
+        """Forget a file's tags and thumbnail, e.g. after it was edited, and reload its row if shown"""
+        path = os.path.abspath(path)
+        self.row_info.pop(path, None)
+        self.row_thumbs.pop(path, None)
+        self.no_thumbs.discard(path)
+        self.photos.pop(path, None)
+        if self.tree.exists(path):
+            self.pending.put(path)
+
+    def on_resize(self, event):
+        rows = max(1, (event.height - ROW_HEIGHT) // ROW_HEIGHT)
+        if rows != self.visible_rows:
+            self.visible_rows = rows
+            self.redraw()
+
+    def on_mousewheel(self, event):
+        self.scroll_by(-1 if event.delta > 0 else 1)
+
+    def on_scroll(self, *args):
+        """Scrollbar command: ('moveto', fraction) or ('scroll', n, 'units'|'pages')"""
+        if args[0] == 'moveto':
+            self.set_offset(int(float(args[1]) * len(self.paths)))
+        elif args[0] == 'scroll':
+            step = int(args[1])
+            self.scroll_by(step * self.visible_rows if args[2] == 'pages' else step)
+
+    def scroll_by(self, rows):
+        self.set_offset(self.offset + rows)
+
+    def set_offset(self, offset):
+        offset = max(0, min(offset, len(self.paths) - self.visible_rows))
+        if offset != self.offset:
+            self.offset = offset
+            self.redraw()
+
+    def visible_paths(self):
+        return self.paths[self.offset:self.offset + self.visible_rows]
+
+    def redraw(self):
+        """Refill the Treeview with the rows in the current window"""
+        self.tree.delete(*self.tree.get_children())
+        visible = self.visible_paths()
+        # Drop PhotoImages for rows that scrolled out of view
+        self.photos = {path: photo for path, photo in self.photos.items() if path in visible}
+        for path in visible:
+            self.tree.insert("", tk.END, iid=path, **self._row_values(path))
+            # Rows scrolled back into view may have had their thumbnail pruned
+            if path not in self.row_info or (path not in self.row_thumbs and path not in self.no_thumbs):
+                self.pending.put(path)
+        if self.selected_path in visible:
+            self.tree.selection_set(self.selected_path)
+
+        total = len(self.paths)
+        if total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + len(visible)) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def _row_values(self, path):
+        info = self.row_info.get(path)
+        if info is None:
+            return {'text': os.path.basename(path), 'values': ("", "")}
+        title, artist, album = info
+        values = {'text': title, 'values': (artist, album)}
+        photo = self._photo_for(path)
+        if photo is not None:
+            values['image'] = photo
+        return values
+
+    def _photo_for(self, path):
+        if path in self.photos:
+            return self.photos[path]
+        img = self.row_thumbs.get(path)
+        if img is None:
+            return None
+        photo = ImageTk.PhotoImage(img)
+        self.photos[path] = photo
+        return photo
+
+    def _load_worker(self):
+        """
+        Background thread: read tags and thumbnails for rows that are still
+        visible. Rows whose tags are known only need their thumbnail again,
+        which usually comes from the on-disk cache without opening the file.
+        """
+        while True:
+            path = self.pending.get()
+            info = self.row_info.get(path)
+            if (info is not None and path in self.row_thumbs) or path not in self.visible_paths():
+                continue
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+                thumb = self.thumb_cache.load(path, mtime_ns)
+                if info is None or thumb is None:
+                    audio = MP4(path)
+                    if info is None:
+                        info = (audio.get('\xa9nam', [os.path.basename(path)])[0],
+                                audio.get('\xa9ART', [''])[0],
+                                audio.get('\xa9alb', [''])[0])
+                    if thumb is None and 'covr' in audio:
+                        thumb = self.thumb_cache.load(path, mtime_ns, audio['covr'][0])
+            except Exception as e:
+                print(f"Error reading {path}: {e}")
+                info, thumb = info or (os.path.basename(path), "", ""), None
+            self.loaded.put((path, info, thumb))
+
+    def _poll_loaded(self):
+        """Apply loaded rows on the Tk thread"""
+        try:
+            while True:
+                path, info, thumb = self.loaded.get_nowait()
+                self.row_info[path] = info
+                if thumb is not None:
+                    self.row_thumbs[path] = thumb
+                else:
+                    self.no_thumbs.add(path)
+                if self.tree.exists(path):
+                    self.tree.item(path, **self._row_values(path))
+        except queue.Empty:
+            pass
+        # Only keep thumbnails near the current window in memory
+        if len(self.row_thumbs) > self.visible_rows * 10:
+            start = max(0, self.offset - self.visible_rows * 2)
+            nearby = set(self.paths[start:self.offset + self.visible_rows * 3])
+            self.row_thumbs = {path: img for path, img in self.row_thumbs.items() if path in nearby}
+        self.after(POLL_INTERVAL_MS, self._poll_loaded)
+
+    def on_tree_select(self, event):
+        selected = self.tree.selection()
+        # Redraws re-select the current row; only report real changes
+        if selected and selected[0] != self.selected_path:
+            self.selected_path = selected[0]
+            self.on_select(selected[0])
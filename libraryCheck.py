@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+libraryCheck.py - Verify the MP4 structure of every song and repair broken files in one sweep
+
+The check walks the atom tree without decoding: every box must fit in the
+file, moov and mdat must be present, and the sample tables must point inside
+mdat. It runs in a process pool, so a large library is checked at disk speed.
+Files that parse but look odd (no duration, trailing bytes, implausible
+bitrate) can be given a full decode test with --decode. Broken files are
+remuxed by a small ffmpeg pool into a temp file that is verified before it
+replaces the original. Meant to run on a schedule, e.g.
+
+    python libraryCheck.py --decode --repair
+"""
+
+import os
+import struct
+import shutil
+import argparse
+import logging
+import subprocess
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import libraryIndex
+from ffmpegPath import get_ffmpeg_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = os.cpu_count() or 4
+REPAIR_WORKERS = 2          # ffmpeg remuxes running at once
+MP4_EXTENSIONS = {'.m4a', '.mp4'}
+MIN_BITRATE = 8000          # Bits per second below which a file is suspicious
+MAX_BITRATE = 2000000       # Bits per second above which a file is suspicious
+
+# Boxes whose payload is a list of child boxes, on the path to the sample tables
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+def parse_box_header(header, pos, end):
+    """
+    Parse the box header at pos (header holds at least its first 16 bytes,
+    or what is left before end). Returns (type, payload start, box end) and
+    raises ValueError if the box does not fit before end.
+    """
+    size, box_type = struct.unpack_from('>I4s', header)
+    name = box_type.decode('latin-1')
+    header_size = 8
+    if size == 1:
+        if len(header) < 16:
+            raise ValueError(f"{name} box header is truncated")
+        size = struct.unpack_from('>Q', header, 8)[0]
+        header_size = 16
+    elif size == 0:
+        size = end - pos
+    if size < header_size:
+        raise ValueError(f"{name} box has invalid size {size}")
+    if pos + size > end:
+        raise ValueError(f"{name} box is truncated ({size} bytes, {end - pos} left)")
+    return box_type, pos + header_size, pos + size
+
+def iter_boxes(data, start, end):
+    """Yield (type, payload start, box end) for the child boxes in data[start:end]"""
+    pos = start
+    while end - pos >= 8:
+        box_type, payload, box_end = parse_box_header(data[pos:pos + 16], pos, end)
+        yield box_type, payload, box_end
+        pos = box_end
+    if pos < end:
+        raise ValueError(f"{end - pos} stray bytes after the last child box")
+
+def read_top_level(f, file_size):
+    """
+    Return the top-level boxes as (type, payload start, box end) and the
+    number of trailing bytes too short to be a box, reading only the headers
+    """
+    boxes = []
+    pos = 0
+    while file_size - pos >= 8:
+        f.seek(pos)
+        box = parse_box_header(f.read(16), pos, file_size)
+        boxes.append(box)
+        pos = box[2]
+    return boxes, file_size - pos
+
+def _sample_tables(moov, start, end, tables):
+    """Collect mvhd, stsz and stco/co64 payloads from the moov tree"""
+    for box_type, payload, box_end in iter_boxes(moov, start, end):
+        if box_type in CONTAINER_BOXES:
+            _sample_tables(moov, payload, box_end, tables)
+        elif box_type in (b'mvhd', b'stsz', b'stco', b'co64'):
+            tables.setdefault(box_type, []).append(moov[payload:box_end])
+
+def _movie_duration(mvhd):
+    """Duration in seconds from an mvhd payload"""
+    if mvhd[0] == 1:
+        timescale, duration = struct.unpack_from('>IQ', mvhd, 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', mvhd, 12)
+    return duration / timescale if timescale else 0.0
+
+def _sample_bytes(stsz):
+    """Total size of the samples listed in an stsz payload"""
+    sample_size, count = struct.unpack_from('>II', stsz, 4)
+    if sample_size:
+        return sample_size * count
+    if len(stsz) < 12 + 4 * count:
+        raise ValueError("stsz table is truncated")
+    return sum(struct.unpack_from(f'>{count}I', stsz, 12))
+
+def _chunk_offsets(box_type, table):
+    count = struct.unpack_from('>I', table, 4)[0]
+    width = 8 if box_type == b'co64' else 4
+    if len(table) < 8 + width * count:
+        raise ValueError(f"{box_type.decode()} table is truncated")
+    return struct.unpack_from(f">{count}{'Q' if width == 8 else 'I'}", table, 8)
+
+def check_mp4(path):
+    """
+    Check the atom structure of one file without decoding it. Returns
+    (path, problems, suspicions): a file with problems is broken, one with
+    only suspicions is worth a decode test. Runs in a worker process.
+    """
+    problems, suspicions = [], []
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if file_size < 8:
+                return path, [f"file is only {file_size} bytes"], suspicions
+            boxes, trailing = read_top_level(f, file_size)
+            types = [box_type for box_type, _, _ in boxes]
+            if types[0] != b'ftyp':
+                problems.append("file does not start with an ftyp box")
+            if types.count(b'moov') != 1:
+                problems.append(f"expected one moov box, found {types.count(b'moov')}")
+            mdats = [(payload, box_end) for box_type, payload, box_end in boxes if box_type == b'mdat']
+            if not mdats:
+                problems.append("no mdat box")
+            if problems:
+                return path, problems, suspicions
+            if trailing:
+                suspicions.append(f"{trailing} trailing bytes after the last box")
+
+            _, moov_start, moov_end = boxes[types.index(b'moov')]
+            f.seek(moov_start)
+            moov = f.read(moov_end - moov_start)
+        tables = {}
+        _sample_tables(moov, 0, len(moov), tables)
+    except (OSError, ValueError, struct.error) as e:
+        return path, problems + [str(e)], suspicions
+
+    try:
+        if not tables.get(b'stsz') or not (tables.get(b'stco') or tables.get(b'co64')):
+            return path, ["no sample tables"], suspicions
+        offsets = [offset for box_type in (b'stco', b'co64')
+                   for table in tables.get(box_type, []) for offset in _chunk_offsets(box_type, table)]
+        outside = [offset for offset in offsets
+                   if not any(start <= offset < end for start, end in mdats)]
+        if outside:
+            problems.append(f"{len(outside)} of {len(offsets)} chunks point outside mdat")
+        sample_bytes = sum(_sample_bytes(table) for table in tables[b'stsz'])
+        mdat_bytes = sum(end - start for start, end in mdats)
+        if sample_bytes > mdat_bytes:
+            problems.append(f"samples need {sample_bytes} bytes, mdat holds {mdat_bytes}")
+
+        duration = _movie_duration(tables[b'mvhd'][0]) if tables.get(b'mvhd') else 0.0
+        if duration <= 0:
+            suspicions.append("no duration in mvhd")
+        else:
+            bitrate = sample_bytes * 8 / duration
+            if not MIN_BITRATE <= bitrate <= MAX_BITRATE:
+                suspicions.append(f"implausible bitrate {bitrate / 1000:.0f} kbps")
+    except (ValueError, struct.error) as e:
+        problems.append(str(e))
+    return path, problems, suspicions
+
+def decode_test(path):
+    """Decode the audio with ffmpeg, failing on the first error. Returns an error message or None."""
+
+    with metrics.span('decode_test'):
+        result = subprocess.run([
+            get_ffmpeg_path(), '-v', 'error', '-xerror', '-i', str(path),
+            '-map', '0:a:0', '-f', 'null', '-'
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    errors = result.stderr.decode(errors='replace').strip()
+    if result.returncode != 0 or errors:
+        return errors.splitlines()[-1] if errors else f"ffmpeg exited with {result.returncode}"
+    return None
+
+def repair_file(path):
+    """
+    Remux a broken MP4 with ffmpeg into a temp file next to it, and replace
+    the original only if the result passes check_mp4. Tags mutagen can still
+    read (including the cover) are carried over. Returns True on success.
+    """
+    from mutagen.mp4 import MP4
+    import mp4Padding
+
+    path = str(path)
+    try:
+        tags = dict(MP4(path).tags or {})
+    except Exception:
+        tags = {}
+
+    temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix='.repair.m4a')
+    os.close(temp_fd)
+    try:
+        with metrics.span('container_repair'):
+            subprocess.run([
+                get_ffmpeg_path(), '-v', 'error', '-y',
+                '-err_detect', 'ignore_err', '-i', path,
+                '-map', '0:a:0', '-c:a', 'copy',  # Just copy the audio stream, no re-encoding
+                '-movflags', '+faststart',
+                '-f', 'mp4', temp_path
+            ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, problems, _ = check_mp4(temp_path)
+        if problems:
+            logger.error(f"Repaired copy of {path} is still broken: {'; '.join(problems)}")
+            return False
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except subprocess.CalledProcessError as e:
+        errors = e.stderr.decode(errors='replace').strip().splitlines()
+        logger.error(f"ffmpeg could not repair {path}: {errors[-1] if errors else e}")
+        return False
+    except Exception as e:
+        logger.error(f"Error repairing {path}: {e}")
+        return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    if tags:
+        try:
+            audio = MP4(path)
+            if audio.tags is None:
+                audio.add_tags()
+            audio.tags.update(tags)
+            mp4Padding.save_mp4(audio, reserve=True)
+            return True
+        except Exception as e:
+            logger.warning(f"Repaired {path} but could not restore its tags: {e}")
+    libraryIndex.update_file(path)
+    return True
+
+def list_mp4_files(directory):
+    """MP4 files under a directory, leaving out hidden temp files of running downloads"""
+    return sorted(str(path) for path in Path(directory).rglob('*')
+                  if path.suffix.lower() in MP4_EXTENSIONS and not path.name.startswith('.') and path.is_file())
+
+def check_library(directory, workers=DEFAULT_WORKERS, decode=False):
+    """
+    Check every MP4 file under a directory. Returns {path: [problems]} for
+    the broken files; with decode=True suspicious files are decode tested.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    files = list_mp4_files(directory)
+    logger.info(f"Checking {len(files)} file(s) with {workers} worker process(es)")
+    broken, suspicious = {}, []
+    with metrics.span('check_library', files=len(files)):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for path, problems, suspicions in executor.map(check_mp4, files, chunksize=16):
+                if problems:
+                    broken[path] = problems
+                    logger.warning(f"Broken:     {path}: {'; '.join(problems)}")
+                elif suspicions:
+                    suspicious.append(path)
+                    logger.info(f"Suspicious: {path}: {'; '.join(suspicions)}")
+
+    if decode and suspicious:
+        logger.info(f"Decode testing {len(suspicious)} suspicious file(s)")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, error in zip(suspicious, executor.map(decode_test, suspicious)):
+                if error:
+                    broken[path] = [f"decode failed: {error}"]
+                    logger.warning(f"Broken:     {path}: decode failed: {error}")
+    metrics.increment('files_checked', len(files))
+    metrics.increment('files_broken', len(broken))
+    logger.info(f"{len(files) - len(broken)} of {len(files)} file(s) are intact, "
+                f"{len(suspicious)} looked suspicious")
+    return broken
+
+def repair_library(paths, workers=REPAIR_WORKERS):
+    """Repair files with a bounded pool of ffmpeg processes. Returns the paths that could not be repaired."""
+    logger.info(f"Repairing {len(paths)} file(s) with {workers} ffmpeg worker(s)")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(repair_file, paths))
+    failed = [path for path, repaired in zip(paths, results) if not repaired]
+    logger.info(f"Repaired {len(paths) - len(failed)} of {len(paths)} file(s)")
+    for path in failed:
+        logger.error(f"Could not repair: {path}")
+    return failed
+
+def main():
+    """
+    Main function to parse arguments and start the library check
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description='Check the MP4 structure of every song and repair broken files')
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--directory', '-d',
+                        default=os.path.join(script_dir, 'downloads'),
+                        help='Directory containing music files (default: script_location/downloads)')
+    parser.add_argument('--decode', action='store_true',
+                        help='Decode test files whose structure is valid but suspicious')
+    parser.add_argument('--repair', action='store_true',
+                        help='Remux broken files with ffmpeg and replace them once the copy checks out')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS,
+                        help=f'Number of files checked in parallel (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--repair-workers', type=int, default=REPAIR_WORKERS,
+                        help=f'Number of ffmpeg repairs run in parallel (default: {REPAIR_WORKERS})')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        logger.error(f"Directory not found: {args.directory}")
+        return
+    broken = check_library(args.directory, args.workers, args.decode)
+    if broken and args.repair:
+        repair_library(sorted(broken), args.repair_workers)
+    metrics.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+libraryIndex.py - Persistent index of the music library
+
+Keeps one row per track (path, size, mtime, core tags, cover hash and source
+video ID) in SQLite. A refresh only re-reads files whose size or mtime
+changed, and every tag write made through mp4Padding.save_mp4 or the
+pipeline updates the row directly, so queries never need a rescan.
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import argparse
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_DB = os.path.join(SCRIPT_DIR, "cache", "library.db")
+INDEX_ENABLED = True      # Update the index whenever the tools write tags
+DEFAULT_WORKERS = os.cpu_count() or 4
+MUSIC_EXTENSIONS = {'.m4a', '.mp3', '.opus', '.ogg', '.flac', '.wma', '.wav'}
+
+# Where the pipeline stores the YouTube video ID a file was made from
+SOURCE_ID_KEY = '----:com.apple.iTunes:SOURCE_VIDEO_ID'  # MP4 freeform atom
+SOURCE_ID_DESC = 'SOURCE_VIDEO_ID'                        # ID3 TXXX description
+SOURCE_ID_COMMENT = 'source_video_id'                     # Vorbis comment
+
+TAG_FIELDS = ['title', 'artist', 'album', 'album_artist', 'year', 'track']
+QUERY_FIELDS = TAG_FIELDS + ['cover_hash', 'source_id']
+COLUMNS = ['path', 'size', 'mtime_ns', *TAG_FIELDS, 'duration', 'cover_hash', 'source_id', 'indexed_at']
+
+_local = threading.local()
+
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != INDEX_DB:
+        os.makedirs(os.path.dirname(INDEX_DB), exist_ok=True)
+        conn = sqlite3.connect(INDEX_DB, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                album_artist TEXT,
+                year TEXT,
+                track INTEGER,
+                duration REAL,
+                cover_hash TEXT,         -- sha1 of the first embedded cover
+                source_id TEXT,          -- YouTube video ID the file was made from
+                indexed_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS tracks_artist ON tracks (artist COLLATE NOCASE)")
+        conn.execute("CREATE INDEX IF NOT EXISTS tracks_album ON tracks (album COLLATE NOCASE)")
+        conn.execute("CREATE INDEX IF NOT EXISTS tracks_source_id ON tracks (source_id)")
+        conn.commit()
+        _local.conn, _local.path = conn, INDEX_DB
+    return conn
+
+def _first(values):
+    """First value of a tag list as text, or None"""
+    if not values:
+        return None
+    value = values[0] if isinstance(values, list) else values
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    value = str(value).strip()
+    return value or None
+
+def _track_number(value):
+    try:
+        return int(str(value).split('/')[0])
+    except (TypeError, ValueError):
+        return None
+
+def _cover_hash(data):
+    return hashlib.sha1(bytes(data)).hexdigest() if data else None
+
+def read_tags(audio):
+    """Extract the indexed fields from a mutagen file object"""
+    from mutagen.mp4 import MP4
+    from mutagen.id3 import ID3
+
+    fields = dict.fromkeys(TAG_FIELDS + ['cover_hash', 'source_id'])
+    tags = audio.tags
+    if isinstance(audio, MP4) and tags is not None:
+        fields['title'] = _first(tags.get('\xa9nam'))
+        fields['artist'] = _first(tags.get('\xa9ART'))
+        fields['album'] = _first(tags.get('\xa9alb'))
+        fields['album_artist'] = _first(tags.get('aART'))
+        fields['year'] = _first(tags.get('\xa9day'))
+        trkn = tags.get('trkn')
+        fields['track'] = trkn[0][0] if trkn else None
+        covers = tags.get('covr')
+        fields['cover_hash'] = _cover_hash(covers[0]) if covers else None
+        fields['source_id'] = _first(tags.get(SOURCE_ID_KEY))
+    elif isinstance(tags, ID3):
+        def text(frame_id):
+            frame = tags.get(frame_id)
+            return _first(frame.text) if frame else None
+        fields['title'] = text('TIT2')
+        fields['artist'] = text('TPE1')
+        fields['album'] = text('TALB')
+        fields['album_artist'] = text('TPE2')
+        fields['year'] = text('TDRC')
+        fields['track'] = _track_number(text('TRCK'))
+        pictures = tags.getall('APIC')
+        fields['cover_hash'] = _cover_hash(pictures[0].data) if pictures else None
+        fields['source_id'] = text(f'TXXX:{SOURCE_ID_DESC}')
+    elif tags is not None and hasattr(tags, 'get'):
+        # Vorbis comments (Opus, Ogg, FLAC)
+        fields['title'] = _first(tags.get('title'))
+        fields['artist'] = _first(tags.get('artist'))
+        fields['album'] = _first(tags.get('album'))
+        fields['album_artist'] = _first(tags.get('albumartist'))
+        fields['year'] = _first(tags.get('date'))
+        fields['track'] = _track_number(_first(tags.get('tracknumber')))
+        pictures = getattr(audio, 'pictures', None)
+        if not pictures and tags.get('metadata_block_picture'):
+            import base64
+            from mutagen.flac import Picture
+            pictures = [Picture(base64.b64decode(tags['metadata_block_picture'][0]))]
+        fields['cover_hash'] = _cover_hash(pictures[0].data) if pictures else None
+        fields['source_id'] = _first(tags.get(SOURCE_ID_COMMENT))
+    return fields
+
+def _store(path, stat, fields, duration):
+    conn = _connect()
+    conn.execute(f"INSERT OR REPLACE INTO tracks ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                 (path, stat.st_size, stat.st_mtime_ns, *(fields[name] for name in TAG_FIELDS),
+                  duration, fields['cover_hash'], fields['source_id'], time.time()))
+    conn.commit()
+
+def index_file(path):
+    """Read a file's tags and store them. Returns False if the file has no readable tags."""
+    from mutagen import File
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    audio = File(path)
+    if audio is None:
+        return False
+    _store(path, stat, read_tags(audio), getattr(audio.info, 'length', None))
+    return True
+
+def update_from_audio(audio):
+    """Refresh a row from a mutagen object that was just saved, without reading the file again"""
+    if not INDEX_ENABLED:
+        return
+    try:
+        path = os.path.abspath(audio.filename)
+        _store(path, os.stat(path), read_tags(audio), getattr(audio.info, 'length', None))
+    except Exception as e:
+        logger.warning(f"Could not update library index for {audio.filename}: {e}")
+
+def update_file(path):
+    """Refresh the row of a file the pipeline just wrote"""
+    if not INDEX_ENABLED:
+        return
+    try:
+        index_file(path)
+    except Exception as e:
+        logger.warning(f"Could not update library index for {path}: {e}")
+
+def remove_file(path):
+    """Forget a file that was deleted"""
+    if not INDEX_ENABLED:
+        return
+    conn = _connect()
+    conn.execute("DELETE FROM tracks WHERE path = ?", (os.path.abspath(path),))
+    conn.commit()
+
+def list_music_files(directory, recursive=True):
+    pattern = '**/*' if recursive else '*'
+    return [path for path in Path(directory).glob(pattern)
+            if path.is_file() and path.suffix.lower() in MUSIC_EXTENSIONS]
+
+def refresh(directory, recursive=True, workers=DEFAULT_WORKERS):
+    """
+    Bring the index up to date for a directory by comparing size and mtime.
+    Only new or changed files are read; rows of deleted files are dropped.
+    Returns counts of added, updated, removed and unchanged files.
+    """
+    directory = os.path.abspath(directory)
+    prefix = directory + os.sep
+    known = {path: (size, mtime_ns) for path, size, mtime_ns in _connect().execute(
+        "SELECT path, size, mtime_ns FROM tracks WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))}
+
+    seen, changed = set(), []
+    for file_path in list_music_files(directory, recursive):
+        path = os.path.abspath(file_path)
+        seen.add(path)
+        stat = file_path.stat()
+        if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+            changed.append(path)
+
+    def read(path):
+        try:
+            return index_file(path)
+        except Exception as e:
+            logger.warning(f"Could not index {path}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(read, changed))
+
+    if not recursive:
+        # Files in subdirectories were not scanned, so they are not stale
+        known = {path: value for path, value in known.items() if os.path.dirname(path) == directory}
+    stale = [path for path in known if path not in seen]
+    conn = _connect()
+    conn.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in stale])
+    conn.commit()
+
+    counts = {
+        'added': sum(1 for path in changed if path not in known),
+        'updated': sum(1 for path in changed if path in known),
+        'removed': len(stale),
+        'unchanged': len(seen) - len(changed),
+    }
+    logger.info(f"Library index: {counts['added']} added, {counts['updated']} updated, "
+                f"{counts['removed']} removed, {counts['unchanged']} unchanged")
+    return counts
+
+def query_tracks(directory=None, missing=None, artist=None, album=None, source_id=None, recursive=True):
+    """
+    Return matching tracks as dicts. missing is a field name (album, artist,
+    cover_hash, ...) that must be empty; artist and album match case-insensitively.
+    """
+    sql, params = f"SELECT {', '.join(COLUMNS)} FROM tracks WHERE 1 = 1", []
+    if directory:
+        # Exact prefix comparisons: LIKE would treat _ and % in directory
+        # names as wildcards and ignore case
+        prefix = os.path.abspath(directory) + os.sep
+        sql += " AND substr(path, 1, ?) = ?"
+        params += [len(prefix), prefix]
+        if not recursive:
+            sql += " AND instr(substr(path, ?), ?) = 0"
+            params += [len(prefix) + 1, os.sep]
+    if missing:
+        if missing not in QUERY_FIELDS:
+            raise ValueError(f"Unknown field '{missing}', choose from {', '.join(QUERY_FIELDS)}")
+        sql += f" AND ({missing} IS NULL OR {missing} = '')"
+    if artist:
+        sql += " AND (artist = ? COLLATE NOCASE OR album_artist = ? COLLATE NOCASE)"
+        params += [artist, artist]
+    if album:
+        sql += " AND album = ? COLLATE NOCASE"
+        params.append(album)
+    if source_id:
+        sql += " AND source_id = ?"
+        params.append(source_id)
+    rows = _connect().execute(sql + " ORDER BY artist, album, track, path", params).fetchall()
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+def summary():
+    """Track count and how many tracks lack each core field"""
+    conn = _connect()
+    counts = {'tracks': conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]}
+    for name in ('title', 'artist', 'album', 'cover_hash', 'source_id'):
+        counts[f'missing_{name}'] = conn.execute(
+            f"SELECT COUNT(*) FROM tracks WHERE {name} IS NULL OR {name} = ''").fetchone()[0]
+    return counts
+
+def main():
+    """
+    Main function to parse arguments and query the library index
+    """
+    parser = argparse.ArgumentParser(description='Query the persistent music library index')
+    parser.add_argument('--directory', '-d',
+                        default=os.path.join(SCRIPT_DIR, 'downloads'),
+                        help='Directory containing music files (default: script_location/downloads)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Re-read new and changed files before querying')
+    parser.add_argument('--missing', choices=QUERY_FIELDS,
+                        help='List tracks where this field is empty')
+    parser.add_argument('--artist', help='List tracks by this artist')
+    parser.add_argument('--album', help='List tracks on this album')
+    parser.add_argument('--source-id', help='List tracks made from this YouTube video ID')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS,
+                        help=f'Number of files read in parallel during a refresh (default: {DEFAULT_WORKERS})')
+    args = parser.parse_args()
+
+    if args.refresh:
+        if not os.path.isdir(args.directory):
+            logger.error(f"Directory not found: {args.directory}")
+            return
+        refresh(args.directory, workers=args.workers)
+
+    if not (args.missing or args.artist or args.album or args.source_id):
+        counts = summary()
+        print(f"{counts.pop('tracks')} tracks indexed")
+        for name, count in counts.items():
+            print(f"  {name.replace('_', ' ')}: {count}")
+        return
+
+    started = time.perf_counter()
+    tracks = query_tracks(args.directory, args.missing, args.artist, args.album, args.source_id)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    for track in tracks:
+        print(f"{track['artist'] or '?'} - {track['title'] or '?'} [{track['album'] or 'no album'}]  {track['path']}")
+    print(f"{len(tracks)} track(s) in {elapsed_ms:.1f} ms")
+
+if __name__ == "__main__":
+    main()
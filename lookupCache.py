@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+lookupCache.py - Persistent cache of provider lookups, including known misses
+"""
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import metrics
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DB = os.path.join(SCRIPT_DIR, "cache", "lookups.db")
+POSITIVE_TTL = 30 * 24 * 3600  # Seconds a found result is reused
+NEGATIVE_TTL = 3 * 24 * 3600   # Seconds a "no result" answer is trusted
+
+_local = threading.local()
+
+def _connect():
+    """One connection per thread, since lookups run from worker threads"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != CACHE_DB:
+        os.makedirs(os.path.dirname(CACHE_DB), exist_ok=True)
+        conn = sqlite3.connect(CACHE_DB, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS lookups (
+                provider TEXT NOT NULL,
+                query_key TEXT NOT NULL,
+                query_text TEXT NOT NULL,
+                result TEXT,             -- JSON, NULL for a known miss
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (provider, query_key)
+            )
+        """)
+        conn.commit()
+        _local.conn, _local.path = conn, CACHE_DB
+    return conn
+
+def _normalize(text):
+    words = "".join(ch.lower() if ch.isalnum() else " " for ch in str(text or "")).split()
+    return " ".join(words)
+
+def normalize_query(*parts):
+    """
+    Build a cache key that ignores case, punctuation and spacing differences.
+    Every part keeps its own slot, empty or not, so artist "A" with title
+    "B C" never shares a key with artist "A B" and title "C", or with no
+    artist and title "A B C".
+    """
+    return "\x1f".join(_normalize(part) for part in parts)
+
+def get(provider, *query):
+    """
+    Return (hit, result) for a lookup. result is None for a cached miss.
+    Expired entries count as a miss of the cache itself: (False, None).
+    """
+    key = normalize_query(*query)
+    row = _connect().execute(
+        "SELECT result, expires_at FROM lookups WHERE provider = ? AND query_key = ?",
+        (provider, key)
+    ).fetchone()
+    if row is None or row[1] < time.time():
+        metrics.increment('cache_misses', cache='lookup', provider=provider)
+        return False, None
+    metrics.increment('cache_hits', cache='lookup', provider=provider,
+                      kind='negative' if row[0] is None else 'positive')
+    return True, (json.loads(row[0]) if row[0] is not None else None)
+
+def put(provider, result, *query):
+    """
+    Store a definitive lookup answer. Pass result=None (or an empty list) to
+    record that the provider has nothing for this query. Never store errors.
+    """
+    now = time.time()
+    negative = not result
+    conn = _connect()
+    conn.execute(
+        "INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?, ?)",
+        (provider, normalize_query(*query), " | ".join(str(part) for part in query if part),
+         None if negative else json.dumps(result), now, now + (NEGATIVE_TTL if negative else POSITIVE_TTL))
+    )
+    conn.commit()
+
+def list_misses(include_expired=False):
+    """Return (provider, query text, created_at) for every cached miss"""
+    sql = "SELECT provider, query_text, created_at FROM lookups WHERE result IS NULL"
+    params = ()
+    if not include_expired:
+        sql += " AND expires_at >= ?"
+        params = (time.time(),)
+    return _connect().execute(sql + " ORDER BY query_text", params).fetchall()
+
+def purge(expired_only=True, misses_only=False):
+    """Delete cache entries and return how many were removed"""
+    sql, params = "DELETE FROM lookups WHERE 1 = 1", []
+    if expired_only:
+        sql += " AND expires_at < ?"
+        params.append(time.time())
+    if misses_only:
+        sql += " AND result IS NULL"
+    conn = _connect()
+    count = conn.execute(sql, params).rowcount
+    conn.commit()
+    return count
+
+def main():
+    """
+    Main function to list or clean cached lookups
+    """
+    parser = argparse.ArgumentParser(description='Inspect the provider lookup cache')
+    parser.add_argument('--misses', action='store_true',
+                        help='List queries no provider could match (candidates for manual tagging)')
+    parser.add_argument('--purge-expired', action='store_true',
+                        help='Delete expired entries')
+    parser.add_argument('--clear-misses', action='store_true',
+                        help='Forget all cached misses so they are looked up again')
+    args = parser.parse_args()
+
+    if args.purge_expired:
+        print(f"Removed {purge()} expired entries")
+    if args.clear_misses:
+        print(f"Removed {purge(expired_only=False, misses_only=True)} cached misses")
+    if args.misses or not (args.purge_expired or args.clear_misses):
+        misses = list_misses()
+        print(f"{len(misses)} cached misses:")
+        for provider, query_text, created_at in misses:
+            print(f"  [{provider}] {query_text} ({time.strftime('%Y-%m-%d', time.localtime(created_at))})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+loudness.py - EBU R128 loudness measurement and ReplayGain / iTunNORM tags
+
+The pipeline adds LOUDNESS_FILTER to the ffmpeg transcode it already runs and
+parses the summary from stderr, so no extra decode is needed. The backfill
+mode measures files already in the library in parallel.
+"""
+
+import os
+import re
+import argparse
+import logging
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import mp4Padding
+from ffmpegPath import get_ffmpeg_path
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Analysis only: the audio passes through unchanged. Per-frame logging is
+# pushed to verbose so stderr only carries the summary.
+LOUDNESS_FILTER = "ebur128=peak=true:framelog=verbose"
+REFERENCE_LOUDNESS = -18.0  # LUFS, the ReplayGain 2.0 reference level
+R128_REFERENCE_LOUDNESS = -23.0  # LUFS, the reference for Opus R128 gain tags
+DEFAULT_WORKERS = os.cpu_count() or 4
+
+FREEFORM_PREFIX = '----:com.apple.iTunes:'
+TRACK_GAIN_KEY = FREEFORM_PREFIX + 'replaygain_track_gain'
+TRACK_PEAK_KEY = FREEFORM_PREFIX + 'replaygain_track_peak'
+ITUNNORM_KEY = FREEFORM_PREFIX + 'iTunNORM'
+
+_SUMMARY_PATTERNS = {
+    'integrated': re.compile(r'^\s*I:\s*(-?[\d.]+|-inf)\s*LUFS', re.MULTILINE),
+    'range': re.compile(r'^\s*LRA:\s*(-?[\d.]+)\s*LU\b', re.MULTILINE),
+    'true_peak': re.compile(r'^\s*Peak:\s*(-?[\d.]+|-inf)\s*dBFS', re.MULTILINE),
+}
+
+def parse_ebur128_summary(stderr_text):
+    """
+    Extract integrated loudness (LUFS), loudness range (LU) and true peak
+    (dBFS) from ffmpeg's ebur128 summary. Returns None if no summary was found.
+    """
+    if isinstance(stderr_text, bytes):
+        stderr_text = stderr_text.decode('utf-8', errors='replace')
+    summary_at = stderr_text.rfind('Summary:')
+    if summary_at < 0:
+        return None
+    summary = stderr_text[summary_at:]
+    values = {}
+    for name, pattern in _SUMMARY_PATTERNS.items():
+        match = pattern.search(summary)
+        if match:
+            values[name] = float(match.group(1))
+    if 'integrated' not in values or values['integrated'] == float('-inf'):
+        return None  # Silence has no meaningful loudness
+    return values
+
+def measure_loudness(path):
+    """Decode a file once with ffmpeg and return its loudness values"""
+    with metrics.span('loudness_scan'):
+        result = subprocess.run([
+            get_ffmpeg_path(), '-hide_banner', '-nostats', '-i', str(path),
+            '-vn', '-af', LOUDNESS_FILTER, '-f', 'null', '-'
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return parse_ebur128_summary(result.stderr)
+
+def itunnorm(gain_db, peak_linear):
+    """Build an iTunNORM string (Sound Check) from a ReplayGain track gain and peak"""
+    def scaled(base):
+        return min(max(round(base * 10 ** (-gain_db / 10)), 1), 0xFFFFFFFF)
+    peak = min(round(peak_linear * 32768), 0xFFFFFFFF)
+    values = [scaled(1000), scaled(1000), scaled(2500), scaled(2500), 0, 0, peak, peak, 0, 0]
+    return ''.join(f' {value:08X}' for value in values)
+
+def replaygain(values):
+    """Return (track gain in dB, linear track peak) for measured loudness values"""
+    gain = REFERENCE_LOUDNESS - values['integrated']
+    peak_db = values.get('true_peak', 0.0)
+    peak = 10 ** (peak_db / 20) if peak_db != float('-inf') else 0.0
+    return gain, peak
+
+def r128_track_gain(values):
+    """R128_TRACK_GAIN for Opus files: Q7.8 gain towards -23 LUFS (RFC 7845)"""
+    gain = round((R128_REFERENCE_LOUDNESS - values['integrated']) * 256)
+    return max(-32768, min(32767, gain))
+
+def apply_loudness_tags(audio, values):
+    """Set ReplayGain and iTunNORM freeform atoms on an MP4 (mutagen) object"""
+    from mutagen.mp4 import MP4FreeForm
+
+    gain, peak = replaygain(values)
+    audio[TRACK_GAIN_KEY] = [MP4FreeForm(f"{gain:+.2f} dB".encode('utf-8'))]
+    audio[TRACK_PEAK_KEY] = [MP4FreeForm(f"{peak:.6f}".encode('utf-8'))]
+    audio[ITUNNORM_KEY] = [MP4FreeForm(itunnorm(gain, peak).encode('utf-8'))]
+
+def backfill_file(path, force=False):
+    """Measure and tag one file. Returns True if tags were written."""
+    from mutagen.mp4 import MP4
+
+    try:
+        audio = MP4(path)
+        if not force and TRACK_GAIN_KEY in audio:
+            return False
+        values = measure_loudness(path)
+        if not values:
+            logger.warning(f"No loudness measured for {path}")
+            return False
+        # Re-open in case the file changed while ffmpeg was decoding it
+        audio = MP4(path)
+        apply_loudness_tags(audio, values)
+        mp4Padding.save_mp4(audio)
+        logger.info(f"{Path(path).name}: {values['integrated']:.1f} LUFS, "
+                    f"peak {values.get('true_peak', 0.0):.1f} dBFS")
+        return True
+    except Exception as e:
+        logger.error(f"Error measuring loudness for {path}: {e}")
+        return False
+
+def backfill_library(directory, force=False, workers=DEFAULT_WORKERS):
+    """Add loudness tags to every .m4a file under a directory in parallel"""
+    files = [path for path in Path(directory).rglob('*.m4a') if path.is_file()]
+    logger.info(f"Measuring loudness for {len(files)} file(s) with {workers} worker(s)")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        updated = sum(executor.map(lambda path: backfill_file(path, force), files))
+    logger.info(f"Loudness tags written for {updated} file(s)")
+    mp4Padding.report_rewrites()
+    metrics.flush()
+    return updated
+
+def main():
+    """
+    Main function to parse arguments and start the backfill
+    """
+    parser = argparse.ArgumentParser(description='Add ReplayGain / iTunNORM loudness tags to M4A files')
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--directory', '-d',
+                        default=os.path.join(script_dir, 'downloads'),
+                        help='Directory containing music files (default: script_location/downloads)')
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='Re-measure files that already have loudness tags')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS,
+                        help=f'Number of files measured in parallel (default: {DEFAULT_WORKERS})')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        logger.error(f"Directory not found: {args.directory}")
+        return
+    backfill_library(args.directory, args.force, args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,10 @@ m4a_inspector.py - Inspect all metadata tags in M4A files
 """
 
 import os
-import sys
+import argparse
 import logging
 from pathlib import Path
-from mutagen.mp4 import MP4
+import profiler
 
 # Configure logging
 logging.basicConfig(
@@ -20,6 +20,8 @@ def inspect_m4a_file(file_path):
     """
     Display all metadata tags in an M4A file
     """
+    from mutagen.mp4 import MP4
+    
     try:
         # Load the M4A file
         audio = MP4(file_path)
@@ -107,9 +109,16 @@ def main():
     """
     Main function to parse arguments and start the inspection
     """
-    if len(sys.argv) > 1:
+    parser = argparse.ArgumentParser(description='Inspect all metadata tags in M4A files')
+    parser.add_argument('path', nargs='?',
+                        help='M4A file or directory to inspect (default: script_location/downloads)')
+    profiler.add_arguments(parser)
+    args = parser.parse_args()
+    profiler.enable_from_args(args, 'm4aInspect')
+    
+    if args.path:
         # If path is provided as argument
-        path = sys.argv[1]
+        path = args.path
     else:
         # Default to script directory
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -124,7 +133,8 @@ def main():
     
     # Process single file or directory
     if path.is_file() and path.suffix.lower() == '.m4a':
-        inspect_m4a_file(path)
+        with profiler.stage('inspect_m4a_file'):
+            inspect_m4a_file(path)
     elif path.is_dir():
         # Collect all M4A files
         m4a_files = list(path.glob('**/*.m4a'))
@@ -137,7 +147,8 @@ def main():
         
         # Process each file
         for file_path in m4a_files:
-            inspect_m4a_file(file_path)
+            with profiler.stage('inspect_m4a_file'):
+                inspect_m4a_file(file_path)
     else:
         print("Please provide either an M4A file or a directory containing M4A files.")
 
@@ -1,36 +1,311 @@
 import os
-import yt_dlp
-import requests
-from mutagen.mp4 import MP4, MP4Cover
+import sys
+import glob
+import json
+import argparse
 from urllib.parse import unquote
 import time
+import queue
+import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import profiler
+import mp4Padding
+import circuitBreaker
+import lookupCache
+import loudness
+import libraryIndex
+import libraryCheck
+import videoInfoCache
+import catalogMirror
+from matching import MATCH_THRESHOLD, clean_title_for_search, score_candidate
+from ffmpegPath import FFMPEG_DIRECTORY, get_ffmpeg_path
+import downloadScheduler
 
 DOWNLOAD_DIR = "downloads"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-FFMPEG_DIRECTORY = r"ffmpeg\ffmpeg-2025-02-20-git-bc1a3bfd2c-full_build\bin"
+DEEZER_SEARCH_URL = "https://api.deezer.com/search"
+ITUNES_SEARCH_URL = "https://itunes.apple.com/search"
+CANDIDATE_LIMIT = 10      # Candidates requested from each provider per query
+STREAM_DOWNLOADS = True   # Pipe audio from yt-dlp straight into ffmpeg instead of via a source file
+# Streamable containers first, since ffmpeg cannot seek back in a pipe to find a trailing moov atom
+STREAM_FORMAT = 'bestaudio[ext=webm]/bestaudio[ext=m4a]/bestaudio'
+DOWNLOAD_WORKERS = 2      # Songs processed in parallel when downloading a playlist
+QUEUE_SIZE = 16           # Discovered playlist entries buffered ahead of the workers
+LOOKUP_BUDGET = 10        # Seconds allowed for all metadata lookups of one song
+PROVIDER_TIMEOUT = 5      # Seconds allowed for a single provider request
+LOOKUP_RELEASES = True    # Add album, release date, track/disc number and MBIDs from MusicBrainz
+VERIFY_TOLERANCE = 3      # Seconds an output's duration may differ from the source before it is rejected
+ORPHAN_AGE = 3600         # Seconds after which an untouched temp file in DOWNLOAD_DIR is an orphan
+PART_MAX_AGE = 7 * 24 * 3600  # Seconds a resumable .part file is kept
+LOOKUP_WORKERS = 4        # Metadata lookups running alongside downloads
+CHECK_DUPLICATES = True   # Skip tagging downloads that match a song already in the library
+DELETE_DUPLICATES = False # Also delete those downloads instead of keeping them untagged
+MEASURE_LOUDNESS = True   # Measure EBU R128 loudness during the transcode and tag ReplayGain/iTunNORM
+# Encoder settings per output format. Every requested preset is encoded from a
+# single decode of the source, in one ffmpeg process.
+OUTPUT_PRESETS = {
+    'aac': {'extension': 'm4a', 'container': 'mp4', 'codec': 'aac', 'bitrate': '256k',
+            'options': ["-movflags", "+faststart"]},
+    'opus': {'extension': 'opus', 'container': 'ogg', 'codec': 'libopus', 'bitrate': '160k',
+             'options': []},
+    'mp3': {'extension': 'mp3', 'container': 'mp3', 'codec': 'libmp3lame', 'bitrate': '320k',
+            'options': ["-id3v2_version", "3"]},
+}
+OUTPUT_FORMATS = ['aac']  # Presets produced for every song; the first one is the primary file
+
+# Loudness measured by the transcode, keyed by output path until the tags are written
+measured_loudness = {}
+measured_loudness_lock = threading.Lock()
+
+def record_loudness(output_path, ffmpeg_stderr):
+    """Keep the loudness summary from a transcode's stderr for embed_metadata"""
+    if not MEASURE_LOUDNESS:
+        return
+    values = loudness.parse_ebur128_summary(ffmpeg_stderr)
+    if values:
+        with measured_loudness_lock:
+            measured_loudness[os.path.abspath(output_path)] = values
+
+def take_loudness(song_path):
+    with measured_loudness_lock:
+        return measured_loudness.pop(os.path.abspath(song_path), None)
+
+def loudness_args():
+    """ffmpeg filter arguments that measure loudness in the same pass"""
+    return ["-af", loudness.LOUDNESS_FILTER] if MEASURE_LOUDNESS else []
+
+def get_output_presets(formats=None):
+    """Return [(name, preset)] for the requested formats, defaulting to OUTPUT_FORMATS"""
+    names = []
+    for name in formats or OUTPUT_FORMATS:
+        name = name.strip().lower()
+        if name not in OUTPUT_PRESETS:
+            raise ValueError(f"Unknown output format '{name}', choose from {', '.join(OUTPUT_PRESETS)}")
+        if name not in names:
+            names.append(name)
+    return [(name, OUTPUT_PRESETS[name]) for name in names]
+
+def encode_args(presets, output_paths):
+    """
+    ffmpeg output arguments for several encodes of the same input. ffmpeg
+    decodes the input once and feeds every output from it. Loudness is
+    measured on the first output only, since all of them share the source.
+    """
+    args = []
+    for index, ((name, preset), output_path) in enumerate(zip(presets, output_paths)):
+        args += ["-map", "0:a:0"]  # Audio only, drop any embedded thumbnail stream
+        if index == 0:
+            args += loudness_args()
+        args += [
+            "-c:a", preset['codec'],
+            "-b:a", preset['bitrate'],
+            *preset['options'],
+            "-f", preset['container'],
+            output_path
+        ]
+    return args
+
+def make_temp_path(extension, kind):
+    """
+    Hidden temp file in DOWNLOAD_DIR for an output that is not verified yet.
+    Names look like .abc123.transcode.m4a so sweep_orphans can find them.
+    """
+    temp_fd, temp_path = tempfile.mkstemp(dir=DOWNLOAD_DIR, prefix='.', suffix=f".{kind}.{extension}")
+    os.close(temp_fd)
+    return temp_path
+
+def verify_output(path, expected_duration=None):
+    """
+    Check that a freshly written file parses as audio and, if the source
+    duration is known, that its length is within VERIFY_TOLERANCE of it.
+    Raises ValueError when the file must not enter the library.
+    """
+    from mutagen import File
+    
+    with metrics.span('verify'):
+        audio = File(path)
+    if audio is None or not getattr(audio.info, 'length', 0):
+        raise ValueError(f"{os.path.basename(path)} is not a readable audio file")
+    if expected_duration and abs(audio.info.length - expected_duration) > VERIFY_TOLERANCE:
+        raise ValueError(f"{os.path.basename(path)} is {audio.info.length:.1f}s long, "
+                         f"expected {expected_duration:.1f}s")
+
+def finalize_outputs(temp_paths, output_paths, expected_duration=None):
+    """Verify every temp output, then move them all into place"""
+    for temp_path in temp_paths:
+        verify_output(temp_path, expected_duration)
+    for temp_path, output_path in zip(temp_paths, output_paths):
+        os.replace(temp_path, output_path)
+
+def sweep_orphans(directory=None):
+    """
+    Remove temp outputs left behind by interrupted runs, and .part files too
+    old to be worth resuming. Recent files may belong to another worker and
+    are left alone. Returns the number of files removed.
+    """
+    directory = directory or DOWNLOAD_DIR
+    now = time.time()
+    patterns = [(".*.stream.*", ORPHAN_AGE), (".*.transcode.*", ORPHAN_AGE), (".*.repair.*", ORPHAN_AGE),
+                ("*.temp.m4a", ORPHAN_AGE), ("*.part", PART_MAX_AGE), ("*.ytdl", PART_MAX_AGE)]
+    removed = 0
+    for pattern, max_age in patterns:
+        for path in glob.glob(os.path.join(glob.escape(directory), pattern)):
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    if removed:
+        print(f"Removed {removed} leftover temp file(s) from {directory}")
+    return removed
 
 def get_video_info(url):
-    """Get video title and other info before downloading"""
+    """
+    Get video title and other info before downloading. Answered from the
+    video info cache when the URL names a video seen within INFO_TTL.
+    """
+    cached = videoInfoCache.get(videoInfoCache.video_id_from_url(url))
+    if cached:
+        return cached
+    
+    import yt_dlp
+    
     ydl_opts = {
         'quiet': True,
         'no_warnings': True,
         'extract_flat': True,
+        'format': f"{STREAM_FORMAT}/best",  # Record the audio format a download would pick
     }
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         try:
-            info = ydl.extract_info(url, download=False)
-            return {
-                'title': info.get('title', ''),
-                'artist': info.get('artist', ''),
-                'track': info.get('track', '')
-            }
+            with metrics.span('extract_info'):
+                info = ydl.extract_info(url, download=False)
+            video_info = videoInfoCache.trim_info(info)
+            videoInfoCache.put(video_info)
+            return video_info
         except Exception as e:
             print(f"Error getting video info: {e}")
             return None
 
-def download_song(url):
-    """Download song from YouTube using yt-dlp in high quality AAC format"""
+def read_lines(stream, lines, handle_line=None):
+    """
+    Read a subprocess pipe to the end, so the process never blocks on a full
+    pipe. Lines handle_line accepts (returns True for) are not kept.
+    """
+    for line in stream:
+        if handle_line is None or not handle_line(line):
+            lines.append(line)
+
+def stream_song(url, formats=None):
+    """
+    Download and transcode in one pass: yt-dlp writes the audio to a pipe
+    that ffmpeg reads from, and ffmpeg writes every requested format to temp
+    files that are renamed into place only once it completes.
+    Returns (title, [filenames]) or (None, None).
+    """
+    presets = get_output_presets(formats)
+    import yt_dlp
+    
+    ydl_opts = {
+        'format': STREAM_FORMAT,
+        'outtmpl': f'{DOWNLOAD_DIR}/%(title)s.%(ext)s',
+        'quiet': True,
+        'no_warnings': True,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with metrics.span('extract_info'):
+            info = ydl.extract_info(url, download=False)
+        title = info.get('title', '')
+        base_name = os.path.splitext(os.path.basename(ydl.prepare_filename(info)))[0]
+        info_json = json.dumps(ydl.sanitize_info(info))
+    
+    # A pipe cannot resume, so let the file-based download continue a partial source
+    if glob.glob(os.path.join(glob.escape(DOWNLOAD_DIR), glob.escape(base_name) + ".*.part")):
+        raise RuntimeError(f"a partial download of {title} exists, resuming it")
+    
+    output_files = [f"{base_name}.{preset['extension']}" for _, preset in presets]
+    output_paths = [os.path.join(DOWNLOAD_DIR, output_file) for output_file in output_files]
+    
+    # Hand the resolved info to the yt-dlp subprocess so it does not extract again
+    info_fd, info_path = tempfile.mkstemp(suffix='.info.json')
+    with os.fdopen(info_fd, 'w', encoding='utf-8') as f:
+        f.write(info_json)
+    temp_paths = [make_temp_path(preset['extension'], 'stream') for _, preset in presets]
+    
+    ytdlp_cmd = [
+        sys.executable, "-m", "yt_dlp",
+        "--quiet", "--no-warnings",  # Only errors and the progress lines on stderr
+        "--load-info-json", info_path,
+        "-f", STREAM_FORMAT,
+        "-o", "-",  # Write the media to stdout
+    ]
+    ffmpeg_cmd = [
+        get_ffmpeg_path(),
+        "-y",
+        "-i", "pipe:0",
+        *encode_args(presets, temp_paths)
+    ]
+    
+    print(f"Streaming {title} to {', '.join(output_paths)}...")
+    try:
+        # The subprocess keeps the rate limit share it gets at its start
+        with downloadScheduler.get_scheduler().slot(url, fixed=True) as job, \
+                metrics.span('download', mode='stream', outputs=len(presets)):
+            downloader = subprocess.Popen(ytdlp_cmd + job.cli_options(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            # ffmpeg's stderr is only read once it exits, so drain yt-dlp's
+            # meanwhile, passing its progress lines to the scheduler
+            downloader_errors = []
+            stderr_reader = threading.Thread(target=read_lines, daemon=True,
+                                             args=(downloader.stderr, downloader_errors, job.progress_line))
+            stderr_reader.start()
+            encoder = subprocess.Popen(ffmpeg_cmd, stdin=downloader.stdout,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            # Let yt-dlp receive SIGPIPE if ffmpeg exits early
+            downloader.stdout.close()
+            _, encoder_errors = encoder.communicate()
+            downloader.wait()
+            stderr_reader.join()
+            downloader.stderr.close()
+        
+        if downloader.returncode != 0:
+            raise RuntimeError(f"yt-dlp exited with {downloader.returncode}: "
+                               f"{b''.join(downloader_errors[-20:]).decode(errors='replace').strip()}")
+        if encoder.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with {encoder.returncode}: "
+                               f"{encoder_errors.decode(errors='replace').strip()[-500:]}")
+        
+        finalize_outputs(temp_paths, output_paths, info.get('duration'))
+        record_loudness(output_paths[0], encoder_errors)
+        size = info.get('filesize') or info.get('filesize_approx')
+        if size:
+            metrics.increment('bytes_downloaded', size, kind='audio')
+        print(f"Successfully converted to: {', '.join(output_files)}")
+        return title, output_files
+    finally:
+        for path in (*temp_paths, info_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def download_song(url, formats=None):
+    """
+    Download song from YouTube using yt-dlp and encode it to every requested
+    output format (high quality AAC by default). Returns (title, [filenames])
+    with the primary format first, or (None, None).
+    """
+    import yt_dlp
+    
+    presets = get_output_presets(formats)
+    if STREAM_DOWNLOADS:
+        try:
+            return stream_song(url, formats)
+        except Exception as e:
+            print(f"Streaming download failed, falling back to file download: {e}")
+            metrics.increment('retries', stage='download')
+    
     # Get a list of files before download to compare later
     files_before = set(os.listdir(DOWNLOAD_DIR))
     
@@ -41,117 +316,104 @@ def download_song(url):
         'outtmpl': f'{DOWNLOAD_DIR}/%(title)s.%(ext)s',
         'ffmpeg_location': FFMPEG_DIRECTORY,
         'keepvideo': False,
+        # Keep interrupted downloads as .part files and continue them next time
+        'continuedl': True,
+        'nopart': False,
         'quiet': False,  # Show download progress
     }
     
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        with downloadScheduler.get_scheduler().slot(url) as job, \
+                yt_dlp.YoutubeDL({**ydl_opts, **job.ydl_options()}) as ydl:
+            job.attach(ydl)
+            with metrics.span('download'):
+                info = ydl.extract_info(url, download=True)
             title = info.get('title', '')
             
-            # Wait for file operations to complete
-            time.sleep(1)
-            
-            # Find the new file by comparing directory contents
-            files_after = set(os.listdir(DOWNLOAD_DIR))
-            new_files = files_after - files_before
-            
-            if not new_files:
-                print("No new files found after download")
-                return None, None
-            
-            # Get the downloaded file (likely not an .m4a yet)
-            downloaded_file = None
-            for file in new_files:
-                downloaded_file = file
-                break
-            
-            if not downloaded_file:
-                print("Could not find downloaded file")
-                return None, None
+            # yt-dlp reports where it wrote the file, which stays correct
+            # when several downloads share the directory
+            requested = info.get('requested_downloads') or [{}]
+            filepath = requested[0].get('filepath')
+            if filepath and os.path.exists(filepath):
+                downloaded_file = os.path.basename(filepath)
+            else:
+                # Wait for file operations to complete
+                time.sleep(1)
+                
+                # Find the new file by comparing directory contents
+                files_after = set(os.listdir(DOWNLOAD_DIR))
+                new_files = files_after - files_before
+                
+                if not new_files:
+                    print("No new files found after download")
+                    return None, None
+                
+                # Get the downloaded file (likely not an .m4a yet)
+                downloaded_file = None
+                for file in new_files:
+                    downloaded_file = file
+                    break
+                
+                if not downloaded_file:
+                    print("Could not find downloaded file")
+                    return None, None
             
             # Source file path
             source_path = os.path.join(DOWNLOAD_DIR, downloaded_file)
+            metrics.increment('bytes_downloaded', os.path.getsize(source_path), kind='audio')
             
-            # Prepare output file name - ensure it ends with .m4a
+            # Prepare output file names, one per requested format
             base_name = os.path.splitext(downloaded_file)[0]
-            output_file = f"{base_name}.m4a"
-            output_path = os.path.join(DOWNLOAD_DIR, output_file)
+            output_files = [f"{base_name}.{preset['extension']}" for _, preset in presets]
+            output_paths = [os.path.join(DOWNLOAD_DIR, output_file) for output_file in output_files]
             
-            print(f"Converting {source_path} to {output_path}...")
+            print(f"Converting {source_path} to {', '.join(output_paths)}...")
             
-            # Use ffmpeg directly for a more controlled conversion
-            ffmpeg_path = os.path.join(FFMPEG_DIRECTORY, "ffmpeg.exe")
+            # Use ffmpeg directly for a more controlled conversion, writing
+            # to temp names until the outputs are verified
+            temp_paths = [make_temp_path(preset['extension'], 'transcode') for _, preset in presets]
+            ffmpeg_path = get_ffmpeg_path()
             ffmpeg_cmd = [
                 ffmpeg_path,
+                "-y",  # Overwrite the empty temp files
                 "-i", source_path,
-                "-c:a", "aac", 
-                "-b:a", "256k",
-                "-movflags", "+faststart",
-                "-f", "mp4",
-                "-y",  # Overwrite if exists
-                output_path
+                *encode_args(presets, temp_paths)
             ]
             
             # Run ffmpeg command
-            process = subprocess.run(ffmpeg_cmd, check=True, 
-                                    stdout=subprocess.PIPE, 
-                                    stderr=subprocess.PIPE)
+            try:
+                with metrics.span('transcode', outputs=len(presets)):
+                    process = subprocess.run(ffmpeg_cmd, check=True, 
+                                            stdout=subprocess.PIPE, 
+                                            stderr=subprocess.PIPE)
+                finalize_outputs(temp_paths, output_paths, info.get('duration'))
+            finally:
+                for temp_path in temp_paths:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+            record_loudness(output_paths[0], process.stderr)
             
             # If source and output file are different, remove the source file
-            if source_path != output_path and os.path.exists(output_path):
+            if source_path not in output_paths and all(os.path.exists(path) for path in output_paths):
                 try:
                     os.remove(source_path)
                     print(f"Removed original file: {source_path}")
                 except:
                     print(f"Could not remove original file: {source_path}")
             
-            # Verify the new file exists
-            if os.path.exists(output_path):
-                print(f"Successfully converted to: {output_file}")
-                return title, output_file
+            # Verify the new files exist
+            missing = [path for path in output_paths if not os.path.exists(path)]
+            if not missing:
+                print(f"Successfully converted to: {', '.join(output_files)}")
+                return title, output_files
             else:
-                print(f"Conversion failed - output file not found: {output_path}")
-                return title, downloaded_file
+                print(f"Conversion failed - output file not found: {', '.join(missing)}")
+                return title, [downloaded_file]
     
     except Exception as e:
         print(f"Error during download/conversion: {e}")
         return None, None
 
-def clean_title_for_search(title):
-    """More aggressive cleaning for API search"""
-    import re
-    
-    # Remove common features, remix mentions, etc
-    removals = [
-        r'ft\..*', r'feat\..*', r'\(Official.*?\)', r'\[Official.*?\]',
-        r'\(Lyrics.*?\)', r'\[Lyrics.*?\]', r'\(Audio.*?\)', r'\[Audio.*?\]',
-        r'\(Official Video.*?\)', r'\(Official Music Video.*?\)',
-        r'\(Visualizer\)', r'\[Visualizer\]', r'Official Music Video',
-        r'Official Video', r'Official Audio', r'Official Lyrics Video',
-        r'Lyrics Video', r'Audio', r'HD', r'HQ', r'4K',
-        r'\(.*?Remix.*?\)', r'\[.*?Remix.*?\]', r'\(.*?Ver.*?\)',
-        r'\[.*?Ver.*?\]', r'\d{4}', r'MV', r'M/V'
-    ]
-    
-    cleaned = title
-    
-    # Apply all removals
-    for pattern in removals:
-        cleaned = re.sub(pattern, '', cleaned, flags=re.IGNORECASE)
-    
-    # Remove anything in brackets or parentheses more aggressively
-    cleaned = re.sub(r'\([^)]*\)', '', cleaned)
-    cleaned = re.sub(r'\[[^\]]*\]', '', cleaned)
-    
-    # Remove special characters but keep spaces
-    cleaned = re.sub(r'[^\w\s]', ' ', cleaned)
-    
-    # Remove multiple spaces and trim
-    cleaned = ' '.join(cleaned.split())
-    
-    return cleaned.strip()
-
 def extract_artist_title(video_title):
     """Try to extract artist and title from video title"""
     # Common separators between artist and title
@@ -164,52 +426,131 @@ def extract_artist_title(video_title):
     
     return None, video_title.strip()
 
-def get_album_art_deezer(query, artist=None):
-    """Search album art on Deezer"""
+def get_album_art_deezer(query, artist=None, limit=None, deadline=None):
+    """Search album art on Deezer and return a list of candidates"""
+    import requests
+    
+    limit = limit or CANDIDATE_LIMIT
+    hit, cached = lookupCache.get('deezer', artist, query)
+    if hit:
+        return cached or []
+    
+    if deadline and not deadline.can_start():
+        print("Skipping Deezer: lookup time budget nearly spent")
+        return []
+    breaker = circuitBreaker.get_breaker('deezer')
+    if not breaker.allow_request():
+        print("Skipping Deezer: provider is failing (circuit open)")
+        return []
+    
     # If artist is provided, use a more specific query
-    search_url = f"https://api.deezer.com/search?q={query}"
+    search_url = f"{DEEZER_SEARCH_URL}?q={query}&limit={limit}"
     if artist:
-        search_url = f"https://api.deezer.com/search?q=artist:\"{artist}\" track:\"{query}\""
+        search_url = f"{DEEZER_SEARCH_URL}?q=artist:\"{artist}\" track:\"{query}\"&limit={limit}"
     
+    candidates = []
+    timeout = deadline.timeout(PROVIDER_TIMEOUT) if deadline else PROVIDER_TIMEOUT
     try:
-        response = requests.get(search_url).json()
-        if "data" in response and response["data"]:
-            # Return album art and artist name if available
-            data = response["data"][0]
-            result = {
+        with metrics.span('provider_lookup', provider='deezer'):
+            response = requests.get(search_url, timeout=timeout)
+        response.raise_for_status()
+        response = response.json()
+        if "error" in response:
+            # Deezer reports quota and service errors with a 200 status
+            raise RuntimeError(response["error"].get("message", response["error"]))
+        breaker.record_success()
+        for data in response.get("data", [])[:limit]:
+            if "album" not in data or "cover_big" not in data["album"]:
+                continue
+            candidates.append({
                 'art_url': data["album"]["cover_big"],
-                'artist': data.get("artist", {}).get("name", None)
-            }
-            return result
+                'artist': data.get("artist", {}).get("name", None),
+                'title': data.get("title", ""),
+                'duration': data.get("duration"),
+                'source': 'Deezer'
+            })
+        lookupCache.put('deezer', candidates, artist, query)
     except Exception as e:
+        # A timeout the deadline cut short says nothing about the provider
+        if isinstance(e, requests.Timeout) and timeout < PROVIDER_TIMEOUT:
+            breaker.release_probe()
+        else:
+            breaker.record_failure()
         print(f"Deezer search error: {e}")
-    return None
+    return candidates
 
-def get_album_art_itunes(query, artist=None):
-    """Search album art on iTunes"""
+def get_album_art_itunes(query, artist=None, limit=None, deadline=None):
+    """Search album art on iTunes and return a list of candidates"""
+    import requests
+    
+    limit = limit or CANDIDATE_LIMIT
+    hit, cached = lookupCache.get('itunes', artist, query)
+    if hit:
+        return cached or []
+    
+    if deadline and not deadline.can_start():
+        print("Skipping iTunes: lookup time budget nearly spent")
+        return []
+    breaker = circuitBreaker.get_breaker('itunes')
+    if not breaker.allow_request():
+        print("Skipping iTunes: provider is failing (circuit open)")
+        return []
+    
     if artist:
         # Combine artist and query with a space or + for better search results
         combined_query = f"{artist} {query}"
         # URL encode the combined query
-        search_url = f"https://itunes.apple.com/search?term={combined_query}&media=music&limit=1"
+        search_url = f"{ITUNES_SEARCH_URL}?term={combined_query}&media=music&limit={limit}"
     else:
-        search_url = f"https://itunes.apple.com/search?term={query}&media=music&limit=1"
+        search_url = f"{ITUNES_SEARCH_URL}?term={query}&media=music&limit={limit}"
     
+    candidates = []
+    timeout = deadline.timeout(PROVIDER_TIMEOUT) if deadline else PROVIDER_TIMEOUT
     try:
-        response = requests.get(search_url).json()
-        if response["results"]:
+        with metrics.span('provider_lookup', provider='itunes'):
+            response = requests.get(search_url, timeout=timeout)
+        response.raise_for_status()
+        response = response.json()
+        breaker.record_success()
+        for result in response.get("results", [])[:limit]:
+            if "artworkUrl100" not in result:
+                continue
             # Get the highest quality artwork by replacing '100x100' with larger dimensions
-            result = response["results"][0]
-            artwork_url = result["artworkUrl100"].replace('100x100', '1200x1200')
-            return {
-                'art_url': artwork_url,
-                'artist': result.get("artistName", None)
-            }
+            millis = result.get("trackTimeMillis")
+            candidates.append({
+                'art_url': result["artworkUrl100"].replace('100x100', '1200x1200'),
+                'artist': result.get("artistName", None),
+                'title': result.get("trackName", ""),
+                'duration': millis / 1000 if millis else None,
+                'source': 'iTunes'
+            })
+        lookupCache.put('itunes', candidates, artist, query)
     except Exception as e:
+        if isinstance(e, requests.Timeout) and timeout < PROVIDER_TIMEOUT:
+            breaker.release_probe()
+        else:
+            breaker.record_failure()
         print(f"iTunes search error: {e}")
-    return None
+    return candidates
+
+def get_album_art_catalog(query, artist=None, limit=None, deadline=None):
+    """Search the local catalog mirror and return candidates that have Cover Art Archive artwork"""
+    import albumUpdater
+    
+    candidates = []
+    for row in catalogMirror.search(query, artist, limit or CANDIDATE_LIMIT):
+        if not row['has_cover']:
+            continue
+        candidates.append({
+            'art_url': albumUpdater.COVER_ART_URL.format(release_id=row['release_id']),
+            'artist': row['artist'],
+            'title': row['title'],
+            'duration': row['duration'],
+            'source': 'Catalog'
+        })
+    return candidates
 
-def get_album_art_and_artist(video_title, video_info=None):
+def get_album_art_and_artist(video_title, video_info=None, deadline=None):
     """Try multiple sources and methods to find album art and artist info"""
     print("Searching for album art and artist info...")
     
@@ -225,6 +566,7 @@ def get_album_art_and_artist(video_title, video_info=None):
     
     # Determine the best artist to use (prefer info_artist over extracted_artist)
     best_artist = info_artist if info_artist else extracted_artist
+    duration = video_info.get('duration') if video_info else None
     
     # Try different search combinations
     search_queries = []
@@ -239,21 +581,43 @@ def get_album_art_and_artist(video_title, video_info=None):
         # Fallback to just the cleaned title
         search_queries.append(cleaned_title)
     
-    # Try each query with each service
-    for query in search_queries:
-        print(f"Trying search query: {query}")
+    # The local catalog mirror answers without network calls, so every query
+    # is tried there before Deezer and iTunes are asked
+    attempts = [(query, name, provider) for query in search_queries
+                for name, provider in (('deezer', get_album_art_deezer), ('itunes', get_album_art_itunes))]
+    if catalogMirror.available():
+        attempts = [(query, 'catalog', get_album_art_catalog) for query in search_queries] + attempts
+    
+    # Score every candidate locally and stop at the first confident match,
+    # giving up once the per-song time budget is spent
+    deadline = deadline or circuitBreaker.Deadline(LOOKUP_BUDGET)
+    best_score, best_candidate = 0.0, None
+    last_query = None
+    asked = set()
+    for query, name, provider in attempts:
+        if not deadline.can_start():
+            print(f"Lookup time budget of {LOOKUP_BUDGET}s exhausted")
+            break
+        if query != last_query:
+            print(f"Trying search query: {query}")
+            last_query = query
+        if name in asked:
+            metrics.increment('retries', stage='provider_lookup', provider=name)
+        asked.add(name)
         
-        # Try Deezer
-        result = get_album_art_deezer(query, best_artist)
-        if result:
-            print("Found info on Deezer")
-            return result
-            
-        # Try iTunes
-        result = get_album_art_itunes(query, best_artist)
-        if result:
-            print("Found info on iTunes")
-            return result
+        for candidate in provider(query, best_artist, deadline=deadline):
+            score = score_candidate(candidate, title, best_artist, duration)
+            if score > best_score:
+                best_score, best_candidate = score, candidate
+        
+        if best_score >= MATCH_THRESHOLD:
+            print(f"Found info on {best_candidate['source']}: {best_candidate['title']} "
+                  f"by {best_candidate['artist']} (score {best_score:.2f})")
+            return {'art_url': best_candidate['art_url'], 'artist': best_candidate['artist']}
+    
+    if best_candidate:
+        print(f"Best match {best_candidate['title']} by {best_candidate['artist']} "
+              f"scored {best_score:.2f}, below threshold {MATCH_THRESHOLD}")
     
     # If no result found, return extracted artist if available
     if extracted_artist:
@@ -263,8 +627,92 @@ def get_album_art_and_artist(video_title, video_info=None):
     print("No album art or artist info found after trying all sources")
     return {'art_url': None, 'artist': None}
 
-def embed_metadata(song_path, title, artist=None, image_url=None):
-    """Embed metadata and album art into the M4A file"""
+def fetch_cover(image_url):
+    """Download album art once so it can be embedded into every output format"""
+    import requests
+    
+    try:
+        with metrics.span('cover_fetch'):
+            response = requests.get(image_url, timeout=PROVIDER_TIMEOUT)
+        if response.status_code == 200:
+            metrics.increment('bytes_downloaded', len(response.content), kind='cover')
+            return response.content
+        print(f"Album art request failed with status {response.status_code}")
+    except Exception as e:
+        print(f"Error downloading album art: {e}")
+    return None
+
+_lookup_executor = None
+_lookup_executor_lock = threading.Lock()
+
+def get_lookup_executor():
+    """Thread pool that runs metadata lookups while songs download"""
+    global _lookup_executor
+    with _lookup_executor_lock:
+        if _lookup_executor is None:
+            _lookup_executor = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS, thread_name_prefix='lookup')
+        return _lookup_executor
+
+def lookup_metadata(video_info):
+    """
+    Everything process_song needs from the metadata providers: artist,
+    album art (already downloaded) and MusicBrainz release info. Only
+    needs the video info, so it can run while the audio downloads.
+    MusicBrainz and the Cover Art Archive are asked first; Deezer and
+    iTunes only when they have no match or no artwork.
+    """
+    with metrics.span('lookup_metadata'):
+        return _lookup_metadata(video_info)
+
+def _lookup_metadata(video_info):
+    # Clean the title for better search results
+    cleaned_title = clean_title_for_search(video_info['title'])
+    print(f"Processing metadata for: {cleaned_title}")
+    
+    extracted_artist, title = extract_artist_title(cleaned_title)
+    artist = video_info.get('artist') or extracted_artist
+    deadline = circuitBreaker.Deadline(LOOKUP_BUDGET)
+    
+    # One MusicBrainz query gives the album, year, track numbers, the
+    # artist's canonical name and a Cover Art Archive image
+    release_info = get_release_info(title, artist, video_info.get('duration'), deadline)
+    album_art_url = None
+    if release_info:
+        artist = release_info.get('artist') or artist
+        album_art_url = release_info.get('cover_url')
+    
+    # Fall back to Deezer and iTunes for the artwork and artist
+    if not album_art_url:
+        metadata_info = get_album_art_and_artist(video_info['title'], video_info, deadline)
+        album_art_url = metadata_info.get('art_url', None)
+        if not release_info:
+            artist = metadata_info.get('artist', None)
+    
+    # Fetch the cover once for all outputs
+    cover_data = fetch_cover(album_art_url) if album_art_url else None
+    return {'title': cleaned_title, 'artist': artist, 'release_info': release_info, 'cover_data': cover_data}
+
+def get_release_info(title, artist=None, duration=None, deadline=None):
+    """Album, release date, track/disc number, MBIDs and cover URL from one MusicBrainz query"""
+    if not LOOKUP_RELEASES:
+        return None
+    import albumUpdater
+    
+    try:
+        return albumUpdater.get_release_info(artist, title, duration, deadline)
+    except Exception as e:
+        print(f"MusicBrainz lookup failed: {e}")
+        return None
+
+def embed_metadata(song_path, title, artist=None, image_url=None, loudness_values=None, cover_data=None,
+                   source_id=None, release_info=None, reserve=False):
+    """
+    Embed metadata and album art into the M4A file. reserve is for the first
+    write to a freshly created file: it resets the tag padding, which rewrites
+    the whole file, so later edits such as a re-tag fit in place.
+    """
+    from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+    
     try:
         # Verify the file exists
         if not os.path.exists(song_path):
@@ -283,38 +731,14 @@ def embed_metadata(song_path, title, artist=None, image_url=None):
         except Exception as e:
             print(f"Cannot open as MP4: {e}")
             
-            # Try to fix the file with ffmpeg
+            # Remux into a temp file that replaces the original once it checks out
             print("Attempting to fix the file format...")
-            ffmpeg_path = os.path.join(FFMPEG_DIRECTORY, "ffmpeg.exe")
-            temp_path = song_path + ".temp.m4a"
-            
-            ffmpeg_cmd = [
-                ffmpeg_path,
-                "-i", song_path,
-                "-c:a", "copy",  # Just copy the audio stream, no re-encoding
-                "-f", "mp4",     # Ensure mp4 container format
-                "-y",            # Overwrite if exists
-                temp_path
-            ]
-            
-            try:
-                subprocess.run(ffmpeg_cmd, check=True, 
-                              stdout=subprocess.PIPE, 
-                              stderr=subprocess.PIPE)
-                
-                # Remove original file and rename temp file
-                if os.path.exists(temp_path):
-                    os.remove(song_path)
-                    os.rename(temp_path, song_path)
-                    print("File fixed successfully")
-                    # Now try opening it again
-                    audio = MP4(song_path)
-                else:
-                    print("Failed to fix file format")
-                    return False
-            except Exception as fix_e:
-                print(f"Error fixing file: {fix_e}")
+            metrics.increment('retries', stage='container_repair')
+            if not libraryCheck.repair_file(song_path):
+                print("Failed to fix file format")
                 return False
+            print("File fixed successfully")
+            audio = MP4(song_path)
         
         # Add title metadata
         audio['\xa9nam'] = [title]  # Title
@@ -324,54 +748,200 @@ def embed_metadata(song_path, title, artist=None, image_url=None):
             audio['\xa9ART'] = [artist]  # Artist
             print(f"Added artist metadata: {artist}")
         
+        # Remember which video the file was made from, for the library index
+        if source_id:
+            audio[libraryIndex.SOURCE_ID_KEY] = [MP4FreeForm(source_id.encode('utf-8'))]
+        
+        # Album, date, track/disc numbers and MBIDs, in the same save as the cover
+        if release_info:
+            import albumUpdater
+            albumUpdater.apply_release_info(audio, release_info)
+            print(f"Added album metadata: {release_info['album']}")
+        
+        # Add ReplayGain / iTunNORM tags measured during the transcode
+        if loudness_values:
+            loudness.apply_loudness_tags(audio, loudness_values)
+            print(f"Loudness: {loudness_values['integrated']:.1f} LUFS")
+        
         # Add album art if available
-        if image_url:
-            try:
-                response = requests.get(image_url)
-                if response.status_code == 200:
-                    cover = MP4Cover(response.content, imageformat=MP4Cover.FORMAT_JPEG)
-                    audio['covr'] = [cover]
-                    print("Album art added successfully")
-            except Exception as e:
-                print(f"Error adding album art: {e}")
+        if cover_data is None and image_url:
+            cover_data = fetch_cover(image_url)
+        if cover_data:
+            cover = MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)
+            audio['covr'] = [cover]
+            print("Album art added successfully")
         
-        audio.save()
+        mp4Padding.save_mp4(audio, reserve=reserve)
         print(f"Metadata embedded for: {title}")
         return True
     except Exception as e:
         print(f"Error embedding metadata: {e}")
         return False
 
-def process_song(song_url):
-    """Process a single song - download and add metadata"""
+def embed_metadata_mp3(song_path, title, artist=None, cover_data=None, loudness_values=None, source_id=None,
+                       release_info=None):
+    """Embed metadata and album art into an MP3 file as ID3v2.3 frames"""
+    from mutagen.id3 import ID3, ID3NoHeaderError, TIT2, TPE1, APIC, TXXX
+    
+    try:
+        try:
+            tags = ID3(song_path)
+        except ID3NoHeaderError:
+            tags = ID3()
+        tags.setall('TIT2', [TIT2(encoding=3, text=[title])])
+        if artist:
+            tags.setall('TPE1', [TPE1(encoding=3, text=[artist])])
+        if loudness_values:
+            gain, peak = loudness.replaygain(loudness_values)
+            tags.setall('TXXX:REPLAYGAIN_TRACK_GAIN', [TXXX(encoding=3, desc='REPLAYGAIN_TRACK_GAIN', text=[f"{gain:+.2f} dB"])])
+            tags.setall('TXXX:REPLAYGAIN_TRACK_PEAK', [TXXX(encoding=3, desc='REPLAYGAIN_TRACK_PEAK', text=[f"{peak:.6f}"])])
+        if source_id:
+            tags.setall(f'TXXX:{libraryIndex.SOURCE_ID_DESC}',
+                        [TXXX(encoding=3, desc=libraryIndex.SOURCE_ID_DESC, text=[source_id])])
+        if release_info:
+            import albumUpdater
+            albumUpdater.apply_release_info(tags, release_info)
+        if cover_data:
+            tags.setall('APIC', [APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover_data)])
+        with metrics.span('tag_save'):
+            tags.save(song_path, v2_version=3)
+        libraryIndex.update_file(song_path)
+        print(f"Metadata embedded for: {os.path.basename(song_path)}")
+        return True
+    except Exception as e:
+        print(f"Error embedding metadata: {e}")
+        return False
+
+def embed_metadata_opus(song_path, title, artist=None, cover_data=None, loudness_values=None, source_id=None,
+                        release_info=None):
+    """Embed metadata and album art into an Ogg Opus file as Vorbis comments"""
+    import base64
+    from mutagen.oggopus import OggOpus
+    from mutagen.flac import Picture
+    
+    try:
+        audio = OggOpus(song_path)
+        audio['title'] = [title]
+        if artist:
+            audio['artist'] = [artist]
+        if loudness_values:
+            # Opus players read R128 gain rather than ReplayGain tags
+            audio['R128_TRACK_GAIN'] = [str(loudness.r128_track_gain(loudness_values))]
+        if source_id:
+            audio[libraryIndex.SOURCE_ID_COMMENT] = [source_id]
+        if release_info:
+            import albumUpdater
+            albumUpdater.apply_release_info(audio, release_info)
+        if cover_data:
+            picture = Picture()
+            picture.type = 3  # Front cover
+            picture.mime = 'image/jpeg'
+            picture.desc = 'Cover'
+            picture.data = cover_data
+            audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+        with metrics.span('tag_save'):
+            audio.save()
+        libraryIndex.update_from_audio(audio)
+        print(f"Metadata embedded for: {os.path.basename(song_path)}")
+        return True
+    except Exception as e:
+        print(f"Error embedding metadata: {e}")
+        return False
+
+def embed_song_metadata(song_path, title, artist=None, cover_data=None, loudness_values=None, source_id=None,
+                        release_info=None, reserve=False):
+    """Tag one output file, choosing the tag format from its extension. reserve marks a new file."""
+    extension = os.path.splitext(song_path)[1].lower()
+    if extension == '.mp3':
+        return embed_metadata_mp3(song_path, title, artist, cover_data, loudness_values, source_id, release_info)
+    if extension == '.opus':
+        return embed_metadata_opus(song_path, title, artist, cover_data, loudness_values, source_id, release_info)
+    return embed_metadata(song_path, title, artist, None, loudness_values, cover_data, source_id, release_info,
+                          reserve)
+
+def find_existing_duplicate(song_path, source_id=None):
+    """
+    Return the path of a near-identical song in the dedupe index, or None.
+    Earlier downloads of the same video (source_id) do not count.
+    """
+    import dedupeLibrary
+    
+    try:
+        return dedupeLibrary.find_duplicate(song_path, source_id=source_id)
+    except Exception as e:
+        print(f"Duplicate check failed: {e}")
+        return None
+
+def update_duplicate_index(song_path):
+    """Keep the dedupe index entry valid after the tags changed"""
+    import dedupeLibrary
+    
+    try:
+        dedupeLibrary.update_stat(song_path)
+    except Exception as e:
+        print(f"Could not update duplicate index: {e}")
+
+def process_song(song_url, formats=None):
+    """
+    Process a single song - download it in every requested format and add
+    the same metadata to each output
+    """
     # Get video info first
     video_info = get_video_info(song_url)
     if not video_info:
         print("Failed to get video information")
         return False
     
+    # The lookups only need the video title, so run them while the song
+    # downloads and transcodes
+    metadata_future = get_lookup_executor().submit(lookup_metadata, video_info)
+    
     # Download the song
-    downloaded_title, downloaded_filename = download_song(song_url)
-    if not downloaded_title or not downloaded_filename:
+    downloaded_title, downloaded_filenames = download_song(song_url, formats)
+    if not downloaded_title or not downloaded_filenames:
+        metadata_future.cancel()
         print("Failed to download song")
         return False
     
-    # Clean the title for better search results
-    cleaned_title = clean_title_for_search(video_info['title'])
-    print(f"Processing metadata for: {cleaned_title}")
-    
-    # Get album art and artist info - pass both title and video_info
-    metadata_info = get_album_art_and_artist(video_info['title'], video_info)
+    # The primary output stands for the whole job in the duplicate check
+    song_paths = [os.path.join(DOWNLOAD_DIR, filename) for filename in downloaded_filenames]
+    song_path = song_paths[0]
+    if CHECK_DUPLICATES:
+        duplicate = find_existing_duplicate(song_path, video_info.get('id'))
+        if duplicate and duplicate not in map(os.path.abspath, song_paths):
+            print(f"Duplicate of {duplicate}, skipping tagging of {', '.join(downloaded_filenames)}")
+            if DELETE_DUPLICATES:
+                for path in song_paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+                        libraryIndex.remove_file(path)
+                print(f"Removed {', '.join(downloaded_filenames)}")
+            take_loudness(song_path)
+            metadata_future.cancel()
+            metrics.increment('duplicates_skipped')
+            return True
     
-    # Extract artist and art URL from result
-    artist = metadata_info.get('artist', None)
-    album_art_url = metadata_info.get('art_url', None)
+    # Wait for the lookups started before the download
+    try:
+        with metrics.span('lookup_wait'):
+            metadata = metadata_future.result()
+    except Exception as e:
+        print(f"Metadata lookup failed: {e}")
+        metadata = {'title': clean_title_for_search(video_info['title']), 'artist': None,
+                    'release_info': None, 'cover_data': None}
+    cleaned_title = metadata['title']
+    artist = metadata['artist']
     
     # Embed metadata and album art
-    song_path = os.path.join(DOWNLOAD_DIR, downloaded_filename)
-    if os.path.exists(song_path):
-        success = embed_metadata(song_path, cleaned_title, artist, album_art_url)
+    missing = [path for path in song_paths if not os.path.exists(path)]
+    if not missing:
+        loudness_values = take_loudness(song_path)
+        success = all([embed_song_metadata(path, cleaned_title, artist, metadata['cover_data'], loudness_values,
+                                           video_info.get('id'), metadata['release_info'], reserve=True)
+                       for path in song_paths])
         if success:
+            if CHECK_DUPLICATES:
+                update_duplicate_index(song_path)
             result_info = f"{cleaned_title}"
             if artist:
                 result_info += f" by {artist}"
@@ -381,27 +951,180 @@ def process_song(song_url):
             print(f"Failed to embed metadata for {cleaned_title}")
             return False
     else:
-        print(f"Error: Could not find the downloaded file at {song_path}")
+        print(f"Error: Could not find the downloaded file at {', '.join(missing)}")
         return False
 
+def retag_songs(song_paths, source_id):
+    """
+    Look up metadata again for files made from one video and rewrite their
+    tags. The video info comes from the cache, so YouTube is not asked again.
+    """
+    video_info = get_video_info(videoInfoCache.video_url(source_id))
+    if not video_info:
+        print(f"No video information for {source_id}")
+        return False
+    try:
+        metadata = lookup_metadata(video_info)
+    except Exception as e:
+        print(f"Metadata lookup failed for {source_id}: {e}")
+        return False
+    return all([embed_song_metadata(path, metadata['title'], metadata['artist'], metadata['cover_data'],
+                                    None, source_id, metadata['release_info'])
+                for path in song_paths])
+
+def retag_library(directory=None):
+    """Re-tag every file in the download directory that records its source video"""
+    directory = directory or DOWNLOAD_DIR
+    libraryIndex.refresh(directory)
+    by_source = {}
+    for track in libraryIndex.query_tracks(directory):
+        if track['source_id']:
+            by_source.setdefault(track['source_id'], []).append(track['path'])
+    print(f"Re-tagging {sum(len(paths) for paths in by_source.values())} file(s) "
+          f"from {len(by_source)} video(s)")
+    
+    retagged = 0
+    for source_id, song_paths in by_source.items():
+        with metrics.span('retag_song'):
+            if retag_songs(song_paths, source_id):
+                retagged += 1
+    print(f"Re-tagged {retagged} of {len(by_source)} video(s)")
+    rewritten = mp4Padding.report_rewrites()
+    if rewritten:
+        print(f"{len(rewritten)} file(s) needed a full rewrite to fit their tags")
+    try:
+        metrics.flush()
+    except OSError as e:
+        print(f"Could not write metrics: {e}")
+    return retagged
+
+def iter_playlist_entries(url):
+    """
+    Yield video URLs from a playlist or channel as yt-dlp pages through it.
+    Entries are not processed, so nothing beyond the current page is fetched
+    or held in memory. A plain video URL yields itself.
+    """
+    import yt_dlp
+    
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with metrics.span('extract_info', kind='playlist'):
+            info = ydl.extract_info(url, download=False, process=False)
+        yield from _iter_entries(ydl, info, url)
+
+def _iter_entries(ydl, info, url):
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        yield info.get('webpage_url') or url
+        return
+    # entries is a lazy generator for paged extractors such as YouTube playlists
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue
+        if entry.get('_type') == 'playlist':
+            yield from _iter_entries(ydl, entry, url)
+        elif entry.get('ie_key') == 'YoutubeTab':
+            # Channels list their tabs (videos, shorts, ...) as nested playlists
+            nested = ydl.extract_info(entry['url'], download=False, process=False)
+            yield from _iter_entries(ydl, nested, entry['url'])
+        elif entry.get('url'):
+            yield entry['url']
+        elif entry.get('id'):
+            yield f"https://www.youtube.com/watch?v={entry['id']}"
+
+def process_playlist(playlist_url, workers=None, formats=None):
+    """
+    Download every song of a playlist or channel. A producer thread expands
+    the URL lazily into a bounded queue while worker threads process songs,
+    so downloads start before paging has finished and memory stays flat.
+    """
+    workers = workers or DOWNLOAD_WORKERS
+    song_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    stats = {'queued': 0, 'succeeded': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+    
+    def produce():
+        try:
+            for song_url in iter_playlist_entries(playlist_url):
+                song_queue.put(song_url)
+                stats['queued'] += 1
+        except Exception as e:
+            print(f"Error expanding playlist: {e}")
+        finally:
+            for _ in range(workers):
+                song_queue.put(None)
+    
+    def consume():
+        while True:
+            song_url = song_queue.get()
+            if song_url is None:
+                return
+            try:
+                with metrics.span('process_song'):
+                    success = process_song(song_url, formats)
+            except Exception as e:
+                print(f"Error processing {song_url}: {e}")
+                success = False
+            with stats_lock:
+                stats['succeeded' if success else 'failed'] += 1
+            try:
+                metrics.flush()
+            except OSError as e:
+                print(f"Could not write metrics: {e}")
+    
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=consume, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    print(f"\nPlaylist done: {stats['succeeded']} succeeded, {stats['failed']} failed "
+          f"out of {stats['queued']} songs")
+    return stats
+
 def main():
+    parser = argparse.ArgumentParser(description='Download songs from YouTube and add metadata')
+    profiler.add_arguments(parser)
+    args = parser.parse_args()
+    profiler.enable_from_args(args, 'main')
+    sweep_orphans()
+    
     print("=== YouTube Song Downloader ===")
     print("This tool downloads songs from YouTube and adds metadata including artist info.")
     
     while True:
         print("\nOptions:")
         print("1. Download a song")
-        print("2. Quit")
+        print("2. Download a playlist or channel")
+        print("3. Re-tag downloaded songs")
+        print("4. Quit")
         
-        choice = input("Enter your choice (1-2): ").strip()
+        choice = input("Enter your choice (1-4): ").strip()
         
         if choice == "1":
             song_url = input("Enter YouTube song URL: ")
             if song_url:
-                process_song(song_url)
+                with metrics.span('process_song'):
+                    process_song(song_url)
+                try:
+                    metrics.flush()
+                except OSError as e:
+                    print(f"Could not write metrics: {e}")
             else:
                 print("No URL provided")
         elif choice == "2":
+            playlist_url = input("Enter YouTube playlist or channel URL: ")
+            if playlist_url:
+                process_playlist(playlist_url)
+            else:
+                print("No URL provided")
+        elif choice == "3":
+            retag_library()
+        elif choice == "4":
             print("Goodbye!")
             break
         else:
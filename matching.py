@@ -0,0 +1,80 @@
+"""
+matching.py - Title cleanup and candidate scoring shared by the metadata lookups
+
+Deezer, iTunes, MusicBrainz and catalog mirror hits are all scored the same
+way against the song being tagged, and only accepted above MATCH_THRESHOLD.
+"""
+
+MATCH_THRESHOLD = 0.6     # Minimum score for a candidate to be accepted
+DURATION_TOLERANCE = 15   # Seconds of difference at which the duration score reaches 0
+SCORE_WEIGHTS = {'title': 0.55, 'artist': 0.3, 'duration': 0.15}
+
+def clean_title_for_search(title):
+    """More aggressive cleaning for API search"""
+    import re
+    
+    # Remove common features, remix mentions, etc
+    removals = [
+        r'ft\..*', r'feat\..*', r'\(Official.*?\)', r'\[Official.*?\]',
+        r'\(Lyrics.*?\)', r'\[Lyrics.*?\]', r'\(Audio.*?\)', r'\[Audio.*?\]',
+        r'\(Official Video.*?\)', r'\(Official Music Video.*?\)',
+        r'\(Visualizer\)', r'\[Visualizer\]', r'Official Music Video',
+        r'Official Video', r'Official Audio', r'Official Lyrics Video',
+        r'Lyrics Video', r'Audio', r'HD', r'HQ', r'4K',
+        r'\(.*?Remix.*?\)', r'\[.*?Remix.*?\]', r'\(.*?Ver.*?\)',
+        r'\[.*?Ver.*?\]', r'\d{4}', r'MV', r'M/V'
+    ]
+    
+    cleaned = title
+    
+    # Apply all removals
+    for pattern in removals:
+        cleaned = re.sub(pattern, '', cleaned, flags=re.IGNORECASE)
+    
+    # Remove anything in brackets or parentheses more aggressively
+    cleaned = re.sub(r'\([^)]*\)', '', cleaned)
+    cleaned = re.sub(r'\[[^\]]*\]', '', cleaned)
+    
+    # Remove special characters but keep spaces
+    cleaned = re.sub(r'[^\w\s]', ' ', cleaned)
+    
+    # Remove multiple spaces and trim
+    cleaned = ' '.join(cleaned.split())
+    
+    return cleaned.strip()
+
+def tokenize(text):
+    """Lowercase word tokens of a cleaned title or artist name"""
+    return set(clean_title_for_search(text or '').lower().split())
+
+def token_similarity(a, b):
+    """Dice coefficient between two token sets (1.0 means same words)"""
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+def score_candidate(candidate, title, artist=None, duration=None):
+    """
+    Score a provider candidate between 0 and 1 against the cleaned title,
+    artist and the video duration. Weights are renormalized when the artist
+    or duration is unknown.
+    """
+    title_tokens = tokenize(title)
+    candidate_title = tokenize(candidate.get('title'))
+    candidate_artist = tokenize(candidate.get('artist'))
+    
+    scores = []
+    if artist:
+        scores.append((SCORE_WEIGHTS['title'], token_similarity(title_tokens, candidate_title)))
+        scores.append((SCORE_WEIGHTS['artist'], token_similarity(tokenize(artist), candidate_artist)))
+    else:
+        # Without a known artist the title may contain it, so compare against both fields
+        combined = token_similarity(title_tokens, candidate_title | candidate_artist)
+        scores.append((SCORE_WEIGHTS['title'] + SCORE_WEIGHTS['artist'], max(combined, token_similarity(title_tokens, candidate_title))))
+    
+    if duration and candidate.get('duration'):
+        difference = abs(float(duration) - float(candidate['duration']))
+        scores.append((SCORE_WEIGHTS['duration'], max(0.0, 1 - difference / DURATION_TOLERANCE)))
+    
+    total_weight = sum(weight for weight, _ in scores)
+    return sum(weight * score for weight, score in scores) / total_weight
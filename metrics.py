@@ -0,0 +1,207 @@
+"""
+metrics.py - Timing spans and counters exported as JSON Lines and a Prometheus textfile
+"""
+
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+import profiler
+
+METRICS_ENABLED = True
+METRICS_DIR = "metrics"
+JSONL_FILE = os.path.join(METRICS_DIR, "events.jsonl")
+PROMETHEUS_FILE = os.path.join(METRICS_DIR, "songs_downloader.prom")
+TOTALS_DB = os.path.join(METRICS_DIR, "totals.db")  # Running totals of every process, rendered into PROMETHEUS_FILE
+PROMETHEUS_PREFIX = "songs_downloader"
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_span_totals = {}  # (name, labels) -> [count, total seconds, failures]
+_counters = {}     # (name, labels) -> value
+_flushed = ({}, {})  # The span totals and counters already added to TOTALS_DB
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _write_event(event):
+    if not METRICS_ENABLED:
+        return
+    line = json.dumps(event, ensure_ascii=False)
+    with _lock:
+        os.makedirs(os.path.dirname(JSONL_FILE) or '.', exist_ok=True)
+        with open(JSONL_FILE, 'a', encoding='utf-8') as f:
+            f.write(line + "\n")
+
+@contextmanager
+def span(name, **labels):
+    """
+    Time a block of work. Failures (exceptions) are recorded and re-raised.
+    With profiling enabled the block is also profiled as a stage.
+
+        with metrics.span('download', url=url):
+            ...
+    """
+    start = time.perf_counter()
+    ok = True
+    try:
+        with profiler.stage(name):
+            yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        key = (name, _label_key(labels))
+        with _lock:
+            totals = _span_totals.setdefault(key, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += duration
+            if not ok:
+                totals[2] += 1
+        _write_event({'ts': time.time(), 'type': 'span', 'name': name,
+                      'duration': round(duration, 6), 'ok': ok, 'labels': labels})
+
+def increment(name, value=1, **labels):
+    """Add to a counter, e.g. increment('bytes_downloaded', len(data))"""
+    key = (name, _label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _write_event({'ts': time.time(), 'type': 'counter', 'name': name,
+                  'value': value, 'labels': labels})
+
+def snapshot():
+    """Return copies of the span totals and counters collected so far"""
+    with _lock:
+        return ({key: list(value) for key, value in _span_totals.items()}, dict(_counters))
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in pairs]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+def render_prometheus(span_totals=None, counters=None):
+    """
+    Render metrics in the Prometheus text exposition format, by default
+    those of this process
+    """
+    if span_totals is None or counters is None:
+        span_totals, counters = snapshot()
+    lines = []
+    if span_totals:
+        base = f"{PROMETHEUS_PREFIX}_stage_duration_seconds"
+        lines.append(f"# HELP {base} Time spent in each pipeline stage")
+        lines.append(f"# TYPE {base} summary")
+        for (name, labels), (count, total, _) in sorted(span_totals.items()):
+            label_text = _format_labels(labels, [('stage', name)])
+            lines.append(f"{base}_sum{label_text} {total:.6f}")
+            lines.append(f"{base}_count{label_text} {count}")
+        failures = f"{PROMETHEUS_PREFIX}_stage_failures_total"
+        lines.append(f"# HELP {failures} Pipeline stages that raised an exception")
+        lines.append(f"# TYPE {failures} counter")
+        for (name, labels), (_, _, failed) in sorted(span_totals.items()):
+            lines.append(f"{failures}{_format_labels(labels, [('stage', name)])} {failed}")
+    names = sorted({name for name, _ in counters})
+    for name in names:
+        metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def _connect():
+    conn = sqlite3.connect(TOTALS_DB, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS spans (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            total REAL NOT NULL,
+            failures INTEGER NOT NULL,
+            PRIMARY KEY (name, labels)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels)
+        )
+    """)
+    conn.commit()
+    return conn
+
+def _add_totals(conn, span_totals, counters):
+    """Add this process's growth since the last flush to the shared totals"""
+    flushed_spans, flushed_counters = _flushed
+    for (name, labels), (count, total, failures) in span_totals.items():
+        done = flushed_spans.get((name, labels), [0, 0.0, 0])
+        if count == done[0]:
+            continue
+        conn.execute("""
+            INSERT INTO spans VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (name, labels) DO UPDATE SET count = count + excluded.count,
+                total = total + excluded.total, failures = failures + excluded.failures
+        """, (name, json.dumps(labels), count - done[0], total - done[1], failures - done[2]))
+    for (name, labels), value in counters.items():
+        delta = value - flushed_counters.get((name, labels), 0)
+        if not delta:
+            continue
+        conn.execute("""
+            INSERT INTO counters VALUES (?, ?, ?)
+            ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value
+        """, (name, json.dumps(labels), delta))
+
+def _read_totals(conn):
+    span_totals = {(name, tuple(map(tuple, json.loads(labels)))): [count, total, failures]
+                   for name, labels, count, total, failures in conn.execute("SELECT * FROM spans")}
+    counters = {}
+    for name, labels, value in conn.execute("SELECT * FROM counters"):
+        counters[(name, tuple(map(tuple, json.loads(labels))))] = int(value) if value == int(value) else value
+    return span_totals, counters
+
+def flush():
+    """
+    Add this process's metrics to the totals shared by every process and
+    rewrite the one Prometheus textfile from them. Worker processes write
+    in turn under the database lock, so none overwrites another's counts,
+    and the series carry no per-process label.
+    """
+    global _flushed
+    if not METRICS_ENABLED:
+        return
+    path = PROMETHEUS_FILE
+    directory = os.path.dirname(path) or '.'
+    with _flush_lock:
+        os.makedirs(directory, exist_ok=True)
+        span_totals, counters = snapshot()
+        conn = _connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            _add_totals(conn, span_totals, counters)
+            text = render_prometheus(*_read_totals(conn))
+            # A unique temp name per flush, and the .tmp suffix keeps collectors from reading it
+            temp_fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.prom.tmp')
+            try:
+                with os.fdopen(temp_fd, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        _flushed = (span_totals, counters)
@@ -0,0 +1,61 @@
+"""
+mp4Padding.py - Keep MP4 tag edits in place by reserving and reusing free atom padding
+
+With moov in front of mdat (+faststart), growing the ilst atom forces mutagen
+to shift the whole media payload. Reserving a free atom after ilst when a file
+is created lets later tag edits, including adding a large cover, rewrite only
+the metadata.
+"""
+
+import logging
+import threading
+import metrics
+import libraryIndex
+
+logger = logging.getLogger(__name__)
+
+MP4_TAG_PADDING = 256 * 1024  # Bytes of free space reserved after the tags
+
+_lock = threading.Lock()
+rewritten_files = []  # Files whose tags outgrew the available padding
+
+def save_mp4(audio, reserve=False):
+    """
+    Save an MP4 (mutagen) object, reusing its padding when the new tags fit.
+
+    reserve=True is for files the pipeline just created: the padding is reset
+    to MP4_TAG_PADDING. Otherwise existing padding is kept as is, and a file
+    that has to grow is given MP4_TAG_PADDING again and recorded in
+    rewritten_files. Returns True if the save happened in place.
+    """
+    outcome = {'in_place': True}
+
+    def padding(info):
+        if reserve:
+            return MP4_TAG_PADDING
+        if info.padding >= 0:
+            # Tags fit in the existing free space, keep the file layout unchanged
+            return info.padding
+        outcome['in_place'] = False
+        return MP4_TAG_PADDING
+
+    with metrics.span('tag_save'):
+        audio.save(padding=padding)
+
+    if not reserve and not outcome['in_place']:
+        with _lock:
+            rewritten_files.append(str(audio.filename))
+        metrics.increment('tag_rewrites')
+        logger.warning(f"Tags did not fit in the padding, file was rewritten: {audio.filename}")
+    libraryIndex.update_from_audio(audio)
+    return outcome['in_place']
+
+def report_rewrites():
+    """Log the files that needed a full rewrite during this run"""
+    with _lock:
+        files = list(rewritten_files)
+    if files:
+        logger.info(f"{len(files)} file(s) needed a full rewrite to fit their tags:")
+        for path in files:
+            logger.info(f"  {path}")
+    return files
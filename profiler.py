@@ -0,0 +1,199 @@
+"""
+profiler.py - Opt-in cProfile and sampling profiles scoped to pipeline stages
+
+Every metrics.span is a stage. While profiling is on, each stage runs under
+its own cProfile.Profile; a nested stage pauses its parent, so each stage's
+stats only hold the code that ran directly in it. Code outside any stage is
+recorded as the 'run' stage. An optional sampler thread records wall-clock
+stacks of all threads, including time spent waiting on the network.
+
+At exit the profiles are written to PROFILE_DIR/<timestamp>-<entry point>/:
+  <stage>.pstats    cProfile stats, readable with pstats or snakeviz
+  stages.collapsed  own time per function grouped by stage, in the collapsed
+                    stack format read by flamegraph.pl and speedscope
+  wall.collapsed    sampled wall-clock stacks (with --profile-sampling)
+"""
+
+import os
+import sys
+import time
+import atexit
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = "profiles"
+SAMPLE_INTERVAL = 0.005  # Seconds between wall-clock samples
+ROOT_STAGE = 'run'
+
+PROFILING_ENABLED = False
+_lock = threading.Lock()
+_local = threading.local()
+_profiles = []          # (stage name, cProfile.Profile) for every stage run on every thread
+_thread_stages = {}     # thread id -> stack of stage names, read by the sampler
+_sampler = None
+_output_dir = None
+
+def add_arguments(parser):
+    """Add --profile options to an entry point's argparse parser"""
+    parser.add_argument('--profile', action='store_true',
+                        help=f'Write per-stage cProfile stats and collapsed stacks to {PROFILE_DIR}/')
+    parser.add_argument('--profile-sampling', action='store_true',
+                        help='Also sample wall-clock stacks of all threads (implies --profile)')
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+        with _lock:
+            _thread_stages[threading.get_ident()] = [name for name, _ in stack]
+    return stack
+
+def _publish(stack):
+    with _lock:
+        _thread_stages[threading.get_ident()] = [name for name, _ in stack]
+
+def _start_profile(name):
+    """Resume this thread's profile for a stage, creating it on first use"""
+    profiles = getattr(_local, 'profiles', None)
+    if profiles is None:
+        profiles = _local.profiles = {}
+    profile = profiles.get(name)
+    if profile is None:
+        profile = profiles[name] = cProfile.Profile()
+        with _lock:
+            _profiles.append((name, profile))
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12+ allows one cProfile at a time; the sampler still covers this thread
+        return None
+    return profile
+
+@contextmanager
+def stage(name):
+    """Profile a block of work as a stage. Does nothing unless profiling is enabled."""
+    if not PROFILING_ENABLED:
+        yield
+        return
+    stack = _stack()
+    parent = stack[-1][1] if stack else None
+    if parent is not None:
+        parent.disable()
+    profile = _start_profile(name)
+    stack.append((name, profile))
+    _publish(stack)
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+        stack.pop()
+        _publish(stack)
+        if parent is not None:
+            try:
+                parent.enable()
+            except ValueError:
+                pass
+
+class WallClockSampler(threading.Thread):
+    """Samples the stack of every thread, counting identical stacks"""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.interval = interval
+        self.counts = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                with _lock:
+                    stages = _thread_stages.get(thread_id) or [ROOT_STAGE]
+                key = ";".join([stages[-1]] + frames[::-1])
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def enable(entry_point, sampling=False):
+    """Start profiling the calling thread (as the 'run' stage) and dump everything at exit"""
+    global PROFILING_ENABLED, _sampler, _output_dir
+    if PROFILING_ENABLED:
+        return
+    PROFILING_ENABLED = True
+    _output_dir = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{entry_point}")
+    if sampling:
+        _sampler = WallClockSampler()
+        _sampler.start()
+    stack = _stack()
+    stack.append((ROOT_STAGE, _start_profile(ROOT_STAGE)))
+    _publish(stack)
+    atexit.register(dump)
+
+def enable_from_args(args, entry_point):
+    if args.profile or args.profile_sampling:
+        enable(entry_point, sampling=args.profile_sampling)
+
+def _stage_stats():
+    """Merge the profiles of each stage across threads and runs"""
+    by_stage = {}
+    with _lock:
+        profiles = list(_profiles)
+    for name, profile in profiles:
+        profile.disable()
+        profile.create_stats()
+        if not profile.stats:
+            continue
+        if name in by_stage:
+            by_stage[name].add(profile)
+        else:
+            by_stage[name] = pstats.Stats(profile)
+    return by_stage
+
+def _collapsed_line(frames, value):
+    return ";".join(frame.replace(';', ':') for frame in frames) + f" {value}"
+
+def dump():
+    """Write pstats files and collapsed stacks, and log the hottest functions per stage"""
+    global PROFILING_ENABLED
+    if not PROFILING_ENABLED:
+        return
+    PROFILING_ENABLED = False
+    if _sampler is not None:
+        _sampler.stop()
+    os.makedirs(_output_dir, exist_ok=True)
+
+    lines = []
+    for name, stats in sorted(_stage_stats().items()):
+        stats.dump_stats(os.path.join(_output_dir, f"{name}.pstats"))
+        hottest = []
+        for (filename, line, function), (_, _, own_time, _, _) in stats.stats.items():
+            micros = int(own_time * 1e6)
+            if micros:
+                frame = f"{function} ({os.path.basename(filename)}:{line})"
+                lines.append(_collapsed_line([name, frame], micros))
+                hottest.append((own_time, frame))
+        hottest.sort(reverse=True)
+        logger.info(f"Profile {name}: {stats.total_tt:.3f}s, hottest: "
+                    + ", ".join(f"{frame} {seconds:.3f}s" for seconds, frame in hottest[:3]))
+    with open(os.path.join(_output_dir, "stages.collapsed"), 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+
+    if _sampler is not None:
+        with open(os.path.join(_output_dir, "wall.collapsed"), 'w', encoding='utf-8') as f:
+            for key, count in sorted(_sampler.counts.items()):
+                f.write(_collapsed_line(key.split(';'), count) + "\n")
+    logger.info(f"Profiles written to {_output_dir}")
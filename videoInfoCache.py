@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+videoInfoCache.py - Persistent cache of trimmed yt-dlp video info, keyed by video ID
+
+extract_info is the slowest request we make and the first to be rate
+limited. Retries, re-tagging and re-processed playlists look the video up
+here instead, so only actual media downloads go to YouTube.
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import metrics
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+INFO_DB = os.path.join(SCRIPT_DIR, "cache", "video_info.db")
+INFO_TTL = 7 * 24 * 3600  # Seconds cached video info is reused
+
+# Fields kept from the info dict: what tagging needs plus the chosen audio format
+INFO_FIELDS = ['id', 'title', 'artist', 'track', 'duration',
+               'format_id', 'ext', 'acodec', 'abr', 'filesize']
+
+_VIDEO_ID_PATTERN = re.compile(
+    r'(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)'
+    r'([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])'
+)
+
+_local = threading.local()
+
+def _connect():
+    """One connection per thread, since playlist workers share the cache"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != INFO_DB:
+        os.makedirs(os.path.dirname(INFO_DB), exist_ok=True)
+        conn = sqlite3.connect(INFO_DB, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS videos (
+                video_id TEXT PRIMARY KEY,
+                info TEXT NOT NULL,      -- JSON of INFO_FIELDS
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.commit()
+        _local.conn, _local.path = conn, INFO_DB
+    return conn
+
+def video_id_from_url(url):
+    """The YouTube video ID in a URL, or None if it cannot be told without asking YouTube"""
+    match = _VIDEO_ID_PATTERN.search(url or '')
+    return match.group(1) if match else None
+
+def video_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def trim_info(info):
+    """Keep only INFO_FIELDS of a yt-dlp info dict"""
+    trimmed = {name: info.get(name) for name in INFO_FIELDS}
+    trimmed['title'] = trimmed['title'] or ''
+    trimmed['artist'] = trimmed['artist'] or ''
+    trimmed['track'] = trimmed['track'] or ''
+    trimmed['filesize'] = info.get('filesize') or info.get('filesize_approx')
+    return trimmed
+
+def get(video_id):
+    """Return the cached info for a video ID, or None if it is unknown or expired"""
+    if not video_id:
+        return None
+    row = _connect().execute(
+        "SELECT info, expires_at FROM videos WHERE video_id = ?", (video_id,)
+    ).fetchone()
+    if row is None or row[1] < time.time():
+        metrics.increment('cache_misses', cache='video_info')
+        return None
+    metrics.increment('cache_hits', cache='video_info')
+    return json.loads(row[0])
+
+def put(info):
+    """Store trimmed info under its video ID"""
+    if not info.get('id'):
+        return
+    now = time.time()
+    conn = _connect()
+    conn.execute("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?)",
+                 (info['id'], json.dumps(info), now, now + INFO_TTL))
+    conn.commit()
+
+def purge(expired_only=True):
+    """Delete cached info and return how many entries were removed"""
+    sql, params = "DELETE FROM videos", ()
+    if expired_only:
+        sql += " WHERE expires_at < ?"
+        params = (time.time(),)
+    conn = _connect()
+    count = conn.execute(sql, params).rowcount
+    conn.commit()
+    return count
+
+def main():
+    """
+    Main function to inspect or clean the video info cache
+    """
+    parser = argparse.ArgumentParser(description='Inspect the yt-dlp video info cache')
+    parser.add_argument('--purge-expired', action='store_true',
+                        help='Delete expired entries')
+    parser.add_argument('--clear', action='store_true',
+                        help='Forget all cached video info')
+    args = parser.parse_args()
+
+    if args.purge_expired:
+        print(f"Removed {purge()} expired entries")
+    if args.clear:
+        print(f"Removed {purge(expired_only=False)} entries")
+    conn = _connect()
+    total = conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+    fresh = conn.execute("SELECT COUNT(*) FROM videos WHERE expires_at >= ?", (time.time(),)).fetchone()[0]
+    print(f"{total} cached videos, {fresh} not expired")
+
+if __name__ == "__main__":
+    main()